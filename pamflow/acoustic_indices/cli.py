@@ -1,9 +1,16 @@
 """ Utility functions to use CLI for computing acoustic indices """
 
 import os
+import sys
+import time
+import shutil
 import argparse
-from pamflow.preprocess.utils import input_validation, load_config
-from pamflow.acoustic_indices.utils import compute_indices
+from pamflow.preprocess.utils import (
+    select_metadata, load_config, parse_shard, select_shard, shard_fname, check_site_outputs)
+from pamflow.acoustic_indices.utils import (
+    compute_indices, compute_indices_store, merge_indices_shards, iter_indices_sites,
+    iter_indices_store_sites)
+from pamflow.profiling import PROFILE_ENV, profile_summary, print_profile
 
 #%%
 if __name__ == '__main__':
@@ -20,41 +27,122 @@ if __name__ == '__main__':
                          "The config file should contain all additional settings for your script.")
     parser.add_argument( "--sites", "-s", nargs="+", default=None,
                     help="Specify sites to execute the operation (default: None)")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                    help="Directory to save partial results to resume interrupted runs "
+                         "(default: .checkpoint folder next to the results)")
+    parser.add_argument("--profile", action="store_true",
+                    help="Record wall and CPU time of each processing stage and report throughput. "
+                         "The summary is saved as profile.json and profile_files.csv next to the results.")
+    parser.add_argument("--shard", type=str, default=None,
+                    help="Process only shard i of N, formated as i/N. Files are assigned to shards "
+                         "by a hash of their path, or of their site when grouping by site (default: None)")
+    parser.add_argument("--merge", type=int, default=None, metavar="N",
+                    help="Combine the outputs of N shards into the output of a single node run, "
+                         "instead of computing indices (default: None)")
     args = parser.parse_args()
 
     # Load configuration
-    df = input_validation(args.input)
     config_file = args.config
     config = load_config(config_file)
     target_fs = config["acoustic_indices"]["target_fs"]
     n_jobs = config["acoustic_indices"]["n_jobs"]
+    batch_size = config["acoustic_indices"].get("batch_size", 16)
+    indices = config["acoustic_indices"].get("indices")
+    window = config["acoustic_indices"].get("window")
+    output_format = config["acoustic_indices"].get("output_format", "csv")
     group_by_site = config["acoustic_indices"]["group_by_site"]
     filter_type = config["acoustic_indices"]["filter_type"]
     filter_cut = config["acoustic_indices"]["filter_cut"]
     filter_order = config["acoustic_indices"]["filter_order"]
+    path_cache = config.get("cache", {}).get("path")
+    cache_size = config.get("cache", {}).get("max_size")
     select_sites = args.sites
+    if output_format not in ('csv', 'store'):
+        parser.error(f"output_format must be 'csv' or 'store', got {output_format}")
+    if output_format == 'store' and window is not None:
+        parser.error("output_format 'store' holds one row per file, set window to null")
+    if output_format == 'store' and args.merge is not None and not group_by_site:
+        parser.error("--merge of shards is only supported for csv outputs or when grouping by site")
+    suffix = '_indices' if output_format == 'store' else '_indices.csv'
 
-    # If file list provided filter dataframe
-    if select_sites is None:
-        n_sites = df.groupby('sensor_name').ngroups
-        site_list = df.sensor_name.unique()
-    else:
-        df = df[df['sensor_name'].isin(select_sites)]
-        n_sites = df.groupby('sensor_name').ngroups
-        site_list = df.sensor_name.unique()
+    # Load metadata, if file list provided filter dataframe
+    df = select_metadata(args.input, select_sites)
+
+    # Combine outputs of shards, runs grouped by site already write the final files
+    if args.merge is not None:
+        if group_by_site:
+            missing = check_site_outputs(df, args.output, suffix)
+            sys.exit(1 if missing else 0)
+        df_out = merge_indices_shards(df, args.output, args.merge)
+        df_out.to_csv(args.output, index=False)
+        print(f'Done! {args.merge} shards merged at {args.output}')
+        sys.exit(0)
+
+    # Keep the files of this shard, sites are not split between shards when grouping by site
+    fname_output = args.output
+    if args.shard is not None:
+        shard = parse_shard(args.shard)
+        df = select_shard(df, shard, by='sensor_name' if group_by_site else 'path_audio')
+        if not group_by_site:
+            fname_output = shard_fname(args.output, shard)
+        print(f'Shard {shard[0]} of {shard[1]}: {len(df)} files')
+
+    n_sites = df.groupby('sensor_name').ngroups
+    site_list = df.sensor_name.unique()
     print(f'Computing indices over {n_sites} sites: {site_list}')
 
+    # Partial results are saved to resume interrupted runs
+    path_output = args.output if group_by_site else os.path.dirname(os.path.abspath(args.output))
+    path_checkpoint = args.checkpoint
+    if path_checkpoint is None:
+        path_checkpoint = os.path.join(path_output, '.checkpoint')
+    shard_name = '' if args.shard is None else 'shard-{}-of-{}'.format(*shard)
+    path_checkpoint = os.path.join(path_checkpoint, shard_name)
+
+    # Profiling records are written by each process, workers inherit the environment
+    if args.profile:
+        path_profile = os.path.join(path_output, '.profile', shard_name)
+        path_save_profile = path_profile if shard_name else path_output
+        shutil.rmtree(path_profile, ignore_errors=True)
+        os.environ[PROFILE_ENV] = path_profile
+    start = time.perf_counter()
+
     # Format output per site or per batch
-    if group_by_site:  
-        for site, df_site in df.groupby('sensor_name'):
-            df_out = compute_indices(
-                df_site, target_fs, filter_type, filter_cut, filter_order, n_jobs)
-            fname_save = os.path.join(args.output, f'{site}_indices.csv')
+    # Columnar stores are written as files complete, sorted by site and date
+    # Sites share one pool of processes and are saved as soon as their last file completes
+    if output_format == 'store' and group_by_site:
+        for site, fname_save, n_files in iter_indices_store_sites(
+                df, args.output, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                path_cache, cache_size, batch_size, indices, suffix):
+            print(f'{site} Done! Results of {n_files} files are stored at {fname_save}')
+
+    elif output_format == 'store':
+        n_files = compute_indices_store(
+            df, fname_output, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+            path_cache, cache_size, batch_size, indices)
+        print(f'Done! Results of {n_files} files are stored at {fname_output}')
+
+    elif group_by_site:
+        for site, df_out in iter_indices_sites(
+                df, target_fs, filter_type, filter_cut, filter_order, n_jobs, path_cache,
+                cache_size, path_checkpoint, batch_size, indices, window):
+            fname_save = os.path.join(args.output, f'{site}{suffix}')
             df_out.to_csv(fname_save, index=False)
             print(f'{site} Done! Results are stored at {fname_save}')
 
+    elif len(df) == 0:  # shard without files, an empty output marks it as done
+        open(fname_output, 'w').close()
+        print(f'No files to process, empty output stored at {fname_output}')
+
     else:
         df_out = compute_indices(
-            df, target_fs, filter_type, filter_cut, filter_order, n_jobs)
-        df_out.to_csv(args.output, index=False)
-        print(f'Done! Results are stored at {args.output}')
+            df, target_fs, filter_type, filter_cut, filter_order, n_jobs, path_cache, cache_size,
+            path_checkpoint, batch_size, indices, window)
+        df_out.to_csv(fname_output, index=False)
+        print(f'Done! Results are stored at {fname_output}')
+
+    if args.profile:
+        df_stages, summary = profile_summary(
+            path_profile, time.perf_counter() - start, path_save=path_save_profile)
+        print_profile(df_stages, summary)
+        print(f'Profile saved at {os.path.join(path_save_profile, "profile.json")}')
@@ -0,0 +1,249 @@
+""" Registry of acoustic indices computed on stacks of spectrograms
+
+Indices are functions registered with the register_index decorator. Each index
+declares the intermediates it needs ('waveform', 'amplitude', 'power' or 'dB') and
+receives a Spectra object, which computes intermediates only when first used and shares
+them between indices. Indices return one value per file of the stack.
+
+The indices to compute and their parameters are selected with a dictionary, as in the
+acoustic_indices section of config.yaml:
+
+    indices:
+      ADI: {fmax: 24000, dB_threshold: -40}
+      NDSI: {flim_bioPh: [2000, 20000], flim_antroPh: [0, 2000]}
+      Ht: {}
+
+Default parameters follow the ones used by compute_acoustic_indices, and results match
+the scikit-maad functions up to floating point rounding, with relative differences below
+RTOL. ADI and SC count time-frequency bins above a threshold, a bin lying exactly on the
+threshold may be counted differently.
+
+"""
+import sys
+from functools import cached_property
+import numpy as np
+from scipy.signal import find_peaks
+from maad import util
+
+INTERMEDIATES = ('waveform', 'amplitude', 'power', 'dB')
+INDICES = dict()
+RTOL = 1e-9  # relative tolerance against compute_acoustic_indices
+
+#%%
+def register_index(name, requires, dtype='f8'):
+    """ Decorator to register an acoustic index
+
+    Parameters
+    ----------
+    name : str
+        Name of the index, used in the configuration and as column of the results.
+    requires : tuple of str
+        Intermediates used by the index, from 'waveform', 'amplitude', 'power' and 'dB'.
+    dtype : str, optional
+        Numpy type of the index, by default 'f8'
+    """
+    unknown = set(requires) - set(INTERMEDIATES)
+    if unknown:
+        raise ValueError(f'Unknown intermediates {unknown}, options are {INTERMEDIATES}')
+
+    def decorator(func):
+        INDICES[name] = {'func': func, 'requires': tuple(requires), 'dtype': dtype}
+        return func
+    return decorator
+
+def select_indices(indices=None):
+    """ Validate a selection of indices, None selects all registered indices
+
+    Returns
+    -------
+    dict
+        Index names and parameters.
+    """
+    if indices is None:
+        return {name: {} for name in INDICES}
+    if isinstance(indices, (list, tuple)):
+        indices = {name: {} for name in indices}
+    unknown = [name for name in indices if name not in INDICES]
+    if unknown:
+        raise ValueError(f'Unknown acoustic indices {unknown}, options are {list(INDICES)}')
+    return {name: dict(params or {}) for name, params in indices.items()}
+
+def indices_dtype(indices=None):
+    """ Numpy record type of the results for a selection of indices """
+    indices = select_indices(indices)
+    return np.dtype([(name, INDICES[name]['dtype']) for name in indices])
+
+def indices_requires(indices=None):
+    """ Intermediates needed by a selection of indices """
+    indices = select_indices(indices)
+    return {item for name in indices for item in INDICES[name]['requires']}
+
+def spectrogram_outputs(indices=None):
+    """ Outputs of pamflow.preprocess.spectrogram.get_spectrogram needed by a selection
+    of indices, the spectrogram for spectral indices and the envelope for temporal ones """
+    requires = indices_requires(indices)
+    outputs = ()
+    if requires & {'amplitude', 'power', 'dB'}:
+        outputs += ('spectrogram',)
+    if 'waveform' in requires:
+        outputs += ('envelope',)
+    return outputs
+
+#%%
+class Spectra:
+    """ Intermediates shared by acoustic indices of a stack of files
+
+    Parameters
+    ----------
+    Sxx : 3d numpy array of floats
+        Amplitude spectrograms stacked as (files, frequencies, times), computed with
+        maad.sound.spectrogram mode='amplitude'. Can be None if only temporal indices
+        are computed.
+    fn : 1d ndarray of floats
+        Frequency vector of the spectrograms, None if Sxx is None.
+    env : 2d numpy array, optional
+        Envelopes stacked as (files, samples), computed with maad.sound.envelope
+        mode='fast' and Nt=512. Required by indices using the waveform.
+    """
+    def __init__(self, Sxx, fn, env=None):
+        self._amplitude = None if Sxx is None else np.asarray(Sxx)
+        self._env = env
+        if Sxx is None:
+            self.n_files = len(env)
+        else:
+            self.fn = np.asarray(fn)
+            self.df = fn[1] - fn[0]
+            self.n_files, _, self.n_times = self._amplitude.shape
+
+    @property
+    def amplitude(self):
+        if self._amplitude is None:
+            raise ValueError('Spectrograms are required to compute spectral indices')
+        return self._amplitude
+
+    @property
+    def waveform(self):
+        if self._env is None:
+            raise ValueError('Envelope of the signals is required to compute temporal indices')
+        return np.asarray(self._env)
+
+    @cached_property
+    def power(self):
+        return self.amplitude**2
+
+    @cached_property
+    def dB(self):
+        return util.amplitude2dB(self.amplitude)
+
+    # Reductions along time, shape (files, frequencies)
+    @cached_property
+    def amplitude_max(self):
+        return self.amplitude.max(axis=(1, 2))
+
+    @cached_property
+    def amplitude_sum(self):
+        return self.amplitude.sum(axis=2)
+
+    @cached_property
+    def power_sum(self):
+        return self.power.sum(axis=2)
+
+    def active(self, dB_threshold, relative=False):
+        """ Number of time bins above a threshold in dB, per frequency
+
+        Thresholds are compared in linear scale, so the dB spectrogram is not needed.
+        If relative, the threshold is relative to the maximum of each spectrogram.
+        """
+        threshold = 10**(dB_threshold / 20)
+        if relative:
+            threshold = (self.amplitude_max * threshold)[:, None, None]
+        return (self.amplitude >= threshold).sum(axis=2)
+
+def _entropy(x):
+    """ Normalized Shannon entropy along the last axis, as maad.util.entropy """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pmf = x / x.sum(axis=-1, keepdims=True)
+    pmf[pmf == 0] = sys.float_info.min
+    H = -np.sum(pmf * np.log(pmf), axis=-1) / np.log(x.shape[-1])
+    # Entropy of null signals is 1
+    H[~x.any(axis=-1)] = 1
+    return H
+
+#%%
+# -------------------------
+# Acoustic Indices
+# -------------------------
+@register_index('ADI', requires=('amplitude',))
+def acoustic_diversity_index(X, fmin=0, fmax=24000, bin_step=1000, dB_threshold=-40,
+                             index='shannon'):
+    """ Acoustic diversity index, as maad.features.acoustic_diversity_index """
+    f0 = [int(fmin + bin_step * ii) for ii in range(int(np.floor((fmax - fmin) / bin_step)))]
+    bands = np.array([util.index_bw(X.fn, (f, int(f + bin_step))) for f in f0])
+    score = X.active(dB_threshold, relative=True) @ bands.T / (bands.sum(axis=1) * X.n_times)
+    if index == 'shannon':
+        return _entropy(score) * np.log(bands.shape[0])
+    p = score / score.sum(axis=1, keepdims=True)
+    if index == 'simpson':
+        return 1 - np.sum(p**2, axis=1)
+    elif index == 'invsimpson':
+        return 1 / np.sum(p**2, axis=1)
+    raise ValueError("index must be 'shannon', 'simpson' or 'invsimpson'")
+
+@register_index('ACI', requires=('amplitude',))
+def acoustic_complexity_index(X):
+    """ Acoustic complexity index, as maad.features.acoustic_complexity_index """
+    diff_sum = np.abs(np.diff(X.amplitude, axis=2)).sum(axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(diff_sum / X.amplitude_sum, axis=1)
+
+@register_index('NDSI', requires=('power',))
+def soundscape_index(X, flim_bioPh=(2000, 20000), flim_antroPh=(0, 2000)):
+    """ Normalized difference soundscape index, as maad.features.soundscape_index """
+    # Energy in bins of the width of the anthropophony band, as soundecology
+    bin_step = flim_antroPh[1] - flim_antroPh[0]
+    bins = np.arange(X.fn[0], X.fn[-1] + bin_step, bin_step)
+    bins_mask = np.array([(X.fn >= b0) * (X.fn < b1) for b0, b1 in zip(bins[:-1], bins[1:])])
+    count = bins_mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        power_bins = X.power_sum @ bins_mask.T / count * np.mean(count)
+        bioPh = power_bins[:, util.index_bw(bins[:-1], tuple(flim_bioPh))].sum(axis=1)
+        antroPh = power_bins[:, util.index_bw(bins[:-1], tuple(flim_antroPh))].sum(axis=1)
+        return (bioPh - antroPh) / (bioPh + antroPh)
+
+@register_index('BI', requires=('amplitude',))
+def bioacoustics_index(X, flim=(2000, 11000)):
+    """ Bioacoustics index, as maad.features.bioacoustics_index """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_dB = util.amplitude2dB(X.amplitude_sum / X.n_times / X.amplitude_max[:, None])
+    mean_dB = mean_dB[:, util.index_bw(X.fn, tuple(flim))]
+    return np.sum(mean_dB - mean_dB.min(axis=1, keepdims=True), axis=1) / X.df
+
+@register_index('Hf', requires=('power',))
+def frequency_entropy(X):
+    """ Spectral entropy, as maad.features.frequency_entropy """
+    return _entropy(X.power_sum / X.n_times)
+
+@register_index('Ht', requires=('waveform',))
+def temporal_entropy(X):
+    """ Temporal entropy, as maad.features.temporal_entropy """
+    return _entropy(X.waveform**2)
+
+@register_index('H', requires=('waveform', 'power'))
+def acoustic_entropy(X):
+    """ Acoustic entropy, product of spectral and temporal entropy """
+    return frequency_entropy(X) * temporal_entropy(X)
+
+@register_index('SC', requires=('amplitude',))
+def spectral_cover(X, dB_threshold=-70, flim=(1000, 20000)):
+    """ Spectral cover within flim, as the low frequency cover of maad.features.spectral_cover """
+    band = util.index_bw(X.fn, tuple(flim))
+    return X.active(dB_threshold)[:, band].sum(axis=1) / (band.sum() * X.n_times)
+
+@register_index('NP', requires=('power',), dtype='i8')
+def number_of_peaks(X, min_peak_val=0, min_freq_dist=100, prominence=1e-6):
+    """ Number of peaks of the mean spectrum, as maad.features.number_of_peaks
+    on the power spectrogram with mode='linear' and no slopes """
+    spectrum = np.sqrt(np.einsum('bft,bft->bf', X.power, X.power) / X.n_times)
+    return np.array([
+        len(find_peaks(x, height=min_peak_val, distance=min_freq_dist / X.df,
+                       prominence=prominence)[0]) for x in spectrum])
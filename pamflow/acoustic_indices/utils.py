@@ -1,28 +1,38 @@
 """ Utility functions to compute acoustic indices """
 
 import os
-import concurrent.futures
+import json
+import hashlib
+import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import pandas as pd
 from maad import sound, features, util
-from pamflow.preprocess.utils import input_validation
+from pamflow.preprocess.utils import (
+    input_validation, read_wav_header, read_shards, bounded_map, bounded_map_groups)
+from pamflow.preprocess.spectrogram import get_spectrogram, iter_audio_windows
+from pamflow.profiling import stage, profile_files
+from pamflow.acoustic_indices.indices import (
+    INDICES, Spectra, select_indices, indices_dtype, spectrogram_outputs)
 
 #%%
-def compute_acoustic_indices(s, Sxx, tn, fn):
+def compute_acoustic_indices(s, Sxx, tn, fn, env=None):
     """ 
     Main function that defines which and how indices will be computed.
     
     Parameters
     ----------
     s : 1d numpy array
-        acoustic data
+        acoustic data, not used if env is provided
     Sxx : 2d numpy array of floats
         Amplitude spectrogram computed with maad.sound.spectrogram mode='amplitude'
     tn : 1d ndarray of floats
         time vector with temporal indices of spectrogram.
     fn : 1d ndarray of floats
         frequency vector with temporal indices of spectrogram..
+    env : 1d numpy array, optional
+        envelope of the acoustic data computed with maad.sound.envelope mode='fast'
+        and Nt=512, as returned by get_spectrogram.
 
     Returns
     -------
@@ -40,7 +50,10 @@ def compute_acoustic_indices(s, Sxx, tn, fn):
     _, _, ACI = features.acoustic_complexity_index(Sxx)
     NDSI, xBA, xA, xB = features.soundscape_index(
         Sxx_power, fn, flim_bioPh=(2000, 20000), flim_antroPh=(0, 2000))
-    Ht = features.temporal_entropy(s)
+    if env is None:
+        Ht = features.temporal_entropy(s)
+    else:
+        Ht = util.entropy(env**2)
     Hf, _ = features.frequency_entropy(Sxx_power)
     H = Hf * Ht
     BI = features.bioacoustics_index(Sxx, fn, flim=(2000, 11000))
@@ -65,24 +78,67 @@ def compute_acoustic_indices(s, Sxx, tn, fn):
 #%%
 def compute_acoustic_indices_single_file(
         path_audio, target_fs=48000, filter_type=None, filter_cut=None, filter_order=None,
-        verbose=True):
+        verbose=True, path_cache=None, cache_size=None):
     
     if verbose:
         print(f'Processing file {path_audio}', end='\r')
 
-    # load audio
-    s, fs = sound.load(path_audio)
-    s = sound.resample(s, fs, target_fs, res_type='scipy_poly')
-    if filter_type is not None:
-        s = sound.select_bandwidth(s, target_fs, ftype=filter_type, fcut=filter_cut, forder=filter_order)
+    # Load audio, resample, filter and compute the amplitude spectrogram, or get it from cache
+    Sxx, tn, fn, _, env = get_spectrogram(
+        path_audio, target_fs, nperseg=1024, noverlap=0, mode='amplitude',
+        filter_type=filter_type, filter_cut=filter_cut, filter_order=filter_order,
+        path_cache=path_cache, max_size=cache_size)
 
-    # Compute the amplitude spectrogram and acoustic indices
-    Sxx, tn, fn, _ = sound.spectrogram(
-        s, target_fs, nperseg = 1024, noverlap=0, mode='amplitude')
-    df_indices_file = compute_acoustic_indices(s, Sxx, tn, fn)
+    # Compute acoustic indices
+    df_indices_file = compute_acoustic_indices(None, Sxx, tn, fn, env)
     
     return df_indices_file
 
+#%% Batched computing
+def compute_acoustic_indices_batch(Sxx, fn, env=None, indices=None):
+    """ Compute acoustic indices of a stack of spectrograms with equal shapes
+
+    Indices are computed with the functions registered in pamflow.acoustic_indices.indices,
+    which share intermediates and reductions between indices and files. Only the
+    intermediates needed by the selected indices are computed. With default parameters,
+    results match compute_acoustic_indices up to floating point rounding (relative
+    differences below pamflow.acoustic_indices.indices.RTOL). ADI and SC count time-frequency bins above a threshold, a
+    bin lying exactly on the threshold may be counted differently, which changes the
+    fraction of active bins by at most 1 / (number of bins).
+
+    Parameters
+    ----------
+    Sxx : 3d numpy array of floats
+        Amplitude spectrograms stacked as (files, frequencies, times), computed with
+        maad.sound.spectrogram mode='amplitude'. Required by spectral indices.
+    fn : 1d ndarray of floats
+        Frequency vector of the spectrograms.
+    env : 2d numpy array, optional
+        Envelopes stacked as (files, samples), computed with maad.sound.envelope
+        mode='fast' and Nt=512, as returned by get_spectrogram. Required by temporal indices.
+    indices : dict, optional
+        Names of the indices to compute and their parameters, by default all registered
+        indices with default parameters.
+
+    Returns
+    -------
+    records : numpy record array
+        Acoustic indices, one row per file and one field per index.
+    """
+    indices = select_indices(indices)
+    outputs = spectrogram_outputs(indices)
+    if 'envelope' in outputs and env is None:
+        raise ValueError('env is required to compute temporal indices')
+    if 'spectrogram' in outputs and Sxx is None:
+        raise ValueError('Sxx is required to compute spectral indices')
+
+    X = Spectra(Sxx, fn, env)
+    records = np.zeros(X.n_files, dtype=indices_dtype(indices))
+    for name, params in indices.items():
+        with stage(f'index:{name}'):
+            records[name] = INDICES[name]['func'](X, **params)
+    return records
+
 #%%
 def batch_compute_acoustic_indices(data, path_save=None):
     df = input_validation(data)
@@ -109,57 +165,793 @@ def batch_compute_acoustic_indices(data, path_save=None):
         df_indices.to_csv(path_save+sensor_name+'_indices.csv', index=False)
 
 #%% Parellel computing
-def compute_indices_parallel(data, target_fs, filter_type, filter_cut, filter_order, n_jobs=4):
+def compute_indices_batch(files, target_fs, filter_type, filter_cut, filter_order,
+                          verbose=True, path_cache=None, cache_size=None, indices=None):
+    """ Compute acoustic indices of a batch of files
+
+    Spectrograms with equal shapes, such as recordings of the same length, are stacked
+    and processed at once with compute_acoustic_indices_batch. Only the spectrograms or
+    envelopes needed by the selected indices are computed. Results are returned as a
+    numpy record array, which is much cheaper to send between processes than one pandas
+    Series per file.
+
+    Returns
+    -------
+    records : numpy record array
+        Acoustic indices, one row per file and one field per index.
+    valid : numpy array of bool
+        False for files that could not be processed.
+    """
+    records = np.zeros(len(files), dtype=indices_dtype(indices))
+    valid = np.zeros(len(files), dtype=bool)
+    outputs = spectrogram_outputs(indices)
+
+    # Group spectrograms with equal shapes to compute indices on stacks
+    groups = dict()
+    for idx, file_path in enumerate(files):
+        if verbose:
+            print(f'Processing file {file_path}', end='\r')
+        try:
+            with profile_files(file_path):
+                Sxx, _, fn, _, env = get_spectrogram(
+                    file_path, target_fs, nperseg=1024, noverlap=0, mode='amplitude',
+                    filter_type=filter_type, filter_cut=filter_cut, filter_order=filter_order,
+                    path_cache=path_cache, max_size=cache_size, outputs=outputs)
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+            continue
+        key = (np.shape(Sxx), np.shape(env), None if fn is None else fn[-1])
+        groups.setdefault(key, []).append((idx, Sxx, fn, env))
+
+    for group in groups.values():
+        idx = [item[0] for item in group]
+        with profile_files([files[i] for i in idx]):
+            with stage('stack'):
+                Sxx, env = [None if group[0][pos] is None else
+                            np.stack([item[pos] for item in group]) for pos in (1, 3)]
+            records[idx] = compute_acoustic_indices_batch(Sxx, group[0][2], env, indices)
+        valid[idx] = True
+    return records, valid
+
+def iter_indices(files, target_fs, filter_type, filter_cut, filter_order, n_jobs=1,
+                 path_cache=None, cache_size=None, batch_size=16, max_in_flight=None,
+                 indices=None):
+    """ Compute acoustic indices of a list of files, yielding batches as they complete
+
+    Files are sent to workers in batches of batch_size files, and at most max_in_flight
+    batches are pending at any time, so memory use does not grow with the number of files.
+
+    Parameters
+    ----------
+    files : list
+        Paths to audio files.
+    target_fs, filter_type, filter_cut, filter_order
+        Preprocessing parameters, see compute_acoustic_indices_single_file.
+    n_jobs : int, optional
+        Number of processes, -1 uses all processors, by default 1
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+    batch_size : int, optional
+        Number of files per task, by default 16
+    max_in_flight : int, optional
+        Maximum number of pending tasks, by default twice the number of processes.
+    indices : dict, optional
+        Names of the indices to compute and their parameters, by default all registered
+        indices with default parameters.
+
+    Yields
+    ------
+    tuple
+        Position of the batch in files, record array with acoustic indices and boolean
+        array with files processed without errors, see compute_indices_batch.
+    """
+    args = (target_fs, filter_type, filter_cut, filter_order, True, path_cache, cache_size,
+            select_indices(indices))
+    starts = range(0, len(files), batch_size)
+    tasks = ((files[start:start + batch_size], *args) for start in starts)
+    for position, (records, valid) in bounded_map(
+            compute_indices_batch, tasks, n_jobs, max_in_flight):
+        yield position * batch_size, records, valid
+
+def _collect_indices(files, batches, indices=None):
+    """ Gather batches of results from iter_indices into a dataframe ordered as files """
+    records = np.zeros(len(files), dtype=indices_dtype(indices))
+    valid = np.zeros(len(files), dtype=bool)
+    for start, records_batch, valid_batch in batches:
+        records[start:start + len(records_batch)] = records_batch
+        valid[start:start + len(valid_batch)] = valid_batch
+
+    df_out = pd.DataFrame(records[valid])
+    df_out['fname'] = [os.path.basename(file_path) for file_path in np.asarray(files)[valid]]
+    return df_out
+
+def compute_indices_parallel(data, target_fs, filter_type, filter_cut, filter_order, n_jobs=4,
+                             path_cache=None, cache_size=None, batch_size=16, indices=None):
     df = input_validation(data)
     if n_jobs == -1:
         n_jobs = os.cpu_count()
 
     print(f'Computing acoustic indices for {df.shape[0]} files with {n_jobs} threads')
     
-    # Use concurrent.futures for parelell execution
     files = df.path_audio.to_list()
-    with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
-        
-        # Use submit for each task
-        futures = {executor.submit(compute_acoustic_indices_single_file, file, target_fs, filter_type, filter_cut, filter_order): file for file in files}
-
-        # Get results when tasks are completed
-        results = []
-        for future in concurrent.futures.as_completed(futures):
-            file_path = futures[future]
-            try:
-                result = future.result()
-                result['fname'] = os.path.basename(file_path)
-                results.append(result)
-            
-            except Exception as e:
-                print(f"Error processing {file_path}: {e}")
+    batches = iter_indices(files, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                           path_cache, cache_size, batch_size, indices=indices)
 
     # Build dataframe with results
-    df_out = pd.DataFrame(results)
+    df_out = _collect_indices(files, batches, indices)
     return df_out
 
 #%% Sequential computing
-def compute_indices_sequential(data, target_fs, filter_type, filter_cut, filter_order):
+def compute_indices_sequential(data, target_fs, filter_type, filter_cut, filter_order,
+                               path_cache=None, cache_size=None, indices=None):
     df = input_validation(data)
     print(f'Computing acoustic indices for {df.shape[0]} files')
     
     files = df.path_audio.to_list()
-    results = []
-    for i, file_path in enumerate(files, start=1):
-        result = compute_acoustic_indices_single_file(
-            file_path, target_fs, filter_type, filter_cut, filter_order)
-        result['fname'] = os.path.basename(file_path)
-        results.append(result)
+    batches = iter_indices(files, target_fs, filter_type, filter_cut, filter_order, 1,
+                           path_cache, cache_size, indices=indices)
     
     # Build dataframe with results
-    df_out = pd.DataFrame(results)
+    df_out = _collect_indices(files, batches, indices)
     return df_out
 
-def compute_indices(data, target_fs, filter_type, filter_cut, filter_order, n_jobs):
-    if n_jobs == 1:
-        df_out = compute_indices_sequential(data, target_fs, filter_type, filter_cut, filter_order)
+#%% Streaming computing
+def compute_acoustic_indices_stream(
+        path_audio, window=60, target_fs=48000, filter_type=None, filter_cut=None,
+        filter_order=None, verbose=True, indices=None):
+    """ Compute acoustic indices on consecutive windows of an audio file
+
+    The file is read one window at a time with iter_audio_windows, so long continuous
+    recordings are processed with bounded memory, and one row of indices is computed
+    per window.
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    window : float, optional
+        Length of the windows in seconds, by default 60
+    target_fs, filter_type, filter_cut, filter_order
+        Preprocessing parameters, see compute_acoustic_indices_single_file.
+    verbose : bool, optional
+        Print progress, by default True
+    indices : dict, optional
+        Names of the indices to compute and their parameters, by default all registered
+        indices with default parameters.
+
+    Returns
+    -------
+    records : numpy record array
+        Acoustic indices, one row per window with field offset, the start of the window
+        in seconds from the beginning of the file, and one field per index. Windows
+        shorter than the spectrogram segment are skipped.
+    """
+    if verbose:
+        print(f'Processing file {path_audio}', end='\r')
+
+    fs = target_fs if target_fs is not None else read_wav_header(path_audio)['sample_rate']
+    outputs = spectrogram_outputs(indices)
+    results = []
+    with profile_files(path_audio):
+        for offset, s in iter_audio_windows(
+                path_audio, window, target_fs, filter_type, filter_cut, filter_order):
+            if len(s) < 1024:
+                continue
+            Sxx, fn, env = None, None, None
+            if 'spectrogram' in outputs:
+                with stage('stft'):
+                    Sxx, _, fn, _ = sound.spectrogram(
+                        s, fs, window='hann', nperseg=1024, noverlap=0, mode='amplitude')
+                Sxx = Sxx[None]
+            if 'envelope' in outputs:
+                with stage('envelope'):
+                    env = sound.envelope(s, mode='fast', Nt=512)[None]
+            results.append(
+                (offset, compute_acoustic_indices_batch(Sxx, fn, env, indices)))
+
+    dtype = indices_dtype(indices)
+    records = np.zeros(len(results), dtype=[('offset', 'f8')] + dtype.descr)
+    records['offset'] = [offset for offset, _ in results]
+    for name in dtype.names:
+        records[name] = [result[name][0] for _, result in results]
+    return records
+
+def _compute_acoustic_indices_stream(path_audio, *args):
+    """ compute_acoustic_indices_stream returning no windows if the file can not be read """
+    try:
+        return compute_acoustic_indices_stream(path_audio, *args)
+    except Exception as e:
+        print(f"Error processing {path_audio}: {e}")
+        return None
+
+def iter_indices_stream(files, window, target_fs, filter_type, filter_cut, filter_order,
+                        n_jobs=1, indices=None):
+    """ Compute acoustic indices on windows of a list of files, yielding files as they complete
+
+    Each file is a task of the pool of processes, see compute_acoustic_indices_stream.
+
+    Yields
+    ------
+    tuple
+        Path to the file and record array with acoustic indices per window, or None if
+        the file could not be processed.
+    """
+    args = (window, target_fs, filter_type, filter_cut, filter_order, True, select_indices(indices))
+    tasks = ((file_path, *args) for file_path in files)
+    for position, records in bounded_map(_compute_acoustic_indices_stream, tasks, n_jobs):
+        yield files[position], records
+
+def compute_indices_stream(data, window, target_fs, filter_type, filter_cut, filter_order,
+                           n_jobs=1, indices=None):
+    """ Compute acoustic indices on windows of audio files
+
+    Returns
+    -------
+    pandas DataFrame
+        Acoustic indices with one row per window, with columns fname, offset and date,
+        the start of the window, if dates are available in the metadata.
+    """
+    df = input_validation(data)
+    print(f'Computing acoustic indices on windows of {window} s for {df.shape[0]} files')
+    files = df.path_audio.to_list()
+    frames = _iter_index_frames(
+        files, target_fs, filter_type, filter_cut, filter_order, n_jobs, indices=indices,
+        window=window)
+    df_out = pd.concat([pd.DataFrame()] + list(frames))
+    return _format_windows(df_out, df)
+
+def _iter_index_frames(files, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                       path_cache=None, cache_size=None, batch_size=16, indices=None,
+                       window=None):
+    """ Results of iter_indices, or iter_indices_stream if window is set, as dataframes
+    with columns fname and path_audio """
+    if window is None:
+        for start, records, valid in iter_indices(
+                files, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                path_cache, cache_size, batch_size, indices=indices):
+            yield _index_frame(files[start:start + len(records)], (records, valid), window)
+    else:
+        for file_path, records in iter_indices_stream(
+                files, window, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                indices):
+            yield _index_frame(file_path, records, window)
+
+def _index_tasks(files, target_fs, filter_type, filter_cut, filter_order, path_cache=None,
+                 cache_size=None, batch_size=16, indices=None, window=None):
+    """ Function and list of tasks computing the indices of files, as iter_indices or
+    iter_indices_stream if window is set """
+    if window is None:
+        args = (target_fs, filter_type, filter_cut, filter_order, True, path_cache,
+                cache_size, select_indices(indices))
+        return compute_indices_batch, [
+            (files[start:start + batch_size], *args) for start in range(0, len(files), batch_size)]
+    args = (window, target_fs, filter_type, filter_cut, filter_order, True, select_indices(indices))
+    return _compute_acoustic_indices_stream, [(file_path, *args) for file_path in files]
+
+def _index_frame(files, result, window=None):
+    """ Result of a task of _index_tasks as a dataframe with columns fname and path_audio,
+    files is the list of files of the task, or the file if window is set """
+    if window is None:
+        records, valid = result
+        files = np.asarray(files)[valid]
+        df_batch = pd.DataFrame(records[valid])
+        df_batch['fname'] = [os.path.basename(file_path) for file_path in files]
+        df_batch['path_audio'] = files
+        return df_batch
+    if result is None:
+        return pd.DataFrame()
+    df_file = pd.DataFrame(result)
+    df_file['fname'] = os.path.basename(files)
+    df_file['path_audio'] = files
+    return df_file
+
+def _format_windows(df_out, df):
+    """ Order results per window as files in df and add the date of each window """
+    if df_out.empty:
+        return df_out
+    columns = ['path_audio', 'date'] if 'date' in df.columns else ['path_audio']
+    df_out = df[columns].merge(df_out, on='path_audio', how='inner')
+    if 'date' in df_out.columns:
+        df_out['date'] = (pd.to_datetime(df_out['date'])
+                          + pd.to_timedelta(df_out['offset'], unit='s'))
+    info = [col for col in ('fname', 'offset', 'date') if col in df_out.columns]
+    df_out = df_out[[col for col in df_out.columns if col not in info] + info]
+    return df_out.drop(columns='path_audio')
+
+#%% Resumable computing
+def checkpoint_path(path_checkpoint, target_fs, filter_type, filter_cut, filter_order,
+                    indices=None, window=None):
+    """ Path of the checkpoint directory for a given configuration
+
+    Results computed with different configurations are stored in different directories,
+    named after a hash of the configuration.
+    """
+    config_id = _config_id(target_fs, filter_type, filter_cut, filter_order, indices, window)
+    return os.path.join(path_checkpoint, f'indices_{config_id}')
+
+def _config_id(target_fs, filter_type, filter_cut, filter_order, indices=None, window=None):
+    """ Hash of the parameters that determine the values of acoustic indices """
+    config = {
+        'target_fs': target_fs, 'filter_type': filter_type, 'filter_cut': filter_cut,
+        'filter_order': filter_order, 'nperseg': 1024, 'noverlap': 0,
+        'indices': select_indices(indices)}
+    if window is not None:
+        config['window'] = window
+    config = json.dumps(config, sort_keys=True)
+    return hashlib.blake2b(config.encode(), digest_size=8).hexdigest()
+
+def _checkpoint_parts(path):
+    """ Complete parts of a checkpoint, in the order they were written """
+    if not os.path.isdir(path):
+        return []
+    return sorted(os.path.join(path, fname) for fname in os.listdir(path)
+                  if fname.startswith('part-') and fname.endswith('.csv'))
+
+class _IndexResults:
+    """ Results of the files of a run, saved in parts to a checkpoint directory
+
+    Parts are written under a temporary name and then renamed, so a run killed while
+    writing never leaves a partial part. Without path, results are only kept in memory.
+    """
+    def __init__(self, df, path=None, chunk_size=100):
+        self.df, self.path, self.chunk_size = df, path, chunk_size
+        self.parts = []
+        self.results = []
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.parts = _checkpoint_parts(path)
+            results = [pd.read_csv(fname, float_precision='round_trip') for fname in self.parts]
+            self.results = [df_part[df_part.path_audio.isin(df.path_audio)]
+                            for df_part in results]
+        done = set().union(*[df_part.path_audio for df_part in self.results])
+        # Files to compute
+        self.files = [f for f in df.path_audio if f not in done]
+        self.chunk = []
+
+    def add(self, df_batch):
+        self.chunk.append(df_batch)
+        if sum(len(df_chunk) for df_chunk in self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.chunk) == 0:
+            return
+        if self.path is not None:
+            fname = os.path.join(self.path, f'part-{len(self.parts):06d}-{os.getpid()}.csv')
+            pd.concat(self.chunk).to_csv(fname + '.tmp', index=False)
+            os.replace(fname + '.tmp', fname)
+            self.parts.append(fname)
+        self.results.extend(self.chunk)
+        self.chunk = []
+
+    def output(self, window=None):
+        """ Acoustic indices of the files of the run, ordered as the files """
+        self.flush()
+        if len(self.results) == 0:
+            return pd.DataFrame()
+        df_out = pd.concat(self.results, ignore_index=True)
+        if window is not None:
+            df_out = df_out.drop_duplicates(['path_audio', 'offset'], keep='last')
+            return _format_windows(df_out, self.df)
+        df_out = df_out.drop_duplicates('path_audio', keep='last')
+        df_out = self.df[['path_audio']].merge(df_out, on='path_audio', how='inner')
+        return df_out.drop(columns='path_audio')
+
+def compute_indices_resumable(data, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                              path_checkpoint, chunk_size=100, path_cache=None, cache_size=None,
+                              batch_size=16, indices=None, window=None):
+    """ Compute acoustic indices saving results to a checkpoint as they complete
+
+    Results are saved in chunks of chunk_size files, each chunk as a csv file written
+    under a temporary name and then renamed, so a run killed while writing never leaves
+    a partial chunk. When the computation is restarted, files with results for the same
+    configuration in the checkpoint are skipped, so interrupted runs can be resumed.
+    Use a different path_checkpoint for each site to keep checkpoints small when sites
+    are computed separately, as iter_indices_sites does.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata.
+    target_fs, filter_type, filter_cut, filter_order
+        Preprocessing parameters, see compute_acoustic_indices_single_file.
+    n_jobs : int
+        Number of processes, -1 uses all processors.
+    path_checkpoint : str
+        Directory where checkpoints are saved.
+    chunk_size : int, optional
+        Number of results written at once, by default 100
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+    batch_size : int, optional
+        Number of files per task, by default 16
+    indices : dict, optional
+        Names of the indices to compute and their parameters, by default all registered
+        indices with default parameters.
+    window : float, optional
+        Length in seconds of windows to compute indices on, see compute_indices_stream.
+        By default indices are computed on whole files.
+
+    Returns
+    -------
+    pandas DataFrame
+        Acoustic indices of the files in data, with column fname.
+    """
+    df = input_validation(data)
+    path = checkpoint_path(
+        path_checkpoint, target_fs, filter_type, filter_cut, filter_order, indices, window)
+    results = _IndexResults(df, path, chunk_size)
+    print(f'Computing acoustic indices for {len(results.files)} files, '
+          f'{df.shape[0] - len(results.files)} files found in checkpoint')
+    try:
+        for df_batch in _iter_index_frames(
+                results.files, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                path_cache, cache_size, batch_size, indices, window):
+            results.add(df_batch)
+    finally:
+        results.flush()
+    return results.output(window)
+
+#%% Sites with one pool
+def iter_indices_sites(data, target_fs, filter_type, filter_cut, filter_order, n_jobs=1,
+                       path_cache=None, cache_size=None, path_checkpoint=None, batch_size=16,
+                       indices=None, window=None, chunk_size=100):
+    """ Compute acoustic indices of all sites with one pool of processes, yielding the
+    results of each site as soon as its last file completes
+
+    The files of all sites are a single queue of tasks, so workers do not wait for the
+    slowest file of a site, and deployments with many small sites do not start a pool
+    per site. If path_checkpoint is given, each site has its own checkpoint in a sub
+    directory named after the site, see compute_indices_resumable.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata, with column sensor_name.
+    path_checkpoint : str, optional
+        Directory where checkpoints are saved, by default results are not saved.
+    chunk_size : int, optional
+        Number of results of a site written at once to its checkpoint, by default 100
+    Other parameters are the same as compute_indices_resumable.
+
+    Yields
+    ------
+    tuple
+        Sensor name and acoustic indices of its files, with column fname.
+    """
+    df = input_validation(data)
+    sites, groups, func = dict(), [], None
+    for site, df_site in df.groupby('sensor_name'):
+        path = None
+        if path_checkpoint is not None:
+            path = checkpoint_path(os.path.join(path_checkpoint, str(site)), target_fs,
+                                   filter_type, filter_cut, filter_order, indices, window)
+        results = _IndexResults(df_site, path, chunk_size)
+        func, tasks = _index_tasks(
+            results.files, target_fs, filter_type, filter_cut, filter_order, path_cache,
+            cache_size, batch_size, indices, window)
+        sites[site] = (results, tasks)
+        groups.append((site, tasks))
+    n_files = sum(len(results.files) for results, _ in sites.values())
+    print(f'Computing acoustic indices for {n_files} files of {len(sites)} sites, '
+          f'{len(df) - n_files} files found in checkpoints')
+
+    try:
+        for site, position, result, last in bounded_map_groups(func, groups, n_jobs):
+            results, tasks = sites[site]
+            if position is not None:
+                results.add(_index_frame(tasks[position][0], result, window))
+            if last:
+                del sites[site]
+                yield site, results.output(window)
+    finally:
+        # Save the results of sites not completed when the run is interrupted
+        for results, _ in sites.values():
+            results.flush()
+
+#%% Columnar store
+INDICES_STORE_MANIFEST = '_manifest.json'
+
+def compute_indices_store(data, path_store, target_fs, filter_type, filter_cut, filter_order,
+                          n_jobs=1, path_cache=None, cache_size=None, batch_size=16,
+                          indices=None):
+    """ Compute acoustic indices writing results to a columnar store as they complete
+
+    Files are sorted by sensor name and date, and each column of the store is a numpy
+    .npy file with one row per file allocated before the computation starts. Results of
+    each batch are written to their rows when the batch completes, so the store is
+    sorted regardless of the completion order and memory use does not grow with the
+    number of files. A status column marks files already computed, so interrupted runs
+    are resumed when computing again into the same store with the same configuration.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata. Rows without sensor name or date are
+        skipped.
+    path_store : str
+        Directory of the store.
+    target_fs, filter_type, filter_cut, filter_order
+        Preprocessing parameters, see compute_acoustic_indices_single_file.
+    n_jobs : int, optional
+        Number of processes, -1 uses all processors, by default 1
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+    batch_size : int, optional
+        Number of files per task, by default 16
+    indices : dict, optional
+        Names of the indices to compute and their parameters, by default all registered
+        indices with default parameters.
+
+    Returns
+    -------
+    int
+        Number of files with acoustic indices in the store.
+    """
+    df = _store_rows(input_validation(data))
+    config_id = _config_id(target_fs, filter_type, filter_cut, filter_order, indices)
+
+    # Reuse the store if it holds the same files and configuration
+    columns = _open_indices_store(path_store, df, config_id, indices)
+    pending = np.flatnonzero(columns['status'] == 0)
+    print(f'Computing acoustic indices for {len(pending)} files, '
+          f'{len(df) - len(pending)} files found in store')
+
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    files = df['path_audio'].values[pending].tolist()
+    batches = iter_indices(files, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                           path_cache, cache_size, batch_size, indices=indices)
+    try:
+        for start, records, valid in batches:
+            _write_store_rows(columns, pending[start:start + len(records)], records, valid)
+    finally:
+        for column in columns.values():
+            column.flush()
+    return int((columns['status'] == 1).sum())
+
+def iter_indices_store_sites(data, path_save, target_fs, filter_type, filter_cut, filter_order,
+                             n_jobs=1, path_cache=None, cache_size=None, batch_size=16,
+                             indices=None, suffix='_indices'):
+    """ Compute acoustic indices of all sites with one pool of processes, writing a
+    columnar store per site, see compute_indices_store
+
+    The files of all sites are a single queue of tasks, and the store of a site is
+    closed as soon as its last file completes.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata. Rows without sensor name or date are
+        skipped.
+    path_save : str
+        Directory of the stores, named after the site and suffix.
+    suffix : str, optional
+        Suffix of the name of stores, by default '_indices'
+    Other parameters are the same as compute_indices_store.
+
+    Yields
+    ------
+    tuple
+        Sensor name, directory of its store and number of files with acoustic indices.
+    """
+    df = _store_rows(input_validation(data))
+    config_id = _config_id(target_fs, filter_type, filter_cut, filter_order, indices)
+    args = (target_fs, filter_type, filter_cut, filter_order, True, path_cache, cache_size,
+            select_indices(indices))
+    sites, groups = dict(), []
+    for site, df_site in df.groupby('sensor_name', sort=False):
+        path_store = os.path.join(path_save, f'{site}{suffix}')
+        columns = _open_indices_store(path_store, df_site, config_id, indices)
+        pending = np.flatnonzero(columns['status'] == 0)
+        # Stores are opened again when their files complete, to keep few files open
+        for column in columns.values():
+            column.flush()
+        del columns
+        files = df_site['path_audio'].values[pending].tolist()
+        starts = range(0, len(files), batch_size)
+        sites[site] = (path_store, pending, starts)
+        groups.append((site, [(files[start:start + batch_size], *args) for start in starts]))
+    n_files = sum(len(pending) for _, pending, _ in sites.values())
+    print(f'Computing acoustic indices for {n_files} files of {len(sites)} sites, '
+          f'{len(df) - n_files} files found in stores')
+
+    opened = dict()
+    try:
+        for site, position, result, last in bounded_map_groups(
+                compute_indices_batch, groups, n_jobs):
+            path_store, pending, starts = sites[site]
+            if site not in opened:
+                opened[site] = _store_columns(path_store)
+            if position is not None:
+                records, valid = result
+                start = starts[position]
+                _write_store_rows(
+                    opened[site], pending[start:start + len(records)], records, valid)
+            if last:
+                del sites[site]
+                columns = opened.pop(site)
+                for column in columns.values():
+                    column.flush()
+                yield site, path_store, int((columns['status'] == 1).sum())
+    finally:
+        for columns in opened.values():
+            for column in columns.values():
+                column.flush()
+
+def _store_rows(df):
+    """ Rows of a columnar store, with sensor name and date, sorted by site and date """
+    df = df.assign(date=pd.to_datetime(df['date']))
+    idx_valid = df['sensor_name'].notna() & df['date'].notna()
+    if (~idx_valid).sum() > 0:
+        print(f'Skipping {(~idx_valid).sum()} files without sensor name or date')
+    df = df.loc[idx_valid].sort_values(['sensor_name', 'date'], kind='stable')
+    df['sensor_name'] = df['sensor_name'].astype(str)
+    return df
+
+def _write_store_rows(columns, rows, records, valid):
+    """ Write the acoustic indices of a batch to rows of a store """
+    for name in records.dtype.names:
+        columns[name][rows[valid]] = records[name][valid]
+    # Status is written last, so rows are complete when marked as done
+    columns['status'][rows] = np.where(valid, 1, -1)
+
+def _store_columns(path_store, manifest=None):
+    """ Status and acoustic indices columns of an existing store, opened for writing """
+    if manifest is None:
+        with open(os.path.join(path_store, INDICES_STORE_MANIFEST)) as f:
+            manifest = json.load(f)
+    return {name: np.load(os.path.join(path_store, f'{name}.npy'), mmap_mode='r+')
+            for name in ['status'] + manifest['indices']}
+
+def _open_indices_store(path_store, df, config_id, indices=None):
+    """ Open the columns of a store for writing, creating them if needed """
+    fname_manifest = os.path.join(path_store, INDICES_STORE_MANIFEST)
+    if os.path.isfile(fname_manifest):
+        with open(fname_manifest) as f:
+            manifest = json.load(f)
+        path_audio = np.load(os.path.join(path_store, 'path_audio.npy'), mmap_mode='r')
+        if (manifest['config_id'] == config_id and len(path_audio) == len(df)
+                and (path_audio == df['path_audio'].values.astype(str)).all()):
+            return _store_columns(path_store, manifest)
+        print(f'Store at {path_store} has other files or configuration, it will be replaced')
+        os.remove(fname_manifest)
+
+    os.makedirs(path_store, exist_ok=True)
+    columns = {
+        'path_audio': df['path_audio'].values.astype(str),
+        'fname': df['path_audio'].apply(os.path.basename).values.astype(str),
+        'sensor_name': df['sensor_name'].values.astype(str),
+        'date': df['date'].values.astype('datetime64[ns]')}
+    for name, values in columns.items():
+        np.save(os.path.join(path_store, f'{name}.npy'), values)
+
+    dtype = indices_dtype(indices)
+    writable = {'status': np.lib.format.open_memmap(
+        os.path.join(path_store, 'status.npy'), mode='w+', dtype='i1', shape=(len(df),))}
+    for name in dtype.names:
+        writable[name] = np.lib.format.open_memmap(
+            os.path.join(path_store, f'{name}.npy'), mode='w+', dtype=dtype[name],
+            shape=(len(df),))
+
+    # Rows of each site, sorted by date
+    sensor_name = columns['sensor_name']
+    sites, start = np.unique(sensor_name, return_index=True)
+    stop = np.append(start[1:], len(sensor_name))
+    manifest = {
+        'config_id': config_id,
+        'n_rows': len(df),
+        'indices': list(dtype.names),
+        'sites': {site: [int(i0), int(i1)] for site, i0, i1 in zip(sites, start, stop)}}
+    # The manifest is written last, a store without manifest is incomplete
+    with open(fname_manifest, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return writable
+
+def read_indices_store(path_store, sensor_name=None, date_range=None, columns=None):
+    """ Load acoustic indices from a columnar store built with compute_indices_store
+
+    Only the rows of the selected sites and dates are read from disk.
+
+    Parameters
+    ----------
+    path_store : str
+        Directory of the store.
+    sensor_name : list, optional
+        Sensor names to load, by default all sensors.
+    date_range : list, optional
+        Start and end dates as timestamps or strings. The start date is inclusive and
+        the end date exclusive. By default all dates are loaded.
+    columns : list, optional
+        Columns to load, by default fname, sensor_name, date and all indices.
+
+    Returns
+    -------
+    pandas DataFrame
+        Acoustic indices of files computed without errors, sorted by sensor name and date.
+    """
+    with open(os.path.join(path_store, INDICES_STORE_MANIFEST)) as f:
+        manifest = json.load(f)
+    if columns is None:
+        columns = ['fname', 'sensor_name', 'date'] + manifest['indices']
+    arrays = {name: np.load(os.path.join(path_store, f'{name}.npy'), mmap_mode='r')
+              for name in set(columns) | {'status', 'date'}}
+
+    sites = manifest['sites']
+    if sensor_name is not None:
+        sites = {site: sites[site] for site in map(str, sensor_name) if site in sites}
+
+    # Rows of each site are sorted by date, slice the date range
+    slices = []
+    for start, stop in sites.values():
+        if date_range is not None:
+            dates = arrays['date'][start:stop]
+            start, stop = start + np.searchsorted(
+                dates, [np.datetime64(pd.to_datetime(d)) for d in date_range], side='left')
+        slices.append(slice(start, stop))
+
+    def gather(name):
+        if len(slices) == 0:
+            return arrays[name][:0]
+        return np.concatenate([arrays[name][sl] for sl in slices])
+
+    done = gather('status') == 1
+    return pd.DataFrame({name: gather(name)[done] for name in columns})
+
+def compute_indices(data, target_fs, filter_type, filter_cut, filter_order, n_jobs,
+                    path_cache=None, cache_size=None, path_checkpoint=None, batch_size=16,
+                    indices=None, window=None):
+    if path_checkpoint is not None:
+        df_out = compute_indices_resumable(
+            data, target_fs, filter_type, filter_cut, filter_order, n_jobs, path_checkpoint,
+            path_cache=path_cache, cache_size=cache_size, batch_size=batch_size,
+            indices=indices, window=window)
+    elif window is not None:
+        df_out = compute_indices_stream(
+            data, window, target_fs, filter_type, filter_cut, filter_order, n_jobs, indices)
+    elif n_jobs == 1:
+        df_out = compute_indices_sequential(
+            data, target_fs, filter_type, filter_cut, filter_order, path_cache, cache_size,
+            indices)
     else:
         df_out = compute_indices_parallel(
-            data, target_fs, filter_type, filter_cut, filter_order, n_jobs)
+            data, target_fs, filter_type, filter_cut, filter_order, n_jobs, path_cache, cache_size,
+            batch_size, indices)
     return df_out
+
+#%% Multi-node runs
+def merge_indices_shards(data, fname, n_shards):
+    """ Combine acoustic indices computed by shards into the output of a single node run
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata of the whole run, used to order results as a single node run.
+    fname : str
+        Output path of the single node run, shard outputs are named with shard_fname.
+    n_shards : int
+        Number of shards of the run.
+
+    Returns
+    -------
+    pandas DataFrame
+        Acoustic indices of all shards, ordered as the files in data.
+    """
+    df = input_validation(data)
+    dfs = read_shards(fname, n_shards, float_precision='round_trip')
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    df_out = pd.concat(dfs, ignore_index=True)
+
+    # Stable sort keeps the order of windows within each file
+    fnames = df.path_audio.apply(os.path.basename)
+    order = pd.Series(np.arange(len(df)), index=fnames.values)
+    order = order[~order.index.duplicated()]
+    idx = np.argsort(df_out['fname'].map(order).values, kind='stable')
+    return df_out.iloc[idx].reset_index(drop=True)
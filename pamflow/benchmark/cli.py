@@ -0,0 +1,83 @@
+""" Utility functions to use CLI for benchmarks on synthetic deployments
+
+Generate a deployment once, then run the scenarios before and after a change:
+
+    python -m pamflow.benchmark.cli generate -o ./benchmark_data
+    python -m pamflow.benchmark.cli run -i ./benchmark_data -o baseline.json
+    python -m pamflow.benchmark.cli run -i ./benchmark_data -o results.json --baseline baseline.json
+
+Compare the peak detector of graphical soundscapes with the one of scikit-maad:
+
+    python -m pamflow.benchmark.cli peaks -i ./benchmark_data
+
+"""
+import sys
+import json
+import argparse
+import pandas as pd
+from pamflow.preprocess.utils import load_config
+from pamflow.benchmark.utils import (
+    SCENARIOS, generate_deployment, run_benchmark, compare_baseline, print_benchmark,
+    benchmark_peak_detectors)
+
+#%%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark pamflow operations on synthetic deployments")
+    parser.add_argument(
+        "operation",
+        choices=["generate", "run", "peaks"],
+        help="Benchmark operation")
+    parser.add_argument("--input", "-i", type=str,
+                    help="Directory of a synthetic deployment to run the benchmark")
+    parser.add_argument("--output", "-o", type=str,
+                    help="Directory to write the synthetic deployment, or json file to save "
+                         "benchmark results")
+    parser.add_argument("--config", "-c", type=str, default='config.yaml',
+                    help="Path to config file. "
+                         "The config file should contain all additional settings for your script.")
+    parser.add_argument("--scenarios", nargs="+", default=None, choices=list(SCENARIOS),
+                    help="Scenarios to run (default: all)")
+    parser.add_argument("--baseline", "-b", type=str, default=None,
+                    help="Json file with results of a previous run to compare against. "
+                         "Exit with an error if a scenario is slower than the tolerance.")
+    args = parser.parse_args()
+
+    # Load configuration
+    config = load_config(args.config)
+    n_sensors = config["benchmark"]["n_sensors"]
+    n_days = config["benchmark"]["n_days"]
+    duty_cycle = config["benchmark"]["duty_cycle"]
+    file_length = config["benchmark"]["file_length"]
+    sample_rate = config["benchmark"]["sample_rate"]
+    start_date = config["benchmark"]["start_date"]
+    seed = config["benchmark"]["seed"]
+    repeat = config["benchmark"]["repeat"]
+    tolerance = config["benchmark"]["tolerance"]
+
+    if args.operation == "generate":
+        generate_deployment(args.output, n_sensors, n_days, duty_cycle, file_length,
+                            sample_rate, start_date, seed)
+
+    elif args.operation == "run":
+        results = run_benchmark(args.input, config, args.scenarios, repeat)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f'Results are stored at {args.output}')
+
+        if args.baseline is None:
+            print_benchmark(pd.DataFrame(results['scenarios']).T)
+        else:
+            df = compare_baseline(results, args.baseline, tolerance)
+            print_benchmark(df)
+            if (df['status'] == 'slower').any():
+                print(f'Scenarios slower than baseline: {df.index[df.status == "slower"].to_list()}')
+                sys.exit(1)
+
+    elif args.operation == "peaks":
+        results = benchmark_peak_detectors(args.input, config, repeat)
+        print(pd.Series(results).to_string(float_format=lambda x: f'{x:.3f}'))
+        if results['mismatch_files'] > 0:
+            print('Peaks of pamflow differ from maad')
+            sys.exit(1)
@@ -0,0 +1,489 @@
+""" Reproducible benchmarks on synthetic passive acoustic monitoring deployments
+
+A synthetic deployment has a set of sensors recording files of fixed length at a
+regular period over several days. Each file mixes background noise with tones and
+chirps whose number follows a daily cycle, so that acoustic indices and graphical
+soundscapes change along the day as in real recordings. Files are named with the
+standard SITENAME_YYYYMMDD_HHMMSS.WAV format, and a metadata csv and BirdNET-style
+detection files are written with them. Deployments are fully determined by their
+parameters and the random seed.
+
+Scenarios run the main operations of pamflow on a deployment and report throughput
+and peak memory. Each scenario runs in a fresh process, so that the peak memory of a
+scenario is not inflated by previous ones. Results can be saved as json and compared
+against a baseline from a previous run.
+
+"""
+import os
+import sys
+import json
+import wave
+import time
+import shutil
+import platform
+import tempfile
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from scipy import signal
+from pamflow.profiling import peak_rss
+from pamflow.preprocess.utils import (
+    METADATA_COLUMNS, input_validation, get_audio_metadata, audio_timelapse)
+from pamflow.acoustic_indices.utils import (
+    compute_indices, compute_indices_store, iter_indices_sites, iter_indices_store_sites)
+from pamflow.graphical_soundscape.utils import (
+    graphical_soundscape, iter_graphical_soundscape_sites)
+from pamflow.graphical_soundscape.peaks import local_max
+from pamflow.preprocess.spectrogram import get_spectrogram
+from pamflow.classification.utils import merge_annot_files
+
+SPECIES = [
+    ('Turdus ignobilis', 'Black-billed Thrush'),
+    ('Pitangus sulphuratus', 'Great Kiskadee'),
+    ('Zonotrichia capensis', 'Rufous-collared Sparrow'),
+    ('Leptotila verreauxi', 'White-tipped Dove'),
+    ('Crypturellus soui', 'Little Tinamou'),
+    ('Boana boans', 'Rusty Tree Frog')]
+DETECTION_COLUMNS = ['Start (s)', 'End (s)', 'Scientific name', 'Common name', 'Confidence']
+
+#%%
+def synthetic_signal(length, fs, hour=12, rng=None):
+    """ Synthetic soundscape with noise, tones and chirps
+
+    The number of tones and chirps peaks at dawn and dusk.
+
+    Parameters
+    ----------
+    length : float
+        Length of the signal in seconds.
+    fs : int
+        Sampling rate of the signal.
+    hour : float, optional
+        Hour of the day of the recording, by default 12
+    rng : numpy Generator, optional
+        Random generator, by default a new generator without seed
+
+    Returns
+    -------
+    1d numpy array
+        Signal with values between -1 and 1.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n = int(length * fs)
+    t = np.arange(n) / fs
+    fmax = 0.45 * fs
+    activity = 1 + 4 * (np.exp(-(hour - 6)**2 / 2) + np.exp(-(hour - 18)**2 / 2))
+    s = 0.01 * rng.standard_normal(n)
+
+    # Stationary tones, as insects
+    for _ in range(rng.poisson(activity)):
+        f0 = rng.uniform(1000, fmax)
+        s += rng.uniform(0.005, 0.05) * np.sin(2 * np.pi * f0 * t)
+
+    # Short chirps, as bird and frog calls
+    for _ in range(rng.poisson(4 * activity)):
+        dur = rng.uniform(0.05, min(0.5, length))
+        start = rng.integers(0, max(n - int(dur * fs), 1))
+        tc = np.arange(int(dur * fs)) / fs
+        f0, f1 = rng.uniform(500, fmax, size=2)
+        call = signal.chirp(tc, f0, dur, f1) * signal.windows.hann(len(tc))
+        s[start:start + len(tc)] += rng.uniform(0.05, 0.5) * call[:n - start]
+    return s / max(np.abs(s).max(), 1)
+
+def write_wav(fname, s, fs):
+    """ Write a signal as 16 bits mono WAVE file """
+    with wave.open(fname, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(fs)
+        f.writeframes((np.clip(s, -1, 1) * 32767).astype('<i2').tobytes())
+
+def synthetic_detections(length, rng, segment=3):
+    """ BirdNET-style detections of a file, on consecutive segments of a few seconds """
+    n_segments = max(int(length // segment), 1)
+    n = min(rng.poisson(2), n_segments)
+    start = np.sort(rng.choice(n_segments, n, replace=False)) * segment
+    species = rng.integers(0, len(SPECIES), n)
+    return pd.DataFrame({
+        'Start (s)': start.astype(float),
+        'End (s)': (start + segment).astype(float),
+        'Scientific name': [SPECIES[i][0] for i in species],
+        'Common name': [SPECIES[i][1] for i in species],
+        'Confidence': rng.uniform(0.1, 1, n).round(4)}, columns=DETECTION_COLUMNS)
+
+def generate_deployment(path_save, n_sensors=4, n_days=2, duty_cycle='60T', file_length=10,
+                        sample_rate=48000, start_date='2024-03-05', seed=0, verbose=True):
+    """ Write a synthetic deployment with its metadata and detection files
+
+    Audio files are written to path_save/audio/<sensor>/, BirdNET-style detections
+    to path_save/detections/<sensor>/ and the metadata to path_save/metadata.csv.
+
+    Parameters
+    ----------
+    path_save : str
+        Directory to write the deployment.
+    n_sensors : int, optional
+        Number of sensors, by default 4
+    n_days : int, optional
+        Number of days of recordings, by default 2
+    duty_cycle : str, optional
+        Period between the start of consecutive recordings, as a pandas offset alias,
+        by default '60T'
+    file_length : float, optional
+        Length of each file in seconds, by default 10
+    sample_rate : int, optional
+        Sampling rate of the files, by default 48000
+    start_date : str, optional
+        Date of the first recording formated as 'YYYY-MM-DD', by default '2024-03-05'
+    seed : int, optional
+        Random seed, by default 0
+    verbose : bool, optional
+        Print progress messages, by default True
+
+    Returns
+    -------
+    pandas DataFrame
+        Metadata of the deployment, with the columns of get_audio_metadata.
+    """
+    dates = pd.date_range(start_date, periods=n_days, freq='D')
+    dates = pd.date_range(dates[0], dates[-1] + pd.Timedelta(days=1), freq=duty_cycle,
+                          inclusive='left')
+    records = []
+    for sensor_idx in range(n_sensors):
+        sensor_name = f'S{sensor_idx + 1:03d}'
+        path_audio = os.path.join(path_save, 'audio', sensor_name)
+        path_detections = os.path.join(path_save, 'detections', sensor_name)
+        os.makedirs(path_audio, exist_ok=True)
+        os.makedirs(path_detections, exist_ok=True)
+        for file_idx, date in enumerate(dates):
+            if verbose:
+                print(f'{sensor_name}: {file_idx + 1} / {len(dates)}', end='\r')
+            # One generator per file, so that files do not depend on the deployment size
+            rng = np.random.default_rng([seed, sensor_idx, file_idx])
+            fname = f'{sensor_name}_{date:%Y%m%d_%H%M%S}.WAV'
+            s = synthetic_signal(file_length, sample_rate, date.hour + date.minute / 60, rng)
+            fname_audio = os.path.join(path_audio, fname).replace('\\', '/')
+            write_wav(fname_audio, s, sample_rate)
+            synthetic_detections(file_length, rng).to_csv(
+                os.path.join(path_detections, fname.replace('.WAV', '.BirdNET.results.csv')),
+                index=False)
+            records.append({
+                'path_audio': fname_audio,
+                'fname': fname,
+                'sample_rate': sample_rate,
+                'channels': 1,
+                'bits': 16,
+                'samples': len(s),
+                'length': len(s) / sample_rate,
+                'fsize': os.path.getsize(fname_audio),
+                'sensor_name': sensor_name,
+                'date': date,
+                'time': f'{date:%H%M%S}'})
+
+    df = pd.DataFrame.from_records(records, columns=METADATA_COLUMNS)
+    df.to_csv(os.path.join(path_save, 'metadata.csv'), index=False)
+    if verbose:
+        print(f'\n{len(df)} files written to {path_save}')
+    return df
+
+#%%
+# -------------------------
+# Scenarios
+# -------------------------
+def _scenario_metadata(path_data, config, path_tmp):
+    """ Read headers of all files with an empty metadata index """
+    df = get_audio_metadata(os.path.join(path_data, 'audio'),
+                            path_index=os.path.join(path_tmp, 'index.csv'))
+    return len(df), df['length'].sum()
+
+def _scenario_indices(path_data, config, path_tmp):
+    """ Acoustic indices as computed and saved by the indices CLI, with the output format of
+    the configuration and without cache nor checkpoints. Sites share one pool of processes
+    when grouping by site """
+    df = input_validation(os.path.join(path_data, 'metadata.csv'))
+    cfg = config['acoustic_indices']
+    args = (cfg['target_fs'], cfg['filter_type'], cfg['filter_cut'], cfg['filter_order'],
+            cfg['n_jobs'])
+    batch_size, indices = cfg.get('batch_size', 16), cfg.get('indices')
+    output_format = cfg.get('output_format', 'csv')
+    if output_format == 'store' and cfg['group_by_site']:
+        for _ in iter_indices_store_sites(df, path_tmp, *args, batch_size=batch_size,
+                                          indices=indices):
+            pass
+    elif output_format == 'store':
+        compute_indices_store(df, os.path.join(path_tmp, 'indices'), *args,
+                              batch_size=batch_size, indices=indices)
+    elif cfg['group_by_site']:
+        for site, df_out in iter_indices_sites(df, *args, batch_size=batch_size,
+                                               indices=indices, window=cfg.get('window')):
+            df_out.to_csv(os.path.join(path_tmp, f'{site}_indices.csv'), index=False)
+    else:
+        compute_indices(df, *args, batch_size=batch_size, indices=indices,
+                        window=cfg.get('window')).to_csv(
+            os.path.join(path_tmp, 'indices.csv'), index=False)
+    return len(df), df['length'].sum()
+
+def _scenario_graph(path_data, config, path_tmp):
+    """ Graphical soundscapes as computed and saved by the graphical soundscape CLI, without
+    cache nor peak store. Sites share one pool of processes when grouping by site """
+    df = input_validation(os.path.join(path_data, 'metadata.csv'))
+    df['date'] = pd.to_datetime(df.date)
+    df['time'] = df.date.dt.hour
+    cfg = config['graph_soundscapes']
+    args = (cfg['threshold_abs'], 'path_audio', 'time', cfg['target_fs'], cfg['nperseg'],
+            cfg['noverlap'], cfg['db_range'], cfg['min_distance'], cfg['n_jobs'])
+    batch_size = cfg.get('batch_size', 16)
+    if cfg['group_by_site']:
+        for site, df_out in iter_graphical_soundscape_sites(df, *args, None, None, batch_size):
+            df_out.to_csv(os.path.join(path_tmp, f'{site}_graph.csv'))
+    else:
+        graphical_soundscape(df, *args, batch_size=batch_size).to_csv(
+            os.path.join(path_tmp, 'graph.csv'), index=False)
+    return len(df), df['length'].sum()
+
+def _scenario_timelapse(path_data, config, path_tmp):
+    """ Audio timelapse of each sensor over the whole deployment """
+    df = input_validation(os.path.join(path_data, 'metadata.csv'))
+    dates = pd.to_datetime(df.date)
+    date_range = [f'{dates.min():%Y-%m-%d}', f'{dates.max() + pd.Timedelta(days=1):%Y-%m-%d}']
+    cfg = config['preprocessing']
+    audio_timelapse(df, cfg['sample_length'], cfg['sample_period'], date_range,
+                    path_save=path_tmp, verbose=False, n_jobs=cfg['n_jobs'])
+    flist = [os.path.join(path_tmp, fname) for fname in os.listdir(path_tmp)]
+    n_samples = sum(os.path.getsize(fname) - 44 for fname in flist) / 2
+    fs = df['sample_rate'].iloc[0]
+    return int(round(n_samples / fs / cfg['sample_length'])), n_samples / fs
+
+def _scenario_annotations(path_data, config, path_tmp):
+    """ Merge of BirdNET detection files """
+    flist = []
+    for root, _, files in os.walk(os.path.join(path_data, 'detections')):
+        flist += [os.path.join(root, fname) for fname in files if fname.endswith('.csv')]
+    merge_annot_files(flist, rtype='csv')
+    df = input_validation(os.path.join(path_data, 'metadata.csv'))
+    return len(flist), df['length'].sum()
+
+SCENARIOS = {
+    'metadata': _scenario_metadata,
+    'indices': _scenario_indices,
+    'graph': _scenario_graph,
+    'timelapse': _scenario_timelapse,
+    'annotations': _scenario_annotations,
+}
+
+def _run_isolated(name, path_data, config):
+    """ Run a scenario and measure it, in the process of a single worker pool """
+    path_tmp = tempfile.mkdtemp(prefix=f'pamflow_benchmark_{name}_')
+    try:
+        start = time.perf_counter()
+        n_files, audio_seconds = SCENARIOS[name](path_data, config, path_tmp)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(path_tmp, ignore_errors=True)
+    rss = [peak_rss(), peak_rss(children=True)]
+    rss = [x for x in rss if x is not None]
+    return n_files, audio_seconds, elapsed, max(rss) if rss else None
+
+def run_scenario(name, path_data, config, repeat=1):
+    """ Time a scenario on a synthetic deployment
+
+    Parameters
+    ----------
+    name : str
+        Name of the scenario, one of SCENARIOS.
+    path_data : str
+        Directory of a deployment written by generate_deployment.
+    config : dict
+        Configuration with the sections of config.yaml used by the scenario.
+    repeat : int, optional
+        Number of runs, the fastest one is reported, by default 1
+
+    Returns
+    -------
+    dict
+        Number of files, hours of audio, elapsed seconds, throughput and peak memory of
+        the processes of the scenario in MB.
+    """
+    if name not in SCENARIOS:
+        raise ValueError(f'Unknown scenario {name}, options are {list(SCENARIOS)}')
+    runs = []
+    for _ in range(repeat):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            runs.append(executor.submit(_run_isolated, name, path_data, config).result())
+    n_files, audio_seconds, elapsed, _ = min(runs, key=lambda run: run[2])
+    rss = [run[3] for run in runs if run[3] is not None]
+    audio_hours = audio_seconds / 3600
+    return {
+        'files': int(n_files),
+        'audio_hours': float(audio_hours),
+        'seconds': elapsed,
+        'files_per_second': n_files / elapsed,
+        'audio_hours_per_second': audio_hours / elapsed,
+        'peak_rss_mb': max(rss) if rss else None}
+
+def run_benchmark(path_data, config, scenarios=None, repeat=1, verbose=True):
+    """ Run benchmark scenarios on a synthetic deployment
+
+    Parameters
+    ----------
+    path_data : str
+        Directory of a deployment written by generate_deployment.
+    config : dict
+        Configuration with the sections of config.yaml used by the scenarios.
+    scenarios : list of str, optional
+        Scenarios to run, by default all scenarios
+    repeat : int, optional
+        Number of runs of each scenario, by default 1
+    verbose : bool, optional
+        Print progress messages, by default True
+
+    Returns
+    -------
+    dict
+        Results per scenario and description of the environment.
+    """
+    scenarios = list(SCENARIOS) if scenarios is None else scenarios
+    results = dict()
+    for name in scenarios:
+        if verbose:
+            print(f'Running scenario {name}...')
+        results[name] = run_scenario(name, path_data, config, repeat)
+    return {'environment': environment_info(), 'scenarios': results}
+
+def environment_info():
+    """ Versions and hardware, to judge whether two benchmark results are comparable """
+    import scipy
+    import maad
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'pandas': pd.__version__,
+        'maad': getattr(maad, '__version__', None)}
+
+#%%
+def benchmark_peak_detectors(path_data, config, repeat=1, verbose=True):
+    """ Compare the peak detector of pamflow with maad.rois.spectrogram_local_max
+
+    Spectrograms of all files of the deployment are computed once with the settings of
+    the graph_soundscapes section, then peaks are detected with both implementations,
+    file by file and for pamflow also on the stack of spectrograms.
+
+    Parameters
+    ----------
+    path_data : str
+        Directory of a deployment written by generate_deployment.
+    config : dict
+        Configuration with the graph_soundscapes section of config.yaml.
+    repeat : int, optional
+        Number of runs of each detector, the fastest one is reported, by default 1
+    verbose : bool, optional
+        Print progress messages, by default True
+
+    Returns
+    -------
+    dict
+        Elapsed seconds of each detector, speed-up against maad, and number of files
+        where the peaks differ from maad, which should be 0.
+    """
+    from maad import util
+    from maad.rois import spectrogram_local_max
+    cfg = config['graph_soundscapes']
+    df = input_validation(os.path.join(path_data, 'metadata.csv'))
+    spectrograms = []
+    for path_audio in df['path_audio']:
+        Sxx, tn, fn, ext, _ = get_spectrogram(
+            path_audio, cfg['target_fs'], nperseg=cfg['nperseg'], noverlap=cfg['noverlap'],
+            mode='psd', outputs=('spectrogram',))
+        spectrograms.append((util.power2dB(Sxx, db_range=cfg['db_range']), tn, fn, ext))
+    min_distance, threshold_abs = cfg['min_distance'], cfg['threshold_abs']
+
+    def run_maad():
+        return [spectrogram_local_max(Sxx_db, tn, fn, ext, min_distance, threshold_abs)
+                for Sxx_db, tn, fn, ext in spectrograms]
+
+    def run_pamflow():
+        return [local_max(Sxx_db, min_distance, threshold_abs)
+                for Sxx_db, _, _, _ in spectrograms]
+
+    def run_pamflow_stack():
+        return local_max(stack, min_distance, threshold_abs)
+
+    def timeit(func):
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            elapsed.append(time.perf_counter() - start)
+        return min(elapsed), result
+
+    if verbose:
+        print(f'Detecting peaks on {len(spectrograms)} spectrograms...')
+    seconds_maad, peaks_maad = timeit(run_maad)
+    seconds_pamflow, peaks_pamflow = timeit(run_pamflow)
+    mismatch = sum(
+        not (np.array_equal(tn[peaks[:, 1]], peak_time) and np.array_equal(fn[peaks[:, 0]], peak_freq))
+        for (_, tn, fn, _), peaks, (peak_time, peak_freq)
+        in zip(spectrograms, peaks_pamflow, peaks_maad))
+    results = {
+        'files': len(spectrograms),
+        'seconds_maad': seconds_maad,
+        'seconds_pamflow': seconds_pamflow,
+        'speedup': seconds_maad / seconds_pamflow,
+        'mismatch_files': mismatch}
+
+    # Stacks need spectrograms of equal shape
+    if len({Sxx_db.shape for Sxx_db, _, _, _ in spectrograms}) == 1:
+        stack = np.stack([Sxx_db for Sxx_db, _, _, _ in spectrograms])
+        seconds_stack, peaks_stack = timeit(run_pamflow_stack)
+        results['seconds_pamflow_stack'] = seconds_stack
+        results['speedup_stack'] = seconds_maad / seconds_stack
+        results['mismatch_files'] += sum(
+            not np.array_equal(peaks_stack[peaks_stack[:, 0] == idx, 1:], peaks)
+            for idx, peaks in enumerate(peaks_pamflow))
+    return results
+
+#%%
+def compare_baseline(results, baseline, tolerance=0.1):
+    """ Compare benchmark results against a baseline
+
+    Parameters
+    ----------
+    results : dict
+        Results of run_benchmark.
+    baseline : dict or str
+        Results of a previous run, or path to them saved as json.
+    tolerance : float, optional
+        Relative change in elapsed time considered as noise, by default 0.1
+
+    Returns
+    -------
+    pandas DataFrame
+        Elapsed time, throughput and peak memory per scenario, with the ratio of elapsed
+        time against the baseline and a status of 'slower', 'faster', 'ok' or 'new'.
+    """
+    if isinstance(baseline, str):
+        with open(baseline) as f:
+            baseline = json.load(f)
+    df = pd.DataFrame(results['scenarios']).T
+    df_base = pd.DataFrame(baseline['scenarios']).T
+    df = df.join(df_base[['seconds', 'peak_rss_mb']].add_prefix('baseline_'))
+    df['ratio'] = df['seconds'].astype(float) / df['baseline_seconds'].astype(float)
+    df['status'] = np.select(
+        [df['ratio'].isna(), df['ratio'] > 1 + tolerance, df['ratio'] < 1 - tolerance],
+        ['new', 'slower', 'faster'], 'ok')
+    if baseline.get('environment') != results.get('environment'):
+        print('Warning: baseline was run on a different environment, '
+              'results may not be comparable', file=sys.stderr)
+    return df
+
+def print_benchmark(df):
+    """ Print a table of benchmark results """
+    df = df.copy()
+    for col in df.columns:
+        if col != 'status':
+            df[col] = pd.to_numeric(df[col])
+    print(df.to_string(float_format=lambda x: f'{x:.3f}'))
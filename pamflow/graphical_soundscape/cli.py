@@ -8,14 +8,20 @@ References:
   - Campos-Cerqueira, M., Aide, T.M., 2017. Changes in the acoustic structure and composition along a tropical elevational gradient. JEA 1, 1–1. https://doi.org/10.22261/JEA.PNCO7I
 """
 import os
+import sys
 import argparse
 import pandas as pd
 import glob
 import matplotlib.pyplot as plt
-from maad import sound, util
+from maad import util
 from maad.rois import spectrogram_local_max
-from maad.features import graphical_soundscape, plot_graph
-from pamflow.preprocess.utils import input_validation, load_config
+from maad.features import plot_graph
+from pamflow.preprocess.utils import (
+    select_metadata, load_config, parse_shard, select_shard, shard_fname, check_site_outputs)
+from pamflow.preprocess.spectrogram import get_spectrogram
+from pamflow.graphical_soundscape.utils import (
+    graphical_soundscape, spectral_peak_densities, merge_graph_shards,
+    sweep_graphical_soundscape, iter_graphical_soundscape_sites)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -26,6 +32,7 @@ if __name__ == "__main__":
             "spectrogram_local_max",
             "graphical_soundscape",
             "plot_graph",
+            "sweep",
         ],
         help="Graphical soundscape operation")
     
@@ -42,6 +49,14 @@ if __name__ == "__main__":
                     help="Enable to display plot")
     parser.add_argument( "--sites", "-s", nargs="+", default=None,
                     help="Specify sites to execute the operation (default: None)")
+    parser.add_argument("--date_range", nargs=2, default=None,
+                    help="Start and end dates formated as YYYY-MM-DD (default: None)")
+    parser.add_argument("--shard", type=str, default=None,
+                    help="Process only shard i of N, formated as i/N. Files are assigned to shards "
+                         "by a hash of their path, or of their site when grouping by site (default: None)")
+    parser.add_argument("--merge", type=int, default=None, metavar="N",
+                    help="Combine the outputs of N shards into the output of a single node run, "
+                         "instead of computing graphs (default: None)")
     args = parser.parse_args()
     
     # Load configuration
@@ -55,48 +70,79 @@ if __name__ == "__main__":
     threshold_abs = config["graph_soundscapes"]["threshold_abs"]
     n_jobs = config["graph_soundscapes"]["n_jobs"]
     group_by_site = config["graph_soundscapes"]["group_by_site"]
+    batch_size = config["graph_soundscapes"].get("batch_size", 16)
+    path_peaks = config["graph_soundscapes"].get("peaks_path")
+    peaks_threshold = config["graph_soundscapes"].get("peaks_threshold")
+    sweep = config["graph_soundscapes"].get("sweep") or {}
+    path_cache = config.get("cache", {}).get("path")
+    cache_size = config.get("cache", {}).get("max_size")
     select_sites = args.sites
 
     # Operations
     if args.operation == "spectrogram_local_max":
-        s, fs = sound.load(args.input)
-        s = sound.resample(s, fs, target_fs, res_type="scipy_poly")
-        Sxx, tn, fn, ext = sound.spectrogram(s, fs, nperseg=nperseg, noverlap=noverlap)
+        Sxx, tn, fn, ext, _ = get_spectrogram(
+            args.input, target_fs, nperseg=nperseg, noverlap=noverlap, mode='psd',
+            path_cache=path_cache, max_size=cache_size, outputs=('spectrogram',))
         Sxx_db = util.power2dB(Sxx, db_range=db_range)
         result = spectrogram_local_max(Sxx_db, tn, fn, ext, min_distance, 
                                        threshold_abs, display=True)
         plt.show()
 
     elif args.operation == "graphical_soundscape":
-        df = input_validation(args.input)
+        # Load metadata, if file list provided filter dataframe
+        df = select_metadata(args.input, select_sites, args.date_range)
         df['date'] = pd.to_datetime(df.date)
         df['time'] = df.date.dt.hour
+
+        # Combine outputs of shards, runs grouped by site already write the final files
+        if args.merge is not None:
+            if group_by_site:
+                missing = check_site_outputs(df, args.output, '_graph.csv')
+                sys.exit(1 if missing else 0)
+            df_out = merge_graph_shards(args.output, args.merge)
+            df_out.to_csv(args.output, index=False)
+            print(f'Done! {args.merge} shards merged at {args.output}')
+            sys.exit(0)
+
+        # Keep the files of this shard, sites are not split between shards when grouping by site
+        if args.shard is not None:
+            shard = parse_shard(args.shard)
+            df = select_shard(df, shard, by='sensor_name' if group_by_site else 'path_audio')
+            print(f'Shard {shard[0]} of {shard[1]}: {len(df)} files')
         
-        # If file list provided filter dataframe
-        if select_sites is None:
-            n_sites = df.groupby('sensor_name').ngroups
-            site_list = df.sensor_name.unique()
-        else:
-            df = df[df['sensor_name'].isin(select_sites)]
-            n_sites = df.groupby('sensor_name').ngroups
-            site_list = df.sensor_name.unique()
+        n_sites = df.groupby('sensor_name').ngroups
+        site_list = df.sensor_name.unique()
         print(f'Computing graph over {n_sites} sites: {site_list}')
 
         # Group by site
-        if group_by_site:  # saves results per site
-            for site, df_site in df.groupby('sensor_name'):
-                df_out = graphical_soundscape(
-                    df_site, threshold_abs, 'path_audio', 'time', target_fs, nperseg, 
-                    noverlap, db_range, min_distance, n_jobs)
+        if group_by_site:  # saves results per site, sites share one pool of processes
+            for site, df_out in iter_graphical_soundscape_sites(
+                    df, threshold_abs, 'path_audio', 'time', target_fs, nperseg,
+                    noverlap, db_range, min_distance, n_jobs, path_cache, cache_size, batch_size,
+                    path_peaks, peaks_threshold):
                 fname_save = os.path.join(args.output, f'{site}_graph.csv')
                 df_out.to_csv(fname_save)
                 print(f'{site} Done! Results are stored at {fname_save}')
         
+        # Save the peak density of each file, graphs are averaged when shards are merged
+        elif args.shard is not None:
+            fname_save = shard_fname(args.output, shard)
+            if len(df) == 0:  # shard without files, an empty output marks it as done
+                open(fname_save, 'w').close()
+            else:
+                spectral_peak_densities(
+                    df, threshold_abs, 'path_audio', 'time', target_fs, nperseg,
+                    noverlap, db_range, min_distance, n_jobs, path_cache, cache_size,
+                    batch_size).to_csv(fname_save)
+            print(f'Done! Results of shard {shard[0]} of {shard[1]} are saved at {fname_save}')
+            sys.exit(0)
+
         # Compute over all files
         else:
             df_out = graphical_soundscape(
                 df, threshold_abs, 'path_audio', 'time', target_fs, nperseg, 
-                noverlap, db_range, min_distance, n_jobs)
+                noverlap, db_range, min_distance, n_jobs, path_cache, cache_size, batch_size,
+                path_peaks, peaks_threshold)
             df_out.to_csv(args.output, index=False)
             print(f'Done! Results are saved at {args.output}')
         
@@ -120,3 +166,17 @@ if __name__ == "__main__":
             plt.close()
 
         print(f'Done! Results are saved at {args.output}')
+
+    elif args.operation == "sweep":
+        # Load metadata, if file list provided filter dataframe
+        df = select_metadata(args.input, select_sites, args.date_range)
+        df['date'] = pd.to_datetime(df.date)
+        df['time'] = df.date.dt.hour
+
+        # Parameters missing from the sweep take the values used to compute graphs
+        df_out = sweep_graphical_soundscape(
+            df, sweep.get('threshold_abs', threshold_abs), sweep.get('min_distance', min_distance),
+            sweep.get('nperseg', nperseg), sweep.get('db_range', db_range), 'path_audio', 'time',
+            target_fs, noverlap, n_jobs, path_cache, cache_size, batch_size)
+        df_out.to_csv(args.output, index=False)
+        print(f'Done! Results are saved at {args.output}')
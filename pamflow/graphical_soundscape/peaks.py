@@ -0,0 +1,133 @@
+""" Local maxima of spectrograms with a vectorized maximum filter
+
+local_max finds the same peaks as skimage.feature.peak_local_max, used by
+maad.rois.spectrogram_local_max, with its default arguments: a peak is a pixel equal to
+the maximum of its square neighborhood of size 2 * min_distance + 1, strictly above the
+threshold and at least min_distance pixels away from the borders. Peaks of an image
+whose pixels are all equal to their neighborhood maximum are discarded.
+
+skimage then enforces the minimum distance between peaks by querying a KD-tree for each
+peak. Two peaks closer than min_distance lie in the neighborhood of each other, so they
+have equal levels and only peaks on plateaus can be removed. Here peaks sharing a
+plateau are found with a single query of nearest neighbors, and only those go
+through the greedy selection, in the same order as skimage.
+
+Stacks of spectrograms of equal shape are processed at once, each spectrogram with its
+own borders and threshold.
+
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+#%%
+def local_max(S, min_distance=1, threshold_abs=None):
+    """ Coordinates of local maxima of a spectrogram or a stack of spectrograms
+
+    Parameters
+    ----------
+    S : 2d or 3d numpy array
+        Spectrogram as (frequencies, times), or stack of spectrograms as
+        (files, frequencies, times).
+    min_distance : int, optional
+        Minimum number of pixels separating peaks, and from peaks to the borders,
+        by default 1
+    threshold_abs : float, optional
+        Peaks must be strictly above this level, by default the minimum of each
+        spectrogram.
+
+    Returns
+    -------
+    2d numpy array of ints
+        Coordinates of the peaks as (frequency, time) for a spectrogram, or
+        (file, frequency, time) for a stack, sorted by file and by decreasing level
+        as skimage.feature.peak_local_max.
+    """
+    S = np.asarray(S)
+    if S.ndim not in (2, 3):
+        raise ValueError('S must be a spectrogram or a stack of spectrograms')
+    stack = S if S.ndim == 3 else S[np.newaxis]
+    n_files = stack.shape[0]
+
+    if threshold_abs is None:
+        threshold = stack.reshape(n_files, -1).min(axis=1)[:, None, None]
+    else:
+        threshold = threshold_abs
+
+    if min_distance < 1:
+        mask = stack > threshold
+    else:
+        mask = stack == _maximum_filter(stack, min_distance)
+        # No peak for a trivial image
+        mask[mask.reshape(n_files, -1).all(axis=1)] = False
+        mask &= stack > threshold
+        for axis in (1, 2):
+            _exclude_border(mask, min_distance, axis)
+        if min_distance > 1:
+            _ensure_spacing(mask, min_distance)
+
+    coord = np.transpose(np.nonzero(mask))
+    # Highest peak first within each file, ties in raster order
+    order = np.lexsort((-stack[mask], coord[:, 0]))
+    coord = coord[order]
+    return coord if S.ndim == 3 else coord[:, 1:]
+
+def _maximum_filter(stack, radius):
+    """ Maximum over square windows of each spectrogram, as scipy.ndimage.maximum_filter
+    with size 2 * radius + 1 and mode 'nearest'
+
+    Running maxima are computed by doubling the window, with a few elementwise maxima
+    of shifted arrays per axis, which is faster than the filter of scipy along the
+    non-contiguous frequency axis.
+    """
+    size = 2 * radius + 1
+    for axis in (1, 2):
+        n = stack.shape[axis]
+        pad = [(0, 0)] * stack.ndim
+        pad[axis] = (radius, radius)
+        stack = np.pad(stack, pad, mode='edge')
+        width = 1
+        while 2 * width <= size:
+            stack = np.maximum(_take(stack, axis, None, -width), _take(stack, axis, width, None))
+            width *= 2
+        stack = np.maximum(_take(stack, axis, None, n),
+                           _take(stack, axis, size - width, size - width + n))
+    return stack
+
+def _take(x, axis, start, stop):
+    """ Slice of an array along an axis, as a view """
+    index = [slice(None)] * x.ndim
+    index[axis] = slice(start, stop)
+    return x[tuple(index)]
+
+def _exclude_border(mask, width, axis):
+    """ Discard peaks closer than width to the borders along an axis """
+    _take(mask, axis, None, width)[...] = False
+    _take(mask, axis, -width, None)[...] = False
+
+def _ensure_spacing(mask, min_distance):
+    """ Remove peaks closer than min_distance to a previous peak in raster order
+
+    Peaks closer than min_distance share a plateau, so their order by decreasing level,
+    as used by skimage, is the raster order.
+    """
+    coord = np.transpose(np.nonzero(mask))
+    if len(coord) < 2:
+        return
+    # Files are set apart so that peaks of different files are never close
+    points = coord * np.array([sum(mask.shape[1:]) + min_distance, 1, 1])
+    # Distance to the nearest other peak, infinite if not closer than min_distance
+    distance, _ = cKDTree(points).query(points, k=2, p=np.inf, distance_upper_bound=min_distance)
+    crowded = coord[distance[:, 1] < min_distance]
+    if len(crowded) == 0:
+        return
+    # Pixels closer than min_distance to an accepted peak
+    blocked = np.zeros(mask.shape[1:], dtype=bool)
+    radius = min_distance - 1
+    for file in np.unique(crowded[:, 0]):
+        blocked[:] = False
+        for row, col in crowded[crowded[:, 0] == file, 1:]:
+            if blocked[row, col]:
+                mask[file, row, col] = False
+            else:
+                blocked[max(row - radius, 0):row + radius + 1,
+                        max(col - radius, 0):col + radius + 1] = True
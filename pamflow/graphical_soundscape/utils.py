@@ -0,0 +1,756 @@
+""" Utility functions to compute graphical soundscapes
+
+The functions follow maad.features.graphical_soundscape, with spectrograms computed
+through pamflow.preprocess.spectrogram so that they can be shared through the
+spectrogram cache.
+"""
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from maad import util
+from pamflow.preprocess.utils import (
+    input_validation, read_shards, bounded_map, bounded_map_groups)
+from pamflow.preprocess.spectrogram import get_spectrogram
+from pamflow.graphical_soundscape.peaks import local_max
+
+#%%
+def peak_frequency_counts(
+        files, target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+        path_cache=None, cache_size=None):
+    """ Number of spectrogram peaks per frequency bin of a batch of audio files
+
+    Parameters
+    ----------
+    files : list
+        Paths to the audio files.
+    target_fs : int
+        The target sample rate to resample the audio signal if needed.
+    nperseg : int
+        Window length of each segment to compute the spectrogram.
+    noverlap : int
+        Number of samples to overlap between segments to compute the spectrogram.
+    db_range : float
+        Dynamic range of the computed spectrogram.
+    min_distance : int
+        Minimum number of indices separating peaks.
+    threshold_abs : float
+        Minimum amplitude threshold for peak detection in decibels.
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+
+    Returns
+    -------
+    counts : 2d numpy array of ints
+        Number of peaks per file and frequency bin.
+    n_times : 1d numpy array of ints
+        Number of time steps of the spectrogram of each file.
+    fn : 1d numpy array
+        Frequency bins of the spectrograms.
+    """
+    counts, n_times, fn = [], [], None
+    for path_audio in files:
+        print(f'Processing file {os.path.basename(path_audio)}', end='\r')
+        Sxx, tn, fn_file, _, _ = get_spectrogram(
+            path_audio, target_fs, nperseg=nperseg, noverlap=noverlap, mode='psd',
+            path_cache=path_cache, max_size=cache_size, outputs=('spectrogram',))
+        if fn is not None and not np.array_equal(fn, fn_file):
+            raise ValueError(f'Frequency bins of {path_audio} differ from other files, '
+                             'set target_fs to compute graphs of files with different sample rates')
+        fn = fn_file
+        Sxx_db = util.power2dB(Sxx, db_range=db_range)
+        # As maad.rois.spectrogram_local_max
+        if threshold_abs is not None and threshold_abs < Sxx_db.min():
+            raise ValueError('Value for minimum peak amplitude is below minimum value on spectrogram')
+        peaks = local_max(Sxx_db, min_distance, threshold_abs)
+        counts.append(np.bincount(peaks[:, 0], minlength=len(fn)))
+        n_times.append(len(tn))
+    return np.array(counts).reshape(len(files), -1), np.array(n_times), fn
+
+def spectral_peak_density(
+        path_audio, target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+        path_cache=None, cache_size=None):
+    """ Number of spectrogram peaks per time step within each frequency bin of a file
+
+    Parameters are the same as peak_frequency_counts, for a single file.
+
+    Returns
+    -------
+    pandas DataFrame
+        The peak density of the audio per frequency bin, as a single row.
+    """
+    counts, n_times, fn = peak_frequency_counts(
+        [path_audio], target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+        path_cache, cache_size)
+    peak_density = pd.Series(index=fn, data=counts[0] / n_times[0],
+                             name=os.path.basename(path_audio))
+    return peak_density.to_frame().T
+
+def iter_peak_density(files, target_fs, nperseg, noverlap, db_range, min_distance,
+                      threshold_abs, n_jobs=1, path_cache=None, cache_size=None,
+                      batch_size=16):
+    """ Spectral peak density of files, yielding batches in the order of files
+
+    Batches of batch_size files are processed by a pool of processes, with a bounded
+    number of pending batches. Batches completed ahead of previous ones are held until
+    they can be yielded in order.
+
+    Yields
+    ------
+    tuple
+        Position of the batch in files, peak density per file and frequency bin as a 2d
+        numpy array, and frequency bins.
+    """
+    args = (target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+            path_cache, cache_size)
+    tasks = ((files[start:start + batch_size], *args)
+             for start in range(0, len(files), batch_size))
+    completed, next_position = dict(), 0
+    for position, result in bounded_map(peak_frequency_counts, tasks, n_jobs):
+        completed[position] = result
+        while next_position in completed:
+            counts, n_times, fn = completed.pop(next_position)
+            yield next_position * batch_size, counts / n_times[:, None], fn
+            next_position += 1
+
+def _aggregate_peak_density(density_batches, time):
+    """ Average peak density of files per time, accumulated in the order of files
+
+    Accumulating file by file keeps results independent of the size of batches, so that
+    graphs computed at once or merged from shards are equal.
+    """
+    groups, codes = np.unique(time, return_inverse=True)
+    n_files = np.bincount(codes, minlength=len(groups))
+    total, fn = None, None
+    for start, density, fn in density_batches:
+        if total is None:
+            total = np.zeros((len(groups), density.shape[1]))
+        np.add.at(total, codes[start:start + len(density)], density)
+    if total is None:
+        return pd.DataFrame()
+    graph = pd.DataFrame(total / n_files[:, None], index=groups, columns=fn)
+    graph.index.name = 'time'
+    return graph
+
+#%%
+def spectral_peak_densities(
+        data, threshold_abs, path_audio='path_audio', time='time', target_fs=48000,
+        nperseg=256, noverlap=128, db_range=80, min_distance=1, n_jobs=1,
+        path_cache=None, cache_size=None, batch_size=16):
+    """ Spectral peak density of each file of a set of audio files
+
+    Parameters are the same as graphical_soundscape.
+
+    Returns
+    -------
+    pandas DataFrame
+        Peak density with files as rows, sorted by path_audio, frequency bins as columns
+        and the columns time and path_audio.
+    """
+    df = input_validation(data).sort_values(by=path_audio)
+    print(f'{len(df)} files found to process...')
+    flist = df[path_audio].to_list()
+    density, fn = None, None
+    for start, density_batch, fn in iter_peak_density(
+            flist, target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+            n_jobs, path_cache, cache_size, batch_size):
+        if density is None:
+            density = np.zeros((len(flist), density_batch.shape[1]))
+        density[start:start + len(density_batch)] = density_batch
+
+    res = pd.DataFrame(density, index=[os.path.basename(f) for f in flist], columns=fn)
+    res['time'] = df[time].values
+    res['path_audio'] = flist
+    return res
+
+def graphical_soundscape(
+        data, threshold_abs, path_audio='path_audio', time='time', target_fs=48000,
+        nperseg=256, noverlap=128, db_range=80, min_distance=1, n_jobs=1,
+        path_cache=None, cache_size=None, batch_size=16, path_peaks=None,
+        peaks_threshold=None):
+    """ Compute a graphical soundscape from a set of audio files
+
+    Peaks are extracted from each file by a pool of processes, and the peak density of
+    files is averaged per time as results arrive, so memory use does not grow with the
+    number of files.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata.
+    threshold_abs : float
+        Minimum amplitude threshold for peak detection in decibels.
+    path_audio : str, optional
+        Column name with the path to audio files, by default 'path_audio'
+    time : str, optional
+        Column name with the time used to group files, by default 'time'
+    target_fs : int, optional
+        The target sample rate to resample the audio signal if needed, by default 48000
+    nperseg : int, optional
+        Window length of each segment to compute the spectrogram, by default 256
+    noverlap : int, optional
+        Number of samples to overlap between segments, by default 128
+    db_range : float, optional
+        Dynamic range of the computed spectrogram, by default 80
+    min_distance : int, optional
+        Minimum number of indices separating peaks, by default 1
+    n_jobs : int, optional
+        Number of processes, -1 uses all processors, by default 1
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+    batch_size : int, optional
+        Number of files per task sent to processes, by default 16
+    path_peaks : str, optional
+        Directory of peak stores. If given, peaks of files are detected once with
+        peaks_threshold and saved, and graphs are derived from the store, so runs with
+        other thresholds or groupings do not read audio again. By default None
+    peaks_threshold : float, optional
+        Threshold in decibels of peaks saved in the store, by default -db_range
+
+    Returns
+    -------
+    pandas DataFrame
+        Graphical soundscape with time as index and frequency bins as columns.
+    """
+    df = input_validation(data).sort_values(by=path_audio)
+    print(f'{len(df)} files found to process...')
+    if path_peaks is not None:
+        path_store = compute_peak_store(
+            df, path_peaks, path_audio, target_fs, nperseg, noverlap, db_range, min_distance,
+            peaks_threshold, n_jobs, path_cache, cache_size, batch_size)
+        return graph_from_peaks(path_store, df, threshold_abs, path_audio, time)
+
+    batches = iter_peak_density(
+        df[path_audio].to_list(), target_fs, nperseg, noverlap, db_range, min_distance,
+        threshold_abs, n_jobs, path_cache, cache_size, batch_size)
+    graph = _aggregate_peak_density(batches, df[time].values)
+    print('\nComputation completed!')
+    return graph
+
+def iter_graphical_soundscape_sites(
+        data, threshold_abs, path_audio='path_audio', time='time', target_fs=48000,
+        nperseg=256, noverlap=128, db_range=80, min_distance=1, n_jobs=1,
+        path_cache=None, cache_size=None, batch_size=16, path_peaks=None,
+        peaks_threshold=None):
+    """ Compute the graphical soundscape of each site with one pool of processes,
+    yielding each site as soon as its last file completes
+
+    The files of all sites are a single queue of tasks, so workers do not wait for the
+    slowest file of a site, and deployments with many small sites do not start a pool
+    per site. Graphs are equal to graphical_soundscape on the files of each site. With
+    a peak store, peaks of all sites are detected first and graphs are then derived
+    from the store.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata, with column sensor_name.
+    Other parameters are the same as graphical_soundscape.
+
+    Yields
+    ------
+    tuple
+        Sensor name and its graphical soundscape, with time as index and frequency bins
+        as columns.
+    """
+    df = input_validation(data).sort_values(by=path_audio)
+    print(f'{len(df)} files found to process...')
+    if path_peaks is not None:
+        path_store = compute_peak_store(
+            df, path_peaks, path_audio, target_fs, nperseg, noverlap, db_range, min_distance,
+            peaks_threshold, n_jobs, path_cache, cache_size, batch_size)
+        manifest = read_peak_manifest(path_store)
+        for site, df_site in df.groupby('sensor_name'):
+            yield site, graph_from_peaks(
+                path_store, df_site, threshold_abs, path_audio, time, manifest)
+        return
+
+    args = (target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+            path_cache, cache_size)
+    sites, groups = dict(), []
+    for site, df_site in df.groupby('sensor_name'):
+        flist = df_site[path_audio].to_list()
+        sites[site] = (df_site[time].values, dict())
+        groups.append((site, [(flist[start:start + batch_size], *args)
+                              for start in range(0, len(flist), batch_size)]))
+
+    for site, position, result, last in bounded_map_groups(
+            peak_frequency_counts, groups, n_jobs):
+        site_time, completed = sites[site]
+        if position is not None:
+            completed[position] = result
+        if last:
+            del sites[site]
+            # Batches are accumulated in the order of files, as graphical_soundscape
+            batches = [(idx * batch_size, counts / n_times[:, None], fn)
+                       for idx, (counts, n_times, fn) in sorted(completed.items())]
+            yield site, _aggregate_peak_density(batches, site_time)
+
+def merge_graph_shards(fname, n_shards):
+    """ Combine per file peak densities of shards into a graphical soundscape
+
+    Shards save the peak density of each file, see spectral_peak_densities, so that the
+    graphical soundscape averages files in the same order as a single node run.
+
+    Parameters
+    ----------
+    fname : str
+        Output path of the single node run, shard outputs are named with shard_fname.
+    n_shards : int
+        Number of shards of the run.
+
+    Returns
+    -------
+    pandas DataFrame
+        Graphical soundscape with time as index and frequency bins as columns.
+    """
+    dfs = read_shards(fname, n_shards, index_col=0, float_precision='round_trip')
+    if len(dfs) == 0:
+        return pd.DataFrame()
+    res = pd.concat(dfs).sort_values('path_audio', kind='stable')
+    density = res.drop(columns=['path_audio', 'time'])
+    fn = density.columns.astype(float).values
+    return _aggregate_peak_density([(0, density.values, fn)], res['time'].values)
+
+#%%
+# -------------------------
+# Parameter sweep
+# -------------------------
+def sweep_peak_counts(
+        files, target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+        path_cache=None, cache_size=None):
+    """ Number of spectrogram peaks per frequency bin of a batch of audio files, for a
+    grid of peak detection parameters
+
+    The spectrogram of each file is computed once per value of nperseg. Peaks are
+    detected once per value of db_range and min_distance with the lowest threshold, and
+    the peaks of higher thresholds are the ones with a level above them. As in the peak
+    store, thresholds are not checked against the minimum of the spectrogram.
+
+    Parameters
+    ----------
+    files : list
+        Paths to the audio files.
+    target_fs : int
+        The target sample rate to resample the audio signal if needed.
+    nperseg : list
+        Values of the window length to compute the spectrogram.
+    noverlap : int
+        Number of samples to overlap between segments to compute the spectrogram.
+    db_range, min_distance, threshold_abs : list
+        Values of each parameter, as in peak_frequency_counts.
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+
+    Returns
+    -------
+    dict
+        Keys are tuples (nperseg, db_range, min_distance), values are tuples of
+        the number of peaks as a 3d numpy array (files, thresholds, frequency bins) and
+        the frequency bins.
+    """
+    thresholds = np.asarray(threshold_abs, dtype=float)
+    counts = dict()
+    for idx, path_audio in enumerate(files):
+        print(f'Processing file {os.path.basename(path_audio)}', end='\r')
+        for nperseg_value in nperseg:
+            Sxx, _, fn, _, _ = get_spectrogram(
+                path_audio, target_fs, nperseg=nperseg_value, noverlap=noverlap, mode='psd',
+                path_cache=path_cache, max_size=cache_size, outputs=('spectrogram',))
+            for db_range_value in db_range:
+                Sxx_db = util.power2dB(Sxx, db_range=db_range_value)
+                for min_distance_value in min_distance:
+                    key = (nperseg_value, db_range_value, min_distance_value)
+                    if key not in counts:
+                        counts[key] = (np.zeros((len(files), len(thresholds), len(fn)), int), fn)
+                    elif not np.array_equal(counts[key][1], fn):
+                        raise ValueError(f'Frequency bins of {path_audio} differ from other files, '
+                                         'set target_fs to compute graphs of files with different '
+                                         'sample rates')
+                    peaks = local_max(Sxx_db, min_distance_value, thresholds.min())
+                    level = Sxx_db[peaks[:, 0], peaks[:, 1]]
+                    for idx_threshold, threshold in enumerate(thresholds):
+                        counts[key][0][idx, idx_threshold] = np.bincount(
+                            peaks[level > threshold, 0], minlength=len(fn))
+    return counts
+
+def sweep_graphical_soundscape(
+        data, threshold_abs, min_distance, nperseg, db_range, path_audio='path_audio',
+        time='time', target_fs=48000, noverlap=0, n_jobs=1, path_cache=None,
+        cache_size=None, batch_size=16):
+    """ Peak counts and occupancy of graphical soundscapes for a grid of parameters
+
+    Helps to calibrate peak detection without running graphical_soundscape for each
+    combination of parameters. Audio files are read once per value of nperseg.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata.
+    threshold_abs : float or list
+        Minimum amplitude thresholds for peak detection in decibels.
+    min_distance : int or list
+        Minimum numbers of indices separating peaks.
+    nperseg : int or list
+        Window lengths of each segment to compute the spectrogram.
+    db_range : float or list
+        Dynamic ranges of the computed spectrogram.
+    path_audio : str, optional
+        Column name with the path to audio files, by default 'path_audio'
+    time : str, optional
+        Column name with the time used to group files, by default 'time'
+    target_fs : int, optional
+        The target sample rate to resample the audio signal if needed, by default 48000
+    noverlap : int, optional
+        Number of samples to overlap between segments, the same for all values of
+        nperseg, by default 0
+    n_jobs : int, optional
+        Number of processes, -1 uses all processors, by default 1
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+    batch_size : int, optional
+        Number of files per task sent to processes, by default 16
+
+    Returns
+    -------
+    pandas DataFrame
+        One row per combination of parameters and time, with the number of files and
+        peaks, the mean number of peaks per file, and the occupancy, i.e. the fraction
+        of frequency bins of the graphical soundscape with at least one peak.
+    """
+    grid = [list(np.atleast_1d(values)) for values in
+            (nperseg, db_range, min_distance, threshold_abs)]
+    if noverlap >= min(grid[0]):
+        raise ValueError(f'noverlap {noverlap} must be smaller than all values of nperseg')
+
+    df = input_validation(data).sort_values(by=path_audio)
+    print(f'{len(df)} files found to process...')
+    print(f'Sweeping {np.prod([len(values) for values in grid])} combinations of parameters')
+    flist = df[path_audio].to_list()
+    groups, codes = np.unique(df[time].values, return_inverse=True)
+
+    # Sum of peaks per time and frequency bin, for each combination
+    total = dict()
+    tasks = ((flist[start:start + batch_size], target_fs, grid[0], noverlap, *grid[1:],
+              path_cache, cache_size) for start in range(0, len(flist), batch_size))
+    for position, counts in bounded_map(sweep_peak_counts, tasks, n_jobs):
+        codes_batch = codes[position * batch_size:position * batch_size + batch_size]
+        for key, (counts_key, fn) in counts.items():
+            if key not in total:
+                total[key] = np.zeros((len(groups), *counts_key.shape[1:]), int)
+            np.add.at(total[key], codes_batch, counts_key)
+
+    n_files = np.bincount(codes, minlength=len(groups))
+    res = []
+    for (nperseg_value, db_range_value, min_distance_value), total_key in total.items():
+        for idx_threshold, threshold in enumerate(grid[3]):
+            n_peaks = total_key[:, idx_threshold].sum(axis=1)
+            res.append(pd.DataFrame({
+                'nperseg': nperseg_value,
+                'db_range': db_range_value,
+                'min_distance': min_distance_value,
+                'threshold_abs': threshold,
+                'time': groups,
+                'n_files': n_files,
+                'n_peaks': n_peaks,
+                'peaks_per_file': n_peaks / n_files,
+                'occupancy': (total_key[:, idx_threshold] > 0).mean(axis=1)}))
+    print('\nComputation completed!')
+    if not res:
+        return pd.DataFrame(columns=['nperseg', 'db_range', 'min_distance', 'threshold_abs',
+                                     'time', 'n_files', 'n_peaks', 'peaks_per_file',
+                                     'occupancy'])
+    return pd.concat(res, ignore_index=True).sort_values(
+        ['nperseg', 'db_range', 'min_distance', 'threshold_abs', 'time'], ignore_index=True)
+
+#%%
+# -------------------------
+# Peak store
+# -------------------------
+def spectrogram_peaks(
+        files, target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+        path_cache=None, cache_size=None):
+    """ Coordinates and levels of spectrogram peaks of a batch of audio files
+
+    Peaks are detected as in peak_frequency_counts, without checking that the threshold
+    is above the minimum of the spectrogram, and sorted by decreasing level.
+    Since peaks are local maxima of a fixed neighborhood, the peaks found with a higher
+    threshold are the ones with a level above that threshold.
+
+    Parameters are the same as peak_frequency_counts.
+
+    Returns
+    -------
+    dict
+        Arrays path_audio, n_times, db_min and n_peaks with one value per file, and
+        peak_time, peak_freq and peak_db with the peaks of all files concatenated, as
+        indices of the spectrogram and levels in dB. Frequency bins are stored as fn.
+    """
+    table = {name: [] for name in ['n_times', 'db_min', 'n_peaks', 'peak_time',
+                                   'peak_freq', 'peak_db']}
+    fn = None
+    for path_audio in files:
+        print(f'Processing file {os.path.basename(path_audio)}', end='\r')
+        Sxx, _, fn, _, _ = get_spectrogram(
+            path_audio, target_fs, nperseg=nperseg, noverlap=noverlap, mode='psd',
+            path_cache=path_cache, max_size=cache_size, outputs=('spectrogram',))
+        Sxx_db = util.power2dB(Sxx, db_range=db_range)
+        peaks = local_max(Sxx_db, min_distance, threshold_abs)
+        table['n_times'].append(Sxx_db.shape[1])
+        table['db_min'].append(Sxx_db.min())
+        table['n_peaks'].append(len(peaks))
+        table['peak_freq'].append(peaks[:, 0])
+        table['peak_time'].append(peaks[:, 1])
+        table['peak_db'].append(Sxx_db[peaks[:, 0], peaks[:, 1]])
+
+    table = {name: np.concatenate(values) if name.startswith('peak_') else np.array(values)
+             for name, values in table.items()}
+    table['peak_freq'] = table['peak_freq'].astype('i4')
+    table['peak_time'] = table['peak_time'].astype('i4')
+    table['path_audio'] = np.array(files, dtype=str)
+    table['fn'] = fn
+    return table
+
+PEAK_MANIFEST = '_manifest.csv'
+
+def peak_store_path(path_peaks, target_fs, nperseg, noverlap, db_range, min_distance,
+                    threshold_abs):
+    """ Directory of the peak store for a given configuration """
+    config = {
+        'target_fs': target_fs, 'nperseg': nperseg, 'noverlap': noverlap,
+        'db_range': db_range, 'min_distance': min_distance, 'threshold_abs': threshold_abs}
+    config = json.dumps(config, sort_keys=True)
+    config_id = hashlib.blake2b(config.encode(), digest_size=8).hexdigest()
+    return os.path.join(path_peaks, f'peaks_{config_id}')
+
+def compute_peak_store(
+        data, path_peaks, path_audio='path_audio', target_fs=48000, nperseg=256,
+        noverlap=128, db_range=80, min_distance=1, threshold_abs=None, n_jobs=1,
+        path_cache=None, cache_size=None, batch_size=16):
+    """ Save spectrogram peaks of audio files to a peak store
+
+    Peaks are detected with a permissive threshold and saved once per file, so that
+    graphical soundscapes with any higher threshold, time grouping or selection of
+    files are derived from the store without reading audio, see graph_from_peaks.
+    Files already in the store are skipped.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata.
+    path_peaks : str
+        Directory of peak stores, each configuration is saved in a sub directory.
+    path_audio : str, optional
+        Column name with the path to audio files, by default 'path_audio'
+    threshold_abs : float, optional
+        Minimum level of peaks in decibels, by default -db_range, which keeps all peaks.
+    Other parameters are the same as graphical_soundscape.
+
+    Returns
+    -------
+    str
+        Directory of the store.
+    """
+    df = input_validation(data)
+    if threshold_abs is None:
+        threshold_abs = -db_range
+    path_store = peak_store_path(
+        path_peaks, target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs)
+    os.makedirs(path_store, exist_ok=True)
+    with open(os.path.join(path_store, '_config.json'), 'w') as f:
+        json.dump({
+            'target_fs': target_fs, 'nperseg': nperseg, 'noverlap': noverlap,
+            'db_range': db_range, 'min_distance': min_distance,
+            'threshold_abs': threshold_abs}, f, indent=2)
+
+    # Skip files already in the store
+    manifest = read_peak_manifest(path_store)
+    done = set(manifest['path_audio'])
+    flist = df[path_audio].drop_duplicates()
+    files = [f for f in flist if f not in done]
+    print(f'Detecting peaks for {len(files)} files, {len(flist) - len(files)} files found in store')
+
+    args = (target_fs, nperseg, noverlap, db_range, min_distance, threshold_abs,
+            path_cache, cache_size)
+    tasks = ((files[start:start + batch_size], *args)
+             for start in range(0, len(files), batch_size))
+    n_parts, entries = len(_peak_parts(path_store)), [manifest]
+    try:
+        for position, table in bounded_map(spectrogram_peaks, tasks, n_jobs):
+            # Parts are written under a temporary name, so partial files are never read
+            fname = f'part-{n_parts + position:06d}-{os.getpid()}.npz'
+            np.savez(os.path.join(path_store, fname + '.tmp.npz'), **table)
+            os.replace(os.path.join(path_store, fname + '.tmp.npz'),
+                       os.path.join(path_store, fname))
+            entries.append(_manifest_entries(fname, table))
+    finally:
+        # Parts written after the last saved manifest are added when it is read again
+        if len(entries) > 1:
+            _save_peak_manifest(path_store, pd.concat(entries, ignore_index=True))
+    return path_store
+
+def _peak_parts(path_store):
+    """ Names of complete parts of a peak store, in the order they were written """
+    return sorted(fname for fname in os.listdir(path_store)
+                  if fname.startswith('part-') and fname.endswith('.npz')
+                  and not fname.endswith('.tmp.npz'))
+
+def _manifest_entries(part, table):
+    """ Manifest rows of the files of a part """
+    entries = pd.DataFrame({
+        name: table[name] for name in ['path_audio', 'n_times', 'db_min', 'n_peaks']})
+    entries.insert(1, 'part', part)
+    entries.insert(2, 'start', np.cumsum(table['n_peaks']) - table['n_peaks'])
+    return entries
+
+def _save_peak_manifest(path_store, manifest):
+    fname = os.path.join(path_store, PEAK_MANIFEST)
+    manifest.to_csv(fname + '.tmp', index=False, float_format='%.17g')
+    os.replace(fname + '.tmp', fname)
+
+def read_peak_manifest(path_store):
+    """ Part, first peak and number of peaks of each file of a peak store
+
+    The manifest is saved when compute_peak_store ends. Parts written after it, such as
+    parts of a killed run, are read and added to the manifest.
+
+    Returns
+    -------
+    pandas DataFrame
+        One row per file with columns path_audio, part, start (position of the first
+        peak of the file in the part), n_times, db_min and n_peaks. Files computed twice
+        keep the last result.
+    """
+    fname = os.path.join(path_store, PEAK_MANIFEST)
+    if os.path.isfile(fname):
+        manifest = pd.read_csv(fname, dtype={'path_audio': str, 'part': str})
+    else:
+        manifest = pd.DataFrame(
+            columns=['path_audio', 'part', 'start', 'n_times', 'db_min', 'n_peaks'])
+    known = set(manifest['part'])
+    missing = [part for part in _peak_parts(path_store) if part not in known]
+    if len(missing) > 0:
+        entries = [manifest]
+        for part in missing:
+            with np.load(os.path.join(path_store, part)) as table:
+                entries.append(_manifest_entries(part, table))
+        manifest = pd.concat(entries, ignore_index=True)
+        _save_peak_manifest(path_store, manifest)
+    return manifest.drop_duplicates('path_audio', keep='last').reset_index(drop=True)
+
+def read_peak_store(path_store, files=None, manifest=None):
+    """ Load the peaks of files of a peak store
+
+    Only the parts with the selected files are read, see read_peak_manifest.
+
+    Parameters
+    ----------
+    path_store : str
+        Directory of the store, see compute_peak_store.
+    files : list, optional
+        Paths of the audio files to load, by default all files of the store.
+    manifest : pandas DataFrame, optional
+        Manifest of the store, see read_peak_manifest. By default it is read from the
+        store, pass it to read it once when loading several selections.
+
+    Returns
+    -------
+    files : pandas DataFrame
+        One row per file with columns path_audio, n_times, db_min, n_peaks and start,
+        the position of the first peak of the file in the peak arrays.
+    peaks : dict
+        Arrays peak_time, peak_freq and peak_db.
+    fn : 1d numpy array
+        Frequency bins of the spectrograms.
+    """
+    if manifest is None:
+        manifest = read_peak_manifest(path_store)
+    if files is not None:
+        manifest = manifest[manifest['path_audio'].isin(set(files))]
+    columns = ['path_audio', 'n_times', 'db_min', 'n_peaks']
+    selected, peaks, fn = [], {'peak_time': [], 'peak_freq': [], 'peak_db': []}, None
+    for part, entries in manifest.groupby('part', sort=True):
+        with np.load(os.path.join(path_store, part)) as table:
+            # Positions of the peaks of the selected files in the part
+            n_peaks = entries['n_peaks'].values.astype(int)
+            idx = np.repeat(entries['start'].values.astype(int) - np.cumsum(n_peaks) + n_peaks,
+                            n_peaks) + np.arange(n_peaks.sum())
+            for name in peaks:
+                peaks[name].append(table[name][idx])
+            fn = table['fn']
+        selected.append(entries[columns])
+
+    if len(selected) == 0:
+        files = pd.DataFrame(columns=columns + ['start'])
+        return files, {name: np.zeros(0) for name in peaks}, fn
+    files = pd.concat(selected, ignore_index=True)
+    files['start'] = np.cumsum(files['n_peaks'].values) - files['n_peaks'].values
+    peaks = {name: np.concatenate(values) for name, values in peaks.items()}
+    return files, peaks, fn
+
+def graph_from_peaks(path_store, data, threshold_abs, path_audio='path_audio', time='time',
+                     manifest=None):
+    """ Compute a graphical soundscape from a peak store
+
+    Results are equal to graphical_soundscape with the configuration of the store. Only
+    the parts of the store with the selected files are read.
+
+    Parameters
+    ----------
+    path_store : str
+        Directory of the store, see compute_peak_store.
+    data : pandas DataFrame or str
+        Metadata of the files to include, with the column used to group files. Files
+        can be any subset of the files of the store, such as a site or a date range.
+    threshold_abs : float
+        Minimum amplitude threshold for peak detection in decibels, equal or above the
+        threshold of the store.
+    path_audio : str, optional
+        Column name with the path to audio files, by default 'path_audio'
+    time : str, optional
+        Column name with the time used to group files, by default 'time'
+    manifest : pandas DataFrame, optional
+        Manifest of the store, see read_peak_manifest. By default it is read from the store.
+
+    Returns
+    -------
+    pandas DataFrame
+        Graphical soundscape with time as index and frequency bins as columns.
+    """
+    with open(os.path.join(path_store, '_config.json')) as f:
+        config = json.load(f)
+    if threshold_abs < config['threshold_abs']:
+        raise ValueError(f"Threshold {threshold_abs} is below the threshold of the peak "
+                         f"store {config['threshold_abs']}")
+
+    df = input_validation(data).sort_values(by=path_audio)
+    files, peaks, fn = read_peak_store(path_store, df[path_audio], manifest)
+    files = files.set_index('path_audio').reindex(df[path_audio])
+    missing = files['n_times'].isna()
+    if missing.any():
+        raise ValueError(f'{missing.sum()} files are not in the peak store, '
+                         f'e.g. {files.index[missing][0]}')
+    # As maad.rois.spectrogram_local_max
+    if (threshold_abs < files['db_min']).any():
+        raise ValueError('Value for minimum peak amplitude is below minimum value on spectrogram')
+
+    # Number of peaks per file and frequency above the threshold
+    n_peaks = files['n_peaks'].values.astype(int)
+    idx = np.repeat(files['start'].values.astype(int), n_peaks)
+    idx += np.arange(n_peaks.sum()) - np.repeat(np.cumsum(n_peaks) - n_peaks, n_peaks)
+    file_idx = np.repeat(np.arange(len(files)), n_peaks)
+    keep = peaks['peak_db'][idx] > threshold_abs
+    counts = np.bincount(
+        file_idx[keep] * len(fn) + peaks['peak_freq'][idx][keep],
+        minlength=len(files) * len(fn)).reshape(len(files), len(fn))
+    density = counts / files['n_times'].values[:, None]
+    return _aggregate_peak_density([(0, density, fn)], df[time].values)
@@ -5,12 +5,14 @@ Utilitary functions to manage, check and preprocess large sampling data assiciat
 
 """
 import os
+import sys
 import argparse
+import matplotlib
+matplotlib.use('Agg')  # render without display, also in worker processes
 import matplotlib.pyplot as plt
-import pandas as pd
-from maad import sound, util
 from pamflow.preprocess.utils import find_files, plot_sensor_deployment
-from maad.features import plot_graph
+from pamflow.plot.utils import render_spectrogram, render_graph, render_pyramid, render_batch
+from pamflow.plot.pyramid import build_pyramid
 import yaml
 
 def load_config(file_path):
@@ -18,28 +20,28 @@ def load_config(file_path):
         config = yaml.safe_load(config_file)
     return config
 
-def plot_spectrogram(input, output, config):
-    # load configuration
+def spectrogram_settings(config):
+    """ Parameters of render_spectrogram from the plot section of the configuration """
     config = load_config(config)
-    nperseg = config['plot']['nperseg']
-    noverlap = config['plot']['noverlap']
-    fig_height = config['plot']['fig_height']
-    fig_width = config['plot']['fig_width']
-    db_range = config['plot']['db_range']
-    flims = config['plot']['flims']
-    cmap = config['plot']['colormap']
+    return {
+        'nperseg': config['plot']['nperseg'],
+        'noverlap': config['plot']['noverlap'],
+        'db_range': config['plot']['db_range'],
+        'flims': config['plot']['flims'],
+        'cmap': config['plot']['colormap'],
+        'fig_width': config['plot']['fig_width'],
+        'fig_height': config['plot']['fig_height'],
+        'path_cache': config.get('cache', {}).get('path'),
+        'cache_size': config.get('cache', {}).get('max_size')}
 
-    # plot spectrogram
-    s, fs = sound.load(input)
-    Sxx, _, _, ext = sound.spectrogram(s, fs, nperseg=nperseg, noverlap=noverlap, flims=flims)
-    ext[2], ext[3] = ext[2]/1000, ext[3]/1000
-    fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-    util.plot_spectrogram(Sxx, ext, db_range=db_range, ax=ax, colorbar=False, cmap=cmap)
-    ax.set_ylabel('Frequency (kHz)')
-    ax.set_xlabel('Time (s)')
-    fname_save = str(fname)[:-4] + '.png'
-    plt.savefig(fname_save)
-    plt.close(fig)
+def print_render_status(df):
+    """ Print the number of images per status and the errors, exit with an error on failures """
+    print(f"\nDone! {df.status.value_counts().to_dict()}")
+    failed = df[df.status == 'failed']
+    for fname, error in zip(failed.fname, failed.error):
+        print(f'Failed {fname}: {error}')
+    if len(failed):
+        sys.exit(1)
     
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -50,42 +52,86 @@ if __name__ == "__main__":
             "spectrogram",
             "sensor_deployment",
             "plot_graph",
+            "pyramid",
+            "plot_pyramid",
         ],
         help="Plot operation")
     
     parser.add_argument("--input", "-i", 
                         type=str, help="Path to directory to search")
     parser.add_argument("--output", "-o", 
-                        type=str, help="Path and filename to save results")
+                        type=str, help="Directory to save images, by default next to input files. "
+                                       "Path of the image for sensor_deployment and plot_pyramid")
     parser.add_argument("--config", "-c", type=str, default='config.yaml',
                         help="Path to configuration file. ")
     parser.add_argument("--recursive", "-r", 
                         action="store_true", help="Enable recursive mode")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Render images that are newer than their input, for instance after "
+                             "changing plot settings")
+    parser.add_argument("--raster", action="store_true",
+                        help="Plot the sensor deployment as a single image of recordings per "
+                             "site and day, for deployments with many sites")
+    parser.add_argument("--tlims", nargs=2, type=float, default=None,
+                        help="Start and end in seconds of the window to plot from a pyramid "
+                             "(default: whole recording)")
     args = parser.parse_args()
+    # The sensor deployment does not use settings from the configuration file
+    config = {} if args.operation == "sensor_deployment" else load_config(args.config)
+    n_jobs = config.get('plot', {}).get('n_jobs', 1)
+    pyramid = config.get('plot', {}).get('pyramid') or {}
 
     if args.operation == "spectrogram":
         if os.path.isdir(args.input):
-            flist = find_files(args.input, endswith='.wav')
+            flist = find_files(args.input, endswith='.wav', recursive=args.recursive)
+            root = args.input  # outputs mirror the sub folders of the input
         else:
-            flist = [args.input]
+            flist, root = [args.input], None
         
-        for fname in flist:
-            plot_spectrogram(fname, args.output, args.config)
+        df = render_batch(render_spectrogram, flist, args.output, args.overwrite, n_jobs,
+                          root=root, **spectrogram_settings(args.config))
+        print_render_status(df)
     
     elif args.operation == "sensor_deployment":
-        _ = plot_sensor_deployment(args.input)
+        if args.raster:
+            fig = plot_sensor_deployment(args.input, raster=True)
+        else:
+            fig, ax = plt.subplots(figsize=[8,5])
+            plot_sensor_deployment(args.input, ax=ax)
+        fname_save = args.output or os.path.splitext(args.input.rstrip(os.sep))[0] + '_deployment.png'
+        fig.savefig(fname_save, bbox_inches='tight')
+        print(f'Done! Results are saved at {fname_save}')
 
     elif args.operation == "plot_graph":
         if os.path.isdir(args.input):
-            flist = find_files(args.input, endswith='.csv')
+            flist = find_files(args.input, endswith='.csv', recursive=args.recursive)
+            root = args.input  # outputs mirror the sub folders of the input
         else:
-            flist = [args.input]
+            flist, root = [args.input], None
         
-        for fname in flist:
-            graph = pd.read_csv(fname, index_col=0)
-            fig, ax = plt.subplots()
-            plot_graph(graph)
-            fname_save = str(fname)[:-4] + '.png'
-            plt.savefig(fname_save)
-            plt.close(fig)
-            
\ No newline at end of file
+        df = render_batch(render_graph, flist, args.output, args.overwrite, n_jobs, root=root)
+        print_render_status(df)
+
+    elif args.operation == "pyramid":
+        if os.path.isdir(args.input):
+            flist = find_files(args.input, endswith='.wav', recursive=args.recursive)
+            root = args.input  # outputs mirror the sub folders of the input
+        else:
+            flist, root = [args.input], None
+
+        settings = spectrogram_settings(args.config)
+        df = render_batch(build_pyramid, flist, args.output, args.overwrite, n_jobs,
+                          extension='_pyramid', root=root, nperseg=settings['nperseg'],
+                          noverlap=settings['noverlap'], db_range=settings['db_range'],
+                          tile_size=pyramid.get('tile_size', 1024),
+                          factor=pyramid.get('factor', 2),
+                          pooling=pyramid.get('pooling', 'max'))
+        print_render_status(df)
+
+    elif args.operation == "plot_pyramid":
+        settings = spectrogram_settings(args.config)
+        fname_save = args.output or args.input.rstrip(os.sep) + '.png'
+        render_pyramid(args.input, fname_save, args.tlims, settings['flims'],
+                       pyramid.get('max_columns', 2000), settings['cmap'],
+                       settings['fig_width'], settings['fig_height'])
+        print(f'Done! Results are saved at {fname_save}')
@@ -0,0 +1,225 @@
+""" Multi-resolution spectrogram pyramids of long recordings
+
+A pyramid stores the spectrogram of an audio file at several time resolutions. Level 0
+has one column per STFT frame, and each level pools groups of `factor` columns of the
+previous level with the maximum or the mean of the power. Levels are split along time
+in tiles of tile_size columns, saved as .npy files of uint8 levels in dB between
+-db_range and 0. A 24 h recording at 48 kHz with nperseg=1024 takes about 2 GB at
+level 0, and as much for all other levels together with factor=2.
+
+The audio is read in windows with pamflow.preprocess.spectrogram.iter_audio_windows and
+columns are pooled and written as frames are computed, so building a pyramid keeps at
+most one tile per level in memory. Reading a time window picks the finest level that
+fits within max_columns and loads only the tiles it overlaps.
+
+    path_audio.wav
+    pyramid/
+        pyramid.json
+        level_00/tile_000000.npy
+        level_00/tile_000001.npy
+        level_01/tile_000000.npy
+        ...
+
+"""
+import os
+import json
+import numpy as np
+from scipy import signal
+from pamflow.preprocess.utils import read_wav_header
+from pamflow.preprocess.spectrogram import iter_audio_windows
+
+PYRAMID_CONFIG = 'pyramid.json'
+
+#%%
+def build_pyramid(
+        path_audio, path_save, nperseg=1024, noverlap=0, db_range=80, tile_size=1024,
+        factor=2, pooling='max', window=60, target_fs=None):
+    """ Compute the spectrogram pyramid of an audio file
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    path_save : str
+        Directory to save the pyramid.
+    nperseg : int, optional
+        Window length of each segment to compute the spectrogram, by default 1024
+    noverlap : int, optional
+        Number of samples to overlap between segments, by default 0
+    db_range : float, optional
+        Dynamic range of the stored spectrogram in decibels, by default 80
+    tile_size : int, optional
+        Number of time columns per tile, by default 1024
+    factor : int, optional
+        Number of columns pooled into one column of the next level, by default 2
+    pooling : str, optional
+        'max' or 'mean' of the power of pooled columns, by default 'max'
+    window : float, optional
+        Length in seconds of the audio read at once, by default 60
+    target_fs : int, optional
+        Sampling frequency used for analysis, by default the one of the file.
+
+    Returns
+    -------
+    dict
+        Description of the pyramid, as saved in pyramid.json.
+    """
+    if pooling not in ('max', 'mean'):
+        raise ValueError("pooling must be 'max' or 'mean'")
+    header = read_wav_header(path_audio)
+    if header['error'] is not None:
+        raise ValueError(f"Cannot read {path_audio}: {header['error']}")
+    fs = header['sample_rate'] if target_fs is None else target_fs
+    hop = nperseg - noverlap
+    n_samples = int(header['samples'] * fs / header['sample_rate'])
+    n_frames = max((n_samples - nperseg) // hop + 1, 0)
+    n_levels = 1
+    while np.ceil(n_frames / factor**(n_levels - 1)) > tile_size:
+        n_levels += 1
+
+    config = {
+        'path_audio': str(path_audio), 'sample_rate': fs, 'nperseg': nperseg,
+        'noverlap': noverlap, 'db_range': db_range, 'tile_size': tile_size,
+        'factor': factor, 'pooling': pooling, 'n_levels': n_levels,
+        'fn': (np.arange(nperseg // 2) * fs / nperseg).tolist()}
+    writer = _PyramidWriter(path_save, config)
+    buffer = np.zeros(0)
+    for _, s in iter_audio_windows(path_audio, window, target_fs):
+        # Keep samples of incomplete frames for the next window
+        buffer = np.concatenate([buffer, s])
+        n = (len(buffer) - nperseg) // hop + 1
+        if n <= 0:
+            continue
+        writer.push(0, _power_spectrogram(buffer[:(n - 1) * hop + nperseg], fs, nperseg, noverlap))
+        buffer = buffer[n * hop:]
+    writer.close()
+    config['n_columns'] = writer.n_columns
+
+    with open(os.path.join(path_save, PYRAMID_CONFIG), 'w') as f:
+        json.dump(config, f, indent=2)
+    return config
+
+def _power_spectrogram(s, fs, nperseg, noverlap):
+    """ Power spectral density of all complete frames of a signal, scaled as maad.sound.spectrogram """
+    _, _, Sxx = signal.spectrogram(
+        s, fs, window='hann', nperseg=nperseg, noverlap=noverlap, nfft=nperseg,
+        mode='complex', detrend='constant', scaling='density')
+    return np.abs(Sxx[:-1] * np.sqrt(2 * fs / nperseg))**2
+
+class _PyramidWriter:
+    """ Pool columns into the levels of a pyramid and write full tiles """
+    def __init__(self, path_save, config):
+        self.path_save = path_save
+        self.config = config
+        n_levels, n_freqs = config['n_levels'], len(config['fn'])
+        self.pending = [np.zeros((n_freqs, 0)) for _ in range(n_levels)]
+        self.carry = [np.zeros((n_freqs, 0)) for _ in range(n_levels)]
+        self.n_tiles = [0] * n_levels
+        self.n_columns = [0] * n_levels
+        for level in range(n_levels):
+            os.makedirs(os.path.join(path_save, f'level_{level:02d}'), exist_ok=True)
+
+    def push(self, level, columns, last=False):
+        """ Add columns of power to a level, and their pooled columns to the next one """
+        tile_size, factor = self.config['tile_size'], self.config['factor']
+        pending = np.concatenate([self.pending[level], columns], axis=1)
+        while pending.shape[1] >= tile_size or (last and pending.shape[1] > 0):
+            self._write_tile(level, pending[:, :tile_size])
+            pending = pending[:, tile_size:]
+        self.pending[level] = pending
+
+        if level + 1 == self.config['n_levels']:
+            return
+        carry = np.concatenate([self.carry[level], columns], axis=1)
+        n = carry.shape[1] // factor * factor
+        pool = np.max if self.config['pooling'] == 'max' else np.mean
+        pooled = pool(carry[:, :n].reshape(carry.shape[0], -1, factor), axis=2)
+        if last and carry.shape[1] > n:
+            pooled = np.concatenate([pooled, pool(carry[:, n:], axis=1, keepdims=True)], axis=1)
+            n = carry.shape[1]
+        self.carry[level] = carry[:, n:]
+        if pooled.shape[1] > 0:
+            self.push(level + 1, pooled)
+
+    def close(self):
+        """ Pool incomplete groups and write incomplete tiles, from the finest level """
+        for level in range(self.config['n_levels']):
+            self.push(level, np.zeros((len(self.config['fn']), 0)), last=True)
+
+    def _write_tile(self, level, power):
+        db_range = self.config['db_range']
+        with np.errstate(divide='ignore'):
+            db = np.clip(10 * np.log10(power), -db_range, 0)
+        tile = np.round((db + db_range) * 255 / db_range).astype(np.uint8)
+        fname = os.path.join(self.path_save, f'level_{level:02d}',
+                             f'tile_{self.n_tiles[level]:06d}.npy')
+        np.save(fname, tile)
+        self.n_tiles[level] += 1
+        self.n_columns[level] += tile.shape[1]
+
+#%%
+def load_pyramid(path_pyramid):
+    """ Description of a pyramid saved by build_pyramid """
+    with open(os.path.join(path_pyramid, PYRAMID_CONFIG)) as f:
+        return json.load(f)
+
+def read_pyramid(path_pyramid, tlims=None, max_columns=2000, level=None):
+    """ Spectrogram of a time window from a pyramid, at the finest level that fits
+
+    Parameters
+    ----------
+    path_pyramid : str
+        Directory of the pyramid.
+    tlims : list, optional
+        Start and end of the window in seconds, by default the whole recording.
+    max_columns : int, optional
+        Maximum number of time columns returned, used to select the level, by default 2000
+    level : int, optional
+        Level to read, by default the finest level with at most max_columns columns.
+
+    Returns
+    -------
+    Sxx_db : 2d numpy array
+        Spectrogram in dB as (frequencies, times).
+    tn : 1d numpy array
+        Start time of each column in seconds.
+    fn : 1d numpy array
+        Frequency vector.
+    ext : list
+        Extent of the spectrogram.
+    """
+    config = load_pyramid(path_pyramid)
+    fs, hop = config['sample_rate'], config['nperseg'] - config['noverlap']
+    tile_size, factor, db_range = config['tile_size'], config['factor'], config['db_range']
+    duration = config['n_columns'][0] * hop / fs
+    tmin, tmax = (0, duration) if tlims is None else tlims
+
+    # Columns of level 0 in the window, and the finest level with few enough columns
+    start0 = max(int(np.floor(tmin * fs / hop)), 0)
+    stop0 = min(int(np.ceil(tmax * fs / hop)), config['n_columns'][0])
+    if level is None:
+        level = 0
+        while (level + 1 < config['n_levels']
+               and np.ceil((stop0 - start0) / factor**level) > max_columns):
+            level += 1
+    scale = factor**level
+    start = start0 // scale
+    stop = min(-(-stop0 // scale), config['n_columns'][level])
+
+    # Read only the tiles overlapping the window
+    tiles = []
+    for idx in range(start // tile_size, -(-stop // tile_size)):
+        fname = os.path.join(path_pyramid, f'level_{level:02d}', f'tile_{idx:06d}.npy')
+        tile = np.load(fname, mmap_mode='r')
+        lo = max(start - idx * tile_size, 0)
+        hi = min(stop - idx * tile_size, tile.shape[1])
+        tiles.append(np.asarray(tile[:, lo:hi]))
+    fn = np.array(config['fn'])
+    if tiles:
+        Sxx_db = np.concatenate(tiles, axis=1).astype(np.float32) * db_range / 255 - db_range
+    else:
+        Sxx_db = np.zeros((len(fn), 0), np.float32)
+    tn = np.arange(start, start + Sxx_db.shape[1]) * scale * hop / fs
+    end = min((start + Sxx_db.shape[1]) * scale, config['n_columns'][0]) * hop / fs
+    ext = [start * scale * hop / fs, end, fn[0], fn[-1]]
+    return Sxx_db, tn, fn, ext
@@ -0,0 +1,212 @@
+""" Utility functions to render plots of many files
+
+Figures are created with the object-oriented API of matplotlib and saved with the Agg
+canvas, so rendering does not depend on the pyplot state nor on a display, and can run
+in worker processes. Batches skip outputs newer than their input and report the status
+of each file instead of stopping on the first error.
+"""
+import os
+import shutil
+import traceback
+import pandas as pd
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from maad import util
+from maad.features import plot_graph
+from pamflow.preprocess.utils import bounded_map
+from pamflow.preprocess.spectrogram import get_spectrogram
+from pamflow.plot.pyramid import load_pyramid, read_pyramid
+
+#%%
+def render_spectrogram(
+        path_audio, fname_save, nperseg=1024, noverlap=512, db_range=80, flims=None,
+        cmap='viridis', fig_width=15, fig_height=4, path_cache=None, cache_size=None):
+    """ Save the spectrogram of an audio file as an image
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    fname_save : str
+        Path of the image, the format is given by the extension.
+    nperseg : int, optional
+        Window length of each segment to compute the spectrogram, by default 1024
+    noverlap : int, optional
+        Number of samples to overlap between segments, by default 512
+    db_range : float, optional
+        Dynamic range of the spectrogram in decibels, by default 80
+    flims : list, optional
+        Minimum and maximum frequencies to plot, by default the whole spectrogram
+    cmap : str, optional
+        Colormap, by default 'viridis'
+    fig_width, fig_height : float, optional
+        Size of the figure in inches, by default 15 and 4
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default None
+    cache_size : float, optional
+        Maximum size of the spectrogram cache in GB, by default None
+    """
+    Sxx, _, _, ext, _ = get_spectrogram(
+        path_audio, nperseg=nperseg, noverlap=noverlap, mode='psd', flims=flims,
+        path_cache=path_cache, max_size=cache_size, outputs=('spectrogram',))
+    ext[2], ext[3] = ext[2]/1000, ext[3]/1000
+    fig = Figure(figsize=(fig_width, fig_height))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    util.plot_spectrogram(Sxx, ext, db_range=db_range, ax=ax, colorbar=False, cmap=cmap)
+    ax.set_ylabel('Frequency (kHz)')
+    ax.set_xlabel('Time (s)')
+    fig.savefig(fname_save)
+
+def render_graph(fname_graph, fname_save):
+    """ Save a graphical soundscape stored as csv as an image
+
+    Parameters
+    ----------
+    fname_graph : str
+        Path to the graphical soundscape, with time as index and frequency bins as columns.
+    fname_save : str
+        Path of the image, the format is given by the extension.
+    """
+    graph = pd.read_csv(fname_graph, index_col=0)
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    plot_graph(graph, ax=fig.subplots())
+    fig.savefig(fname_save, bbox_inches='tight')
+
+def render_pyramid(
+        path_pyramid, fname_save, tlims=None, flims=None, max_columns=2000, cmap='viridis',
+        fig_width=15, fig_height=4):
+    """ Save a time window of a spectrogram pyramid as an image
+
+    Only the tiles of the window are read, at the finest level with at most max_columns
+    columns, so memory does not depend on the length of the recording.
+
+    Parameters
+    ----------
+    path_pyramid : str
+        Directory of the pyramid, see pamflow.plot.pyramid.build_pyramid.
+    fname_save : str
+        Path of the image, the format is given by the extension.
+    tlims : list, optional
+        Start and end of the window in seconds, by default the whole recording.
+    flims : list, optional
+        Minimum and maximum frequencies to plot, by default the whole spectrogram
+    max_columns : int, optional
+        Maximum number of time columns drawn, by default 2000
+    cmap : str, optional
+        Colormap, by default 'viridis'
+    fig_width, fig_height : float, optional
+        Size of the figure in inches, by default 15 and 4
+    """
+    Sxx_db, tn, fn, ext = read_pyramid(path_pyramid, tlims, max_columns)
+    if flims is not None:
+        band = (fn >= flims[0]) & (fn <= flims[1])
+        Sxx_db, fn = Sxx_db[band], fn[band]
+        ext = [ext[0], ext[1], fn[0], fn[-1]]
+    ext = [ext[0], ext[1], ext[2]/1000, ext[3]/1000]
+    fig = Figure(figsize=(fig_width, fig_height))
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    util.plot_spectrogram(Sxx_db, ext, log_scale=False, ax=ax, colorbar=False, cmap=cmap,
+                          vmin=-load_pyramid(path_pyramid)['db_range'], vmax=0, aspect='auto')
+    ax.set_ylabel('Frequency (kHz)')
+    ax.set_xlabel('Time (s)')
+    fig.savefig(fname_save)
+
+#%%
+def output_fname(fname, path_save=None, extension='.png', root=None):
+    """ Path of the output of a file, next to the file or in path_save
+
+    If root is given, outputs in path_save mirror the path of the file relative to root,
+    so files with the same name in different folders have different outputs.
+    """
+    fname_save = os.path.splitext(str(fname))[0] + extension
+    if path_save is not None:
+        if root is None:
+            fname_save = os.path.basename(fname_save)
+        else:
+            fname_save = os.path.relpath(fname_save, root)
+        fname_save = os.path.join(path_save, fname_save)
+    return fname_save
+
+def is_up_to_date(fname, fname_save):
+    """ True if the output exists and is not older than its input """
+    return (os.path.exists(fname_save)
+            and os.path.getmtime(fname_save) >= os.path.getmtime(fname))
+
+def _render_file(render, fname, fname_save, kwargs):
+    """ Render a file and return its status, errors are reported instead of raised """
+    # Write to a temporary file, so interrupted renders are not taken as up to date
+    root, extension = os.path.splitext(fname_save)
+    fname_tmp = f'{root}.tmp{extension}'
+    try:
+        render(fname, fname_tmp, **kwargs)
+        if os.path.isdir(fname_save):  # outputs such as pyramids are directories
+            shutil.rmtree(fname_save)
+        os.replace(fname_tmp, fname_save)
+        return 'done', None
+    except Exception as error:
+        if os.path.isdir(fname_tmp):
+            shutil.rmtree(fname_tmp)
+        elif os.path.isfile(fname_tmp):
+            os.remove(fname_tmp)
+        print(f'Error rendering {fname}: {error}')
+        return 'failed', ''.join(traceback.format_exception_only(type(error), error)).strip()
+
+def render_batch(render, flist, path_save=None, overwrite=False, n_jobs=1, extension='.png',
+                 root=None, **kwargs):
+    """ Render the images, or other outputs such as pyramids, of a list of files with a
+    pool of processes
+
+    Parameters
+    ----------
+    render : function
+        Function called as render(fname, fname_save, **kwargs), such as render_spectrogram,
+        render_graph or pamflow.plot.pyramid.build_pyramid.
+    flist : list
+        Paths to the input files.
+    path_save : str, optional
+        Directory to save outputs, by default next to the input files.
+    overwrite : bool, optional
+        Render outputs that are newer than their input, by default False
+    n_jobs : int, optional
+        Number of processes, -1 uses all processors, by default 1
+    extension : str, optional
+        Replaces the extension of input files to name outputs, by default '.png'
+    root : str, optional
+        Directory of the input files, outputs in path_save mirror the folders of the
+        input files below root. By default outputs are named by the input file name.
+    **kwargs
+        Parameters of render.
+
+    Returns
+    -------
+    pandas DataFrame
+        Input, output, status ('done', 'skipped' or 'failed') and error of each file.
+    """
+    df = pd.DataFrame({'fname': [str(fname) for fname in flist]})
+    df['fname_save'] = [output_fname(fname, path_save, extension, root) for fname in df['fname']]
+    duplicated = df['fname_save'].duplicated(keep=False)
+    if duplicated.any():
+        raise ValueError(f'{duplicated.sum()} files have the same output, e.g. '
+                         f'{df.loc[duplicated, "fname_save"].iloc[0]}. Set root to the '
+                         'directory of the input files to mirror its folders.')
+    for path in df['fname_save'].map(os.path.dirname).unique():
+        if path:
+            os.makedirs(path, exist_ok=True)
+    df['status'] = 'skipped'
+    df['error'] = None
+
+    todo = df.index if overwrite else df.index[
+        [not is_up_to_date(fname, fname_save)
+         for fname, fname_save in zip(df['fname'], df['fname_save'])]]
+    print(f'{len(todo)} of {len(df)} files to render...')
+    tasks = ((render, df.at[idx, 'fname'], df.at[idx, 'fname_save'], kwargs) for idx in todo)
+    results = bounded_map(_render_file, tasks, n_jobs)
+    for n_done, (position, (status, error)) in enumerate(results, start=1):
+        idx = todo[position]
+        df.at[idx, 'status'] = status
+        df.at[idx, 'error'] = error
+        print(f'Rendered {n_done} of {len(todo)} files', end='\r')
+    return df
@@ -16,6 +16,10 @@ from pamflow.preprocess.utils import (
     audio_timelapse,
     build_folder_structure,
     input_validation,
+    get_audio_metadata,
+    print_damaged_files,
+    write_metadata_store,
+    select_shard,
     )
 
 
@@ -28,8 +32,10 @@ if __name__ == "__main__":
             "build_folder_structure",
             "add_file_prefix",
             "get_audio_metadata", 
+            "check_audio_files",
             "metadata_summary",
             "select_metadata",
+            "metadata_store",
             "audio_timelapse",
             ], 
         help="Preprocessing operation")
@@ -46,43 +52,59 @@ if __name__ == "__main__":
                         action="store_true", help="Enable quiet mode")
     parser.add_argument( "--sites", "-s", nargs="+", default=None,
                     help="Specify sites to execute the operation (default: None)")
+    parser.add_argument("--index", type=str, default=None,
+                        help="Path to the metadata index used to skip unchanged files "
+                             "(default: hidden csv file in the input directory)")
+    parser.add_argument("--file_index", type=str, default=None,
+                        help="Path to a json file to persist directory listings between runs (default: None)")
+    parser.add_argument("--n_jobs", "-j", type=int, default=-1,
+                        help="Number of threads to list directories and read audio headers (default: all processors)")
+    parser.add_argument("--date_range", nargs=2, default=None,
+                        help="Start and end dates formated as YYYY-MM-DD (default: None)")
+    parser.add_argument("--shard", type=str, default=None,
+                        help="Build timelapses only for sites of shard i of N, formated as i/N. "
+                             "Sites are assigned to shards by a hash of their name (default: None)")
     args = parser.parse_args()
 
     verbose = 0 if args.quiet else 1
     select_sites = args.sites
 
     if args.operation == "get_audio_metadata":
-        df = util.get_metadata_dir(args.input, verbose)
+        df = get_audio_metadata(args.input, args.index, args.n_jobs, verbose, args.file_index)
         df.dropna(inplace=True)  # remove problematic files
         df.to_csv(args.output, index=False)
+
+    elif args.operation == "check_audio_files":
+        df = print_damaged_files(args.input, args.n_jobs)
+        print(f'Number of damaged files: {len(df)}')
+        if args.output is not None:
+            df.to_csv(args.output, index=False)
     
     elif args.operation == "build_folder_structure":
         build_folder_structure(args.input)
 
     elif args.operation == "add_file_prefix":
-        _ = add_file_prefix(args.input, args.recursive, verbose)
+        _ = add_file_prefix(args.input, args.recursive, verbose, args.n_jobs, args.file_index)
     
     elif args.operation == "audio_timelapse":
         config = load_config(args.config)
         date_range = config['preprocessing']['date_range']
         sample_length = config['preprocessing']['sample_length']
+        sample_period = config['preprocessing']['sample_period']
+        n_jobs = config['preprocessing'].get('n_jobs', 1)
         
-        # Load metadata
-        df = input_validation(args.input)
-        
-        # If file list provided filter dataframe
-        if select_sites is None:
-            n_sites = df.groupby('sensor_name').ngroups
-            site_list = df.sensor_name.unique()
-        else:
-            df = df[df['sensor_name'].isin(select_sites)]
-            n_sites = df.groupby('sensor_name').ngroups
-            site_list = df.sensor_name.unique()
+        # Load metadata, if file list provided filter dataframe
+        df = select_metadata(args.input, select_sites, date_range)
+        if args.shard is not None:
+            df = select_shard(df, args.shard, by='sensor_name')
+        n_sites = df.groupby('sensor_name').ngroups
+        site_list = df.sensor_name.unique()
         
         print(f'Computing timelapse from {date_range[0]} to {date_range[1]} over {n_sites} site(s): {site_list}')
 
         audio_timelapse(
-            df, sample_length, sample_period='30T', date_range=date_range, path_save=args.output, save_audio=True, verbose=True)
+            df, sample_length, sample_period=sample_period, date_range=date_range, path_save=args.output,
+            save_audio=True, verbose=True, n_jobs=n_jobs)
     
     elif args.operation == "metadata_summary":
         df = metadata_summary(args.input)
@@ -90,5 +112,8 @@ if __name__ == "__main__":
         print('Process completed successfully')
     
     elif args.operation == "select_metadata":
-        df = select_metadata(args.input)
-        df.to_csv(args.output)
\ No newline at end of file
+        df = select_metadata(args.input, select_sites, args.date_range)
+        df.to_csv(args.output)
+
+    elif args.operation == "metadata_store":
+        write_metadata_store(args.input, args.output, verbose)
\ No newline at end of file
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Audio front end and spectrogram computation shared by acoustic indices, graphical
+soundscapes and plots.
+
+The front end loads audio files, resamples them and applies band filters as
+maad.sound.load, maad.sound.resample with res_type='scipy_poly' and
+maad.sound.select_bandwidth do. Filters are designed once per process for each
+combination of sampling rates and filter parameters, and steps that would not change
+the signal are skipped.
+
+Spectrograms can be stored in an on-disk cache keyed by the content hash of the audio
+file and the parameters used to compute them. Repeated runs with different index,
+peak detection or plotting settings then skip decoding and FFT. The cache has a size
+cap, least recently used entries are removed first. The size of the cache is kept in
+the cache directory and updated under a file lock, so that processes writing to the
+same cache in parallel share it.
+
+"""
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
+from scipy import signal
+from maad import sound, util
+from pamflow.preprocess.utils import read_wav_header, read_audio_segment
+from pamflow.profiling import stage, add_audio
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+    import msvcrt
+
+CACHE_SIZE = 'size'
+CACHE_LOCK = 'size.lock'
+
+#%%
+# -------------------------
+# Front End
+# -------------------------
+@lru_cache(maxsize=None)
+def resample_design(fs, target_fs):
+    """ Polyphase factors and anti-aliasing filter to resample from fs to target_fs
+
+    The filter is the one designed by scipy.signal.resample_poly with default options.
+
+    Returns
+    -------
+    up, down : int
+        Upsampling and downsampling factors.
+    h : 1d numpy array
+        FIR filter coefficients, None if no resampling is needed.
+    """
+    gcd = np.gcd(int(fs), int(target_fs))
+    up, down = int(target_fs) // gcd, int(fs) // gcd
+    if up == down:
+        return 1, 1, None
+    max_rate = max(up, down)
+    h = signal.firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+    return up, down, h
+
+@lru_cache(maxsize=None)
+def filter_design(fs, filter_type, filter_cut, filter_order):
+    """ Second-order sections of the Butterworth filter used by maad.sound.select_bandwidth
+
+    filter_cut must be hashable, a number or a tuple of cutoff frequencies.
+    """
+    Wn = np.asarray(filter_cut, dtype=float) / (fs / 2)
+    return signal.iirfilter(N=filter_order, Wn=Wn, btype=filter_type, ftype='butter',
+                            output='sos')
+
+def _filter_sos(fs, filter_type, filter_cut, filter_order):
+    if isinstance(filter_cut, (list, tuple, np.ndarray)):
+        filter_cut = tuple(float(cut) for cut in filter_cut)
+    return filter_design(fs, filter_type, filter_cut, filter_order)
+
+def resample_audio(s, fs, target_fs):
+    """ Resample a signal as maad.sound.resample with res_type='scipy_poly' """
+    up, down, h = resample_design(fs, target_fs)
+    if h is None:
+        return s
+    return signal.resample_poly(s, up, down, window=h)
+
+def filter_audio(s, fs, filter_type=None, filter_cut=None, filter_order=None):
+    """ Zero-phase Butterworth filter, as maad.sound.select_bandwidth """
+    if filter_type is None:
+        return s
+    return signal.sosfiltfilt(_filter_sos(fs, filter_type, filter_cut, filter_order), s)
+
+def load_audio(path_audio, target_fs=None, filter_type=None, filter_cut=None,
+               filter_order=None):
+    """ Load an audio file, resample and filter
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    target_fs : int, optional
+        Sampling frequency used for analysis, by default the one of the file.
+    filter_type : str, optional
+        Type of filter applied to the signal ('bandpass', 'lowpass' or 'highpass'),
+        by default no filter.
+    filter_cut : float or list, optional
+        Cutoff frequencies of the filter, by default None
+    filter_order : int, optional
+        Order of the filter, by default None
+
+    Returns
+    -------
+    s : 1d numpy array
+        Audio signal, left channel normalized between -1 and 1.
+    fs : int
+        Sampling frequency of the signal.
+    """
+    s, fs = read_audio_segment(path_audio, detrend=False)
+    if target_fs is None:
+        target_fs = fs
+    needs_resample = resample_design(fs, target_fs)[2] is not None
+
+    # Highpass and bandpass filters already remove the DC offset
+    if needs_resample or filter_type not in ('highpass', 'bandpass'):
+        s -= np.mean(s)
+
+    with stage('resample'):
+        s = resample_audio(s, fs, target_fs)
+    with stage('filter'):
+        s = filter_audio(s, target_fs, filter_type, filter_cut, filter_order)
+    return s, target_fs
+
+#%%
+# -------------------------
+# Spectrogram Computation
+# -------------------------
+def get_spectrogram(path_audio, target_fs=None, nperseg=1024, noverlap=0, window='hann',
+                    mode='psd', filter_type=None, filter_cut=None, filter_order=None,
+                    flims=None, path_cache=None, max_size=None,
+                    outputs=('spectrogram', 'envelope')):
+    """ Load, resample, filter and compute the spectrogram of an audio file
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    target_fs : int, optional
+        Sampling frequency used for analysis, by default the one of the file.
+    nperseg : int, optional
+        Window length of each segment, by default 1024
+    noverlap : int, optional
+        Number of samples to overlap between segments, by default 0
+    window : str, optional
+        Window function, by default 'hann'
+    mode : str, optional
+        Spectrogram output, 'psd' or 'amplitude', by default 'psd'
+    filter_type : str, optional
+        Type of filter applied to the signal ('bandpass', 'lowpass' or 'highpass'),
+        by default no filter.
+    filter_cut : float or list, optional
+        Cutoff frequencies of the filter, by default None
+    filter_order : int, optional
+        Order of the filter, by default None
+    flims : list, optional
+        Frequency limits to crop the spectrogram, by default None
+    path_cache : str, optional
+        Directory of the spectrogram cache, by default the cache is not used.
+    max_size : float, optional
+        Maximum size of the cache in GB, by default no limit.
+    outputs : tuple of str, optional
+        Outputs to compute and cache, 'spectrogram' and/or 'envelope', by default both.
+        Outputs not selected are returned as None.
+
+    Returns
+    -------
+    Sxx : 2d numpy array
+        Spectrogram
+    tn : 1d numpy array
+        Time vector
+    fn : 1d numpy array
+        Frequency vector
+    ext : list
+        Extent of the spectrogram
+    env : 1d numpy array
+        Envelope of the signal computed with maad.sound.envelope using frames of 512
+        samples, used to compute temporal indices without the waveform.
+    """
+    params = {
+        'target_fs': target_fs, 'nperseg': nperseg, 'noverlap': noverlap, 'window': window,
+        'mode': mode, 'filter_type': filter_type, 'filter_cut': filter_cut,
+        'filter_order': filter_order, 'outputs': sorted(outputs)}
+
+    spec = None
+    if path_cache is not None:
+        with stage('cache'):
+            key = cache_key(path_audio, params, path_cache)
+            spec = cache_get(path_cache, key)
+
+    if spec is None:
+        spec = _compute_spectrogram(path_audio, **params)
+        if path_cache is not None:
+            with stage('cache'):
+                cache_put(path_cache, key, spec, max_size)
+
+    # Audio is counted for cache hits too, so throughput does not depend on the cache
+    Sxx, tn, fn, ext, env, duration = spec
+    add_audio(duration)
+    if flims is not None and Sxx is not None:
+        Sxx, tn, fn = util.crop_image(Sxx, tn, fn, fcrop=flims)
+        ext = [tn[0], tn[-1], fn[0], fn[-1]]
+    return Sxx, tn, fn, ext, env
+
+def _compute_spectrogram(path_audio, target_fs, nperseg, noverlap, window, mode,
+                         filter_type, filter_cut, filter_order, outputs):
+    """ Compute spectrogram, envelope and duration in seconds of an audio file, see
+    get_spectrogram """
+    s, target_fs = load_audio(path_audio, target_fs, filter_type, filter_cut, filter_order)
+    Sxx, tn, fn, ext, env = None, None, None, None, None
+    if 'spectrogram' in outputs:
+        with stage('stft'):
+            Sxx, tn, fn, ext = sound.spectrogram(
+                s, target_fs, window=window, nperseg=nperseg, noverlap=noverlap, mode=mode)
+        ext = list(ext)
+    if 'envelope' in outputs:
+        with stage('envelope'):
+            env = sound.envelope(s, mode='fast', Nt=512)
+    return Sxx, tn, fn, ext, env, len(s) / target_fs
+
+#%%
+# -------------------------
+# Streaming
+# -------------------------
+def iter_audio_windows(path_audio, window=60, target_fs=None, filter_type=None,
+                       filter_cut=None, filter_order=None):
+    """ Read an audio file in consecutive windows, resampled and filtered
+
+    Only one window is kept in memory, so long continuous recordings can be processed
+    with bounded memory. Resampling reads a margin of samples around each window, so
+    windows join without edge effects. The filter state is carried from one window to
+    the next. Since a zero-phase filter cannot be applied block by block, the Butterworth
+    filter is applied twice forward, which has the same magnitude response as the
+    zero-phase filter used for whole files (maad.sound.select_bandwidth) and only differs
+    in phase. The DC offset is removed from each window.
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    window : float, optional
+        Length of the windows in seconds, by default 60
+    target_fs : int, optional
+        Sampling frequency used for analysis, by default the one of the file.
+    filter_type : str, optional
+        Type of filter applied to the signal ('bandpass', 'lowpass' or 'highpass'),
+        by default no filter.
+    filter_cut : float or list, optional
+        Cutoff frequencies of the filter, by default None
+    filter_order : int, optional
+        Order of the filter, by default None
+
+    Yields
+    ------
+    offset : float
+        Start of the window in seconds from the beginning of the file.
+    s : 1d numpy array
+        Audio signal of the window at target_fs. The last window may be shorter.
+    """
+    header = read_wav_header(path_audio)
+    if header['error'] is not None:
+        raise ValueError(f"Cannot read {path_audio}: {header['error']}")
+    fs, n_samples = header['sample_rate'], header['samples']
+    if target_fs is None:
+        target_fs = fs
+
+    # Resampling factors and margin in samples of the file, multiple of down to keep
+    # windows aligned with samples at target_fs
+    up, down, h = resample_design(fs, target_fs)
+    margin = 0
+    if up != down:
+        margin = int(np.ceil(10 * max(up, down) / up / down) + 1) * down
+    step = int(round(window * fs / down)) * down
+
+    if filter_type is not None:
+        sos = _filter_sos(target_fs, filter_type, filter_cut, filter_order)
+        sos = np.vstack([sos, sos])
+        zi = np.zeros((sos.shape[0], 2))
+
+    for start in range(0, n_samples, step):
+        stop = min(start + step, n_samples)
+        if margin == 0:
+            s, _ = read_audio_segment(path_audio, start / fs, stop / fs, detrend=False)
+            add_audio(len(s) / fs)
+        else:
+            # Read margins around the window and remove them after resampling
+            read_start = max(start - margin, 0)
+            read_stop = min(stop + margin, n_samples)
+            s, _ = read_audio_segment(path_audio, read_start / fs, read_stop / fs, detrend=False)
+            add_audio((stop - start) / fs)
+            with stage('resample'):
+                s = signal.resample_poly(s, up, down, window=h)
+                trim = (start - read_start) * up // down
+                s = s[trim:trim + int(np.ceil((stop - start) * up / down))]
+
+        if filter_type is not None:
+            with stage('filter'):
+                s, zi = signal.sosfilt(sos, s, zi=zi)
+        yield start / fs, s - np.mean(s)
+
+#%%
+# -------------------------
+# Cache Functions
+# -------------------------
+def file_hash(path_audio, path_cache=None):
+    """ Content hash of a file
+
+    The hash is computed reading the whole file. When a cache directory is provided,
+    hashes are memoized by path, size and modification time, so unchanged files are
+    read only once.
+    """
+    st = os.stat(path_audio)
+    if path_cache is not None:
+        stat_key = hashlib.blake2b(
+            f'{os.path.abspath(path_audio)}|{st.st_size}|{st.st_mtime_ns}'.encode(),
+            digest_size=16).hexdigest()
+        fname_memo = os.path.join(path_cache, 'hashes', stat_key[:2], stat_key)
+        if os.path.isfile(fname_memo):
+            with open(fname_memo, 'r') as f:
+                return f.read()
+
+    h = hashlib.blake2b(digest_size=20)
+    with open(path_audio, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    content_hash = h.hexdigest()
+
+    if path_cache is not None:
+        _atomic_write(fname_memo, content_hash.encode())
+    return content_hash
+
+def cache_key(path_audio, params, path_cache=None):
+    """ Cache key from the content hash of the audio file and the spectrogram parameters """
+    params = json.dumps(params, sort_keys=True, default=str)
+    content_hash = file_hash(path_audio, path_cache)
+    return hashlib.blake2b(f'{content_hash}|{params}'.encode(), digest_size=20).hexdigest()
+
+def cache_get(path_cache, key):
+    """ Get a spectrogram from the cache, None if not found """
+    fname = _entry_path(path_cache, key)
+    try:
+        with np.load(fname) as entry:
+            # Outputs that were not computed are not saved
+            spec = [entry[name] if name in entry.files else None
+                    for name in ['Sxx', 'tn', 'fn', 'ext', 'env']]
+            spec.append(float(entry['duration']))
+    except (OSError, ValueError, KeyError):
+        return None
+    # Mark as recently used
+    try:
+        os.utime(fname)
+    except OSError:
+        pass
+    if spec[3] is not None:
+        spec[3] = list(spec[3])
+    return tuple(spec)
+
+def cache_put(path_cache, key, spec, max_size=None):
+    """ Save a spectrogram in the cache and evict old entries if max_size (GB) is exceeded """
+    Sxx, tn, fn, ext, env, duration = spec
+    fname = _entry_path(path_cache, key)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    fname_tmp = f'{fname}.{os.getpid()}.tmp'
+    arrays = {'Sxx': Sxx, 'tn': tn, 'fn': fn, 'ext': ext, 'env': env, 'duration': duration}
+    with open(fname_tmp, 'wb') as f:
+        np.savez(f, **{name: np.asarray(value) for name, value in arrays.items()
+                       if value is not None})
+    os.replace(fname_tmp, fname)
+
+    if max_size is not None:
+        with _cache_lock(path_cache):
+            if _update_cache_size(path_cache, os.path.getsize(fname)) > max_size * 1e9:
+                _write_cache_size(path_cache, _evict(path_cache, 0.9 * max_size))
+
+def evict_cache(path_cache, max_size):
+    """ Remove least recently used entries until the cache is smaller than max_size (GB)
+
+    Returns
+    -------
+    int
+        Size of the cache in bytes after eviction
+    """
+    with _cache_lock(path_cache):
+        total = _evict(path_cache, max_size)
+        _write_cache_size(path_cache, total)
+    return total
+
+def _evict(path_cache, max_size):
+    """ Remove least recently used entries with the size of entries on disk, the cache
+    lock must be held """
+    entries = _list_entries(path_cache)
+    entries.sort(key=lambda entry: entry[1])
+    total = sum(entry[2] for entry in entries)
+    for fname, _, size in entries:
+        if total <= max_size * 1e9:
+            break
+        try:
+            os.remove(fname)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+def _update_cache_size(path_cache, nbytes):
+    """ Add the size of a new entry to the size shared by processes, the cache lock must
+    be held
+
+    The cache is scanned only if the size was never saved. Entries written by other
+    processes during a scan may be counted twice, which only brings the next eviction
+    forward: evictions use the size of the entries on disk.
+    """
+    fname = os.path.join(path_cache, CACHE_SIZE)
+    try:
+        with open(fname, 'r') as f:
+            total = int(f.read()) + nbytes
+    except (OSError, ValueError):
+        total = sum(entry[2] for entry in _list_entries(path_cache))
+    _write_cache_size(path_cache, total)
+    return total
+
+def _write_cache_size(path_cache, total):
+    _atomic_write(os.path.join(path_cache, CACHE_SIZE), str(int(total)).encode())
+
+@contextmanager
+def _cache_lock(path_cache):
+    """ Exclusive lock of the size of a cache, blocking other processes """
+    os.makedirs(path_cache, exist_ok=True)
+    with open(os.path.join(path_cache, CACHE_LOCK), 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _list_entries(path_cache):
+    """ List cache entries as tuples (path, modification time, size) """
+    entries = []
+    if not os.path.isdir(path_cache):
+        return entries
+    for subdir in os.scandir(path_cache):
+        if not subdir.is_dir() or subdir.name == 'hashes':
+            continue
+        for entry in os.scandir(subdir.path):
+            if entry.name.endswith('.npz'):
+                st = entry.stat()
+                entries.append((entry.path, st.st_mtime, st.st_size))
+    return entries
+
+def _entry_path(path_cache, key):
+    return os.path.join(path_cache, key[:2], f'{key}.npz')
+
+def _atomic_write(fname, data):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    fname_tmp = f'{fname}.{os.getpid()}.tmp'
+    with open(fname_tmp, 'wb') as f:
+        f.write(data)
+    os.replace(fname_tmp, fname)
@@ -5,18 +5,47 @@ Utilitary functions to manage, check and preprocess large sampling data assiciat
 
 """
 import os
+import json
+import hashlib
+import wave
+import struct
 import argparse
+import itertools
+import concurrent.futures
 import shutil
 import pandas as pd
 import numpy as np
 import glob
 import yaml
 from pathlib import Path
-from os import listdir
 from maad import sound, util
+from pamflow.profiling import stage
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import seaborn as sns
 
+# Columns of the metadata dataframe, as returned by maad.util.get_metadata_dir
+METADATA_COLUMNS = [
+    'path_audio', 'fname', 'sample_rate', 'channels', 'bits', 'samples', 'length',
+    'fsize', 'sensor_name', 'date', 'time']
+METADATA_DTYPES = {
+    'sample_rate': 'Int64', 'channels': 'Int64', 'bits': 'Int64', 'samples': 'Int64',
+    'length': 'float64', 'fsize': 'Int64'}
+METADATA_INDEX_DTYPES = {
+    'path_audio': str, 'fname': str, 'sensor_name': str, 'date': str, 'time': str}
+METADATA_INDEX_FNAME = '.pamflow_metadata_index.csv'
+METADATA_STORE_MANIFEST = '_partitions.csv'
+
+# Columns and types of the dataframe returned by inspect_wav_files
+WAV_HEADER_COLUMNS = [
+    'path_audio', 'fname', 'sample_rate', 'channels', 'bits', 'samples', 'length',
+    'fsize', 'truncated', 'error']
+WAV_HEADER_DTYPES = {
+    'sample_rate': 'Int64', 'channels': 'Int64', 'bits': 'Int64', 'samples': 'Int64',
+    'length': 'float64', 'fsize': 'Int64', 'truncated': 'bool', 'error': 'string'}
+
 # ----------------------------------
 # Main Utilities For Other Functions
 # ----------------------------------
@@ -33,13 +62,16 @@ def input_validation(data_input):
         return data_input
 
     elif isinstance(data_input, str):
-        if os.path.isdir(data_input):
+        if os.path.isdir(data_input) and is_metadata_store(data_input):
+            print('Loading metadata from metadata store')
+            return read_metadata_store(data_input)
+        elif os.path.isdir(data_input):
             print('Collecting metadata from directory path')
-            return util.get_metadata_dir(data_input, verbose=True)
+            return get_audio_metadata(data_input, verbose=True)
         elif os.path.isfile(data_input) and data_input.lower().endswith(".csv"):
             print('Loading metadata from csv file')
             try:
-                return pd.read_csv(data_input) 
+                return pd.read_csv(data_input, dtype={'sensor_name': str, 'time': str})
             except FileNotFoundError:
                 raise FileNotFoundError(f"File not found: {data_input}")
     
@@ -56,42 +88,39 @@ def date_validation(date_str):
 # ------------------------
 # Visualization Functions
 # ------------------------
-def plot_sensor_deployment(df, x='sensor_name', y='date', ax=None):
+def plot_sensor_deployment(df, x='sensor_name', y='date', ax=None, raster=False):
     """ Plot sensor deployment to have an overview of the sampling
 
     Parameters
     ----------
-    df : pandas DataFrame
+    df : pandas DataFrame or string with path to a csv file or metadata store
         The dataframe must have the columns site, date, sample_length.
         Use maad.util.get_audio_metadata to compile the dataframe.
     ax : matplotlib.axes, optional
         Matplotlib axes fot the figure, by default None
+    raster : bool, optional
+        Draw the number of recordings per site and day as a single image instead of one
+        point per site and day, for deployments with many sites, see
+        plot_deployment_raster. By default False
 
     Returns
     -------
     matplotlib.figure
         If axes are not provided, a figure is created and figure handles are returned.
     """
-    # Function argument validation
-    df = input_validation(df)
-    
+    if raster:
+        return plot_deployment_raster(df, ax=ax)
+
     # Group recordings by day
-    df['date'] = pd.to_datetime(df['date']).dt.date
-    df_out = df.groupby(['sensor_name', 'date']).size().reset_index(name='count')
-    df_out.sort_values(by=['sensor_name', 'date'], inplace=True)
+    df_site, df_out = aggregate_metadata(df)
     
     # Reorder sites according to first recording
-    # Calculate the first date for each site
-    first_date_per_site = df_out.groupby('sensor_name')['date'].min().reset_index()
-    first_date_per_site = first_date_per_site.rename(columns={'date': 'first_date'})
-
-    # Merge the first date information back to the original DataFrame
-    df_out = df_out.merge(first_date_per_site, on='sensor_name')
-
-    # Sort the DataFrame based on the first date
-    df_out = df_out.sort_values(by='first_date')
+    first_date_per_site = df_site.set_index('sensor_name')['date_ini']
+    df_out['first_date'] = df_out['sensor_name'].map(first_date_per_site)
+    df_out = df_out.sort_values(by=['first_date', 'sensor_name', 'date'], kind='stable')
 
     # Plot dataframe
+    show = ax is None
     if ax == None:
         _, ax = plt.subplots(figsize=[8,5])
 
@@ -104,17 +133,186 @@ def plot_sensor_deployment(df, x='sensor_name', y='date', ax=None):
         
     ax.grid(alpha=0.2)
     ax.set_title(
-        f'Sensor Deployment: {df.sensor_name.unique().shape[0]} sites | {df.shape[0]} files')
+        f'Sensor Deployment: {df_site.shape[0]} sites | {df_site.n_recordings.sum()} files')
     plt.xticks(rotation=45)
     plt.legend(
         bbox_to_anchor=(1.05, 1), loc='upper left', borderaxespad=0, title='N. Rec')
     plt.tight_layout()
-    plt.show()
+    if show:
+        plt.show()
+
+def plot_deployment_raster(df, ax=None, chunksize=1000000):
+    """ Plot the number of recordings per site and day as a single image
+
+    Sites are columns, sorted by first recording as in plot_sensor_deployment, and days
+    are rows. Days without recordings are left blank. The figure is built without pyplot,
+    so it can be saved without a display.
+
+    Parameters
+    ----------
+    df : pandas DataFrame or str
+        Metadata dataframe, path to a csv file, to a metadata store or to an audio
+        directory, see deployment_matrix.
+    ax : matplotlib.axes, optional
+        Matplotlib axes for the figure, by default None
+    chunksize : int, optional
+        Number of rows processed at once, by default 1000000
+
+    Returns
+    -------
+    matplotlib.figure
+        Figure of the plot.
+    """
+    counts, sites, days = deployment_matrix(df, chunksize)
+    if ax is None:
+        fig = Figure(figsize=[8, 5])
+        FigureCanvasAgg(fig)
+        ax = fig.subplots()
+    fig = ax.get_figure()
+
+    # Pixel edges on the date axis, so that each day's row is centred on its date as with
+    # the scatter plot
+    extent = [-0.5, len(sites) - 0.5, 0, 1]
+    if len(days):
+        extent[2:] = mdates.date2num([days[0] - pd.Timedelta(hours=12),
+                                      days[-1] + pd.Timedelta(hours=12)])
+    image = ax.imshow(np.ma.masked_equal(counts.T, 0), aspect='auto', origin='lower',
+                      interpolation='nearest', extent=extent, cmap='viridis')
+    fig.colorbar(image, ax=ax, label='N. Rec')
+
+    # Label a bounded number of days, ticks at midnight are at the centre of the rows
+    ax.yaxis.set_major_locator(mdates.DayLocator(interval=max(len(days) // 15, 1)))
+    ax.yaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+
+    # Label a bounded number of sites
+    step = max(len(sites) // 40, 1)
+    ax.set_xticks(np.arange(0, len(sites), step))
+    ax.set_xticklabels(sites[::step], rotation=45, ha='right', fontsize='small')
+    ax.set_xlabel('sensor_name')
+    ax.set_ylabel('date')
+    ax.set_title(f'Sensor Deployment: {len(sites)} sites | {counts.sum()} files')
+    fig.tight_layout()
+    return fig
 
 #%%
 # ------------------------
 # File Managment Functions
 # ------------------------
+def scan_files(folder_path, extensions=None, recursive=True, hidden=False, n_jobs=1,
+               path_index=None):
+    """ Iterate over files in a directory using os.scandir
+
+    Files are yielded as soon as their directory is listed. With n_jobs > 1, directories
+    are listed concurrently on a thread pool, which speeds up slow drives and network
+    storage. Optionally, directory listings are persisted in a file index: directories
+    whose modification time did not change since the last scan are not listed again.
+
+    Parameters
+    ----------
+    folder_path : str or Path
+        Directory to start the search in.
+    extensions : str or list, optional
+        File extensions to keep (e.g. '.wav'), case insensitive. By default all files.
+    recursive : bool, optional
+        Search files in sub-directories, by default True
+    hidden : bool, optional
+        Include hidden files and directories (starting with '.'), by default False
+    n_jobs : int, optional
+        Number of threads to list directories, -1 uses all processors, by default 1
+    path_index : str, optional
+        Path to a json file used to persist directory listings, by default None
+
+    Yields
+    ------
+    str
+        Path to each file found. Order is not guaranteed.
+    """
+    if isinstance(extensions, str):
+        extensions = [extensions]
+    if extensions is not None:
+        extensions = tuple(ext.lower() for ext in extensions)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    def keep(name):
+        if not hidden and name.startswith('.'):
+            return False
+        return extensions is None or name.lower().endswith(extensions)
+
+    index = _load_file_index(path_index)
+    index_new = dict()
+    root = os.fspath(folder_path)
+
+    if n_jobs == 1 or not recursive:
+        pending = [root]
+        while pending:
+            dirpath = pending.pop()
+            files, subdirs = _scan_dir(dirpath, index, index_new)
+            yield from (os.path.join(dirpath, name) for name in files if keep(name))
+            if recursive:
+                pending.extend(os.path.join(dirpath, name) for name in subdirs
+                               if hidden or not name.startswith('.'))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {executor.submit(_scan_dir, root, index, index_new): root}
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    dirpath = futures.pop(future)
+                    files, subdirs = future.result()
+                    for name in subdirs:
+                        if hidden or not name.startswith('.'):
+                            subdir = os.path.join(dirpath, name)
+                            futures[executor.submit(_scan_dir, subdir, index, index_new)] = subdir
+                    yield from (os.path.join(dirpath, name) for name in files if keep(name))
+
+    if path_index is not None:
+        index.update(index_new)
+        _save_file_index(path_index, index)
+
+def _scan_dir(dirpath, index, index_new):
+    """ List files and sub-directories of a directory, reusing the index if up to date
+
+    Directories that cannot be read, such as system folders of SD cards or folders
+    removed during the scan, are skipped as with os.walk.
+    """
+    try:
+        mtime = os.stat(dirpath).st_mtime_ns
+        entry = index.get(dirpath)
+        if entry is not None and entry[0] == mtime:
+            files, subdirs = entry[1], entry[2]
+        else:
+            files, subdirs = [], []
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+    except OSError as e:
+        print(f'Warning: directory {dirpath} skipped: {e}')
+        return [], []
+    index_new[dirpath] = [mtime, files, subdirs]
+    return files, subdirs
+
+def _load_file_index(path_index):
+    """ Load directory listings persisted by scan_files """
+    if path_index is None or not os.path.isfile(path_index):
+        return dict()
+    with open(path_index, 'r') as f:
+        return json.load(f)
+
+def _save_file_index(path_index, index):
+    """ Save directory listings, writing to a temporary file first """
+    path_tmp = f'{path_index}.tmp'
+    try:
+        with open(path_tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(path_tmp, path_index)
+    except OSError as e:
+        print(f'File index could not be saved at {path_index}: {e}')
+
 def search_files(directory=".", extension=""):
     """
     Search for files within a specified directory and its subdirectories.
@@ -131,13 +329,8 @@ def search_files(directory=".", extension=""):
         This function uses a recursive approach to search for files in the specified directory and its subdirectories.
         It returns the path to the first matching file it encounters during the search.
     """
-    extension = extension.lower()
-    for dirpath, dirnames, files in os.walk(directory):
-        for name in files:
-            if extension and name.lower().endswith(extension):
-                return os.path.join(dirpath, name)
-            elif not extension:
-                return os.path.join(dirpath, name)
+    extensions = extension if extension else None
+    return next(scan_files(directory, extensions, recursive=True, hidden=True), None)
 
 def listdir_pattern(path_dir, ends_with=None):
     """
@@ -152,13 +345,11 @@ def listdir_pattern(path_dir, ends_with=None):
     Returns
     -------
     """
-    flist = listdir(path_dir)
-
-    new_list = []
-    for names in flist:
-        if names.endswith(ends_with):
-            new_list.append(names)
-    return new_list
+    flist = scan_files(path_dir, recursive=False, hidden=True)
+    flist = [os.path.basename(fname) for fname in flist]
+    if ends_with is None:
+        return flist
+    return [name for name in flist if name.endswith(ends_with)]
 
 def build_folder_structure(root_dir):
     # Define the subdirectories
@@ -194,45 +385,21 @@ def build_folder_structure(root_dir):
     print("Folder structure created successfully.")
 
 #%%
-def find_wav_files(folder_path, recursive=False):
-    """ Search for files with wav or WAV extension """
-    wav_files = []
-    if recursive:
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                if file.lower().endswith('.wav'):
-                    wav_files.append(os.path.join(root, file))
-    else:
-        for file in os.listdir(folder_path):
-                    if file.lower().endswith('.wav'):
-                        wav_files.append(os.path.join(folder_path, file))
-    
-    # Transform the list of strings to a list of Path objects
-    wav_files = [Path(path) for path in wav_files]
-    
-    return wav_files
+def find_wav_files(folder_path, recursive=False, hidden=True, n_jobs=1, path_index=None):
+    """ Search for files with wav or WAV extension, see scan_files for parameters """
+    flist = scan_files(folder_path, '.wav', recursive, hidden, n_jobs, path_index)
+    return [Path(path) for path in flist]
 
 #%%
-def find_files(folder_path, endswith='*', recursive=False):
-    """ Search for files with any extension """
-    files = []
-    if recursive:
-        for root, _, files in os.walk(folder_path):
-            for file in files:
-                if file.lower().endswith(endswith):
-                    files.append(os.path.join(root, file))
-    else:
-        for file in os.listdir(folder_path):
-                    if file.lower().endswith(endswith):
-                        files.append(os.path.join(folder_path, file))
-    
-    # Transform the list of strings to a list of Path objects
-    files = [Path(path) for path in files]
-    
-    return files
+def find_files(folder_path, endswith='*', recursive=False, hidden=True, n_jobs=1, path_index=None):
+    """ Search for files with any extension, see scan_files for parameters """
+    extensions = None if endswith in ('*', '', None) else endswith
+    flist = scan_files(folder_path, extensions, recursive, hidden, n_jobs, path_index)
+    return [Path(path) for path in flist]
 
 #%%
-def add_file_prefix(folder_name: str, recursive:bool=False, verbose:bool=False) -> None:
+def add_file_prefix(folder_name: str, recursive:bool=False, verbose:bool=False, n_jobs:int=1,
+                    path_index:str=None) -> None:
     """
     Adds a prefix to the file names in the given directory.
     The prefix is the name of the immediate parent folder of the files.
@@ -241,16 +408,16 @@ def add_file_prefix(folder_name: str, recursive:bool=False, verbose:bool=False)
     folder_name(str): Name of directory which contains files.
     recursive(bool): If True, searches for files in sub-directories recursively.
                      Defaults to False if not provided.
+    n_jobs(int): Number of threads to list directories. Defaults to 1.
+    path_index(str): Path to a json file index of directory listings, see scan_files.
 
     Returns: None
     """
     folder_path = Path(folder_name)
 
-    # Get list of files to process
-    flist = find_wav_files(folder_path, recursive=recursive)
-    
-    # remove hidden files 
-    flist = [f for f in flist if not f.name.startswith('.')]
+    # Get list of files to process, without hidden files
+    flist = find_wav_files(folder_path, recursive=recursive, hidden=False, n_jobs=n_jobs,
+                           path_index=path_index)
 
     if verbose:
         print(f'Number of WAVE files detected: {len(flist)}')
@@ -312,71 +479,768 @@ def rename_files_time_delay(path_dir, delay_hours=-5, verbose=False):
 # Audio Metadata Functions
 # ------------------------
 
-def print_damaged_files(df):
-    for _, row in df.iterrows():
-        try:
-            util.audio_header(row.path_audio)
-        except:
-            print(row.fname)
+def read_wav_header(path_audio):
+    """ Read the RIFF/WAVE header of an audio file without loading the audio data
+
+    Only chunk headers are read: the file is traversed by seeking over chunk bodies
+    until the 'fmt ' and 'data' chunks are found.
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+
+    Returns
+    -------
+    dict
+        Header information with keys path_audio, fname, sample_rate, channels, bits,
+        samples, length, fsize, truncated and error. When the header cannot be parsed,
+        error holds the reason and audio fields are None. The keys format_tag,
+        block_align and data_offset describe the layout of the audio data.
+    """
+    header = {
+        'path_audio': path_audio,
+        'fname': os.path.basename(path_audio),
+        'sample_rate': None,
+        'channels': None,
+        'bits': None,
+        'samples': None,
+        'length': None,
+        'fsize': None,
+        'truncated': False,
+        'error': None,
+        'format_tag': None,
+        'block_align': None,
+        'data_offset': None}
+    try:
+        header['fsize'] = os.path.getsize(path_audio)
+        with open(path_audio, 'rb') as f:
+            riff = f.read(12)
+            if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+                header['error'] = 'not a RIFF/WAVE file'
+                return header
+
+            # Walk through chunks until the data chunk is reached
+            fmt, data_size, data_offset = None, None, None
+            while True:
+                chunk = f.read(8)
+                if len(chunk) < 8:
+                    break
+                chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+                if chunk_id == b'data':
+                    data_size, data_offset = chunk_size, f.tell()
+                    break
+                elif chunk_id == b'fmt ':
+                    fmt = f.read(min(chunk_size, 40))
+                    f.seek(chunk_size - len(fmt) + chunk_size % 2, os.SEEK_CUR)
+                else:
+                    f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    except OSError as e:
+        header['error'] = e.strerror if e.strerror else str(e)
+        return header
+
+    if fmt is None or len(fmt) < 16:
+        header['error'] = 'missing fmt chunk'
+        return header
+    if data_offset is None:
+        header['error'] = 'missing data chunk'
+        return header
+
+    format_tag, channels, sample_rate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == 0xFFFE and len(fmt) >= 26:  # WAVE_FORMAT_EXTENSIBLE, read subformat
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    if channels == 0 or sample_rate == 0 or block_align == 0:
+        header['error'] = 'invalid fmt chunk'
+        return header
+
+    # Recorders that stop abruptly may leave an unfinished data chunk size
+    available = header['fsize'] - data_offset
+    if data_size == 0 or data_size > available:
+        header['truncated'] = True
+        data_size = available
+
+    samples = data_size // block_align
+    header.update({
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'bits': bits,
+        'samples': samples,
+        'length': samples / sample_rate,
+        'format_tag': format_tag,
+        'block_align': block_align,
+        'data_offset': data_offset})
+    return header
+
+def inspect_wav_files(flist, n_jobs=-1, verbose=False):
+    """ Read the header of many WAVE files in parallel
+
+    Parameters
+    ----------
+    flist : list or pandas Series
+        Paths to the audio files.
+    n_jobs : int, optional
+        Number of threads used to read headers, -1 uses all processors, by default -1
+    verbose : bool, optional
+        Print progress messages, by default False
+
+    Returns
+    -------
+    pandas DataFrame
+        One row per file with columns path_audio, fname, sample_rate, channels, bits,
+        samples, length, fsize, truncated and error.
+    """
+    flist = list(flist)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+
+    # Submit files in batches to keep the number of pending futures bounded
+    headers = []
+    batch_size = 10000
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for idx in range(0, len(flist), batch_size):
+            headers.extend(executor.map(read_wav_header, flist[idx:idx + batch_size]))
+            if verbose:
+                print(f'{len(headers)} / {len(flist)} headers read', end='\r')
+
+    df = pd.DataFrame.from_records(headers, columns=WAV_HEADER_COLUMNS)
+    return df.astype(WAV_HEADER_DTYPES)
+
+def get_audio_metadata(path_dir, path_index=None, n_jobs=-1, verbose=False, path_file_index=None):
+    """ Get audio metadata from a directory using a persistent metadata index
+
+    The index stores the metadata of every WAVE file found in the directory together
+    with its size and modification time. On subsequent calls only new or modified files
+    are read, the remaining rows are taken from the index.
+
+    Parameters
+    ----------
+    path_dir : str
+        Path to the directory with audio files. The search is performed recursively.
+    path_index : str, optional
+        Path to the csv file used as metadata index. By default the index is stored as a
+        hidden file at the root of path_dir.
+    n_jobs : int, optional
+        Number of threads used to list directories and read headers, -1 uses all
+        processors, by default -1
+    verbose : bool, optional
+        Print progress messages, by default False
+    path_file_index : str, optional
+        Path to a json file index of directory listings, see scan_files, by default None
+
+    Returns
+    -------
+    pandas DataFrame
+        Metadata with the same columns as maad.util.get_metadata_dir
+    """
+    if path_index is None:
+        path_index = os.path.join(path_dir, METADATA_INDEX_FNAME)
+
+    # List wav files with their size and modification time
+    flist = scan_files(path_dir, '.wav', recursive=True, n_jobs=n_jobs, path_index=path_file_index)
+    flist = [fname.replace('\\', '/') for fname in flist]
+    stats = [os.stat(fname) for fname in flist]
+    df_files = pd.DataFrame({
+        'path_audio': flist,
+        'fsize': [st.st_size for st in stats],
+        'mtime': [st.st_mtime_ns for st in stats]})
+
+    # Load previous index and keep rows of unchanged files
+    if os.path.isfile(path_index):
+        df_index = pd.read_csv(path_index, dtype=METADATA_INDEX_DTYPES)
+        df_index = df_index.drop_duplicates('path_audio', keep='last')
+    else:
+        df_index = pd.DataFrame(columns=METADATA_COLUMNS + ['mtime']).astype(
+            {'fsize': 'int64', 'mtime': 'int64'})
+    df_files = df_files.merge(
+        df_index, on=['path_audio', 'fsize', 'mtime'], how='left', indicator=True)
+    idx_new = (df_files['_merge'] == 'left_only').values
+    df_files.drop(columns='_merge', inplace=True)
+
+    if verbose:
+        print(f'Number of WAVE files detected: {len(flist)}')
+        print(f'Number of new or modified files: {idx_new.sum()}')
+
+    # Read headers only for new or modified files
+    flist_new = df_files.loc[idx_new, 'path_audio'].to_list()
+    if len(flist_new) > 0:
+        df_new = inspect_wav_files(flist_new, n_jobs=n_jobs, verbose=verbose)
+        df_new = pd.concat([df_new, parse_filenames(df_new['fname'])], axis=1)
+        # Keep consistency with maad: unreadable files have null values on all fields
+        df_new.loc[df_new['error'].notna(), METADATA_COLUMNS[2:]] = np.nan
+        df_new['fsize'] = df_files.loc[idx_new, 'fsize'].values
+        df_new['mtime'] = df_files.loc[idx_new, 'mtime'].values
+        if verbose:
+            for fname in df_new.loc[df_new['error'].notna(), 'path_audio']:
+                print('Incorrect wave format. Return null values for: ', fname)
+        df_new = df_new[METADATA_COLUMNS + ['mtime']].astype(object)
+        df_files.loc[idx_new, METADATA_COLUMNS + ['mtime']] = df_new.values
+
+    # Update index
+    try:
+        df_files[METADATA_COLUMNS + ['mtime']].to_csv(path_index, index=False)
+    except OSError as e:
+        print(f'Metadata index could not be saved at {path_index}: {e}')
+
+    df_metadata = df_files[METADATA_COLUMNS].astype(METADATA_DTYPES)
+    df_metadata['date'] = pd.to_datetime(df_metadata['date'])
+    return df_metadata
+
+def parse_filenames(fnames):
+    """ Get sensor name, date and time from file names in standard format
+
+    The standard format is SITENAME_DATE_TIME.WAV, with DATE as YYYYMMDD and TIME as
+    HHMMSS. Files that do not follow the format get null values.
+
+    Parameters
+    ----------
+    fnames : pandas Series
+        File names.
+
+    Returns
+    -------
+    pandas DataFrame
+        Columns sensor_name, date (formated as YYYY-mm-dd HH:MM:SS) and time.
+    """
+    fnames = fnames.astype(str)
+    parts = fnames.str.split('_', expand=True).reindex(columns=range(3))
+    parts = parts.fillna('').astype(str)
+    idx_valid = (
+        fnames.str.count('_').eq(2)
+        & parts[1].str.len().eq(8) & parts[1].str.isnumeric()
+        & parts[2].str.len().eq(10) & parts[2].str[0:6].str.isnumeric())
+
+    df = pd.DataFrame(index=fnames.index, columns=['sensor_name', 'date', 'time'])
+    date = parts.loc[idx_valid, 1]
+    hour = parts.loc[idx_valid, 2]
+    df.loc[idx_valid, 'sensor_name'] = parts.loc[idx_valid, 0]
+    df.loc[idx_valid, 'date'] = (
+        date.str[0:4] + '-' + date.str[4:6] + '-' + date.str[6:8] + ' '
+        + hour.str[0:2] + ':' + hour.str[2:4] + ':' + hour.str[4:6])
+    df.loc[idx_valid, 'time'] = hour.str[0:6]
+    return df
+
+def print_damaged_files(df, n_jobs=-1):
+    """ Print and return files with unreadable or truncated WAVE headers
+
+    Parameters
+    ----------
+    df : pandas DataFrame or string with path to a csv file
+        Metadata with column path_audio.
+    n_jobs : int, optional
+        Number of threads used to read headers, -1 uses all processors, by default -1
+
+    Returns
+    -------
+    pandas DataFrame
+        Header information of damaged files, as returned by inspect_wav_files
+    """
+    df = input_validation(df)
+    df_header = inspect_wav_files(df['path_audio'], n_jobs=n_jobs)
+    df_damaged = df_header.loc[df_header['error'].notna() | df_header['truncated']]
+    for _, row in df_damaged.iterrows():
+        reason = row.error if pd.notna(row.error) else 'truncated'
+        print(f'{row.fname}: {reason}')
+    return df_damaged.reset_index(drop=True)
+
+def iter_metadata(data, chunksize=100000, columns=None):
+    """ Iterate over metadata in chunks of rows
+
+    Csv files are read in chunks and metadata stores partition by partition, so the
+    full metadata is never loaded in memory.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe, path to a csv file, to a metadata store or to an audio directory.
+    chunksize : int, optional
+        Number of rows per chunk for csv files and dataframes, by default 100000
+    columns : list, optional
+        Columns to load, by default all columns.
+
+    Yields
+    ------
+    pandas DataFrame
+        Chunk of metadata
+    """
+    if isinstance(data, str) and os.path.isfile(data) and data.lower().endswith('.csv'):
+        yield from pd.read_csv(data, chunksize=chunksize, usecols=columns,
+                               dtype={'sensor_name': str, 'time': str})
+    elif isinstance(data, str) and os.path.isdir(data) and is_metadata_store(data):
+        for path_partition in read_metadata_manifest(data)['path_partition']:
+            yield _read_partition(data, path_partition, columns=columns)
+    else:
+        df = input_validation(data)
+        if columns is not None:
+            df = df[columns]
+        for idx in range(0, len(df), chunksize):
+            yield df.iloc[idx:idx + chunksize]
+
+def aggregate_metadata(data, chunksize=100000):
+    """ Compute per site and per day statistics of the sampling in a single pass
+
+    Metadata is processed in chunks: medians are computed from histograms of lengths
+    and sample rates, which take few distinct values in passive acoustic monitoring.
+    Sampling intervals need the dates of each site in order, so dates are kept as 8
+    bytes per recording and sorted per site at the end. Medians are exact whatever the
+    order of rows, such as csv files written by get_audio_metadata.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe, path to a csv file, to a metadata store or to an audio
+        directory. Must have the columns sensor_name, date, length and sample_rate.
+    chunksize : int, optional
+        Number of rows processed at once, by default 100000
+
+    Returns
+    -------
+    df_site : pandas DataFrame
+        One row per site with columns sensor_name, date_ini, date_end, n_recordings,
+        time_diff, sample_length and sample_rate.
+    df_daily : pandas DataFrame
+        Number of recordings per site and day with columns sensor_name, date and count.
+    """
+    columns = ['sensor_name', 'date', 'length', 'sample_rate']
+    date_ini, date_end, n_recordings, site_dates = [], [], [], {}
+    hist_length, hist_rate, daily = [], [], []
+    for chunk in iter_metadata(data, chunksize, columns):
+        chunk = chunk.dropna().copy()
+        chunk['date'] = pd.to_datetime(chunk['date'], format='%Y-%m-%d %H:%M:%S')
+        chunk = chunk.sort_values(['sensor_name', 'date'], kind='stable')
+        grouped = chunk.groupby('sensor_name')
+        date_ini.append(grouped['date'].min())
+        date_end.append(grouped['date'].max())
+        n_recordings.append(grouped.size())
+
+        # Sites may be split across chunks, intervals are computed after the last one
+        dates = chunk['date'].values.astype('int64')
+        for site, idx in grouped.indices.items():
+            site_dates.setdefault(site, []).append(dates[idx])
+
+        hist_length.append(chunk.groupby(['sensor_name', chunk['length'].round(3)]).size())
+        hist_rate.append(chunk.groupby(['sensor_name', 'sample_rate']).size())
+        daily.append(chunk.groupby(['sensor_name', chunk['date'].dt.normalize()]).size())
+
+        # Combine partial results to keep memory bounded
+        date_ini = [pd.concat(date_ini).groupby(level=0).min()]
+        date_end = [pd.concat(date_end).groupby(level=0).max()]
+        n_recordings, hist_length, hist_rate, daily = [
+            [_sum_counts(counts)] for counts in
+            [n_recordings, hist_length, hist_rate, daily]]
+    hist_diff = [_interval_counts(site_dates)]
+
+    df_site = pd.DataFrame({
+        'date_ini': date_ini[0] if date_ini else pd.Series(dtype='datetime64[ns]'),
+        'date_end': date_end[0] if date_end else pd.Series(dtype='datetime64[ns]'),
+        'n_recordings': n_recordings[0] if n_recordings else pd.Series(dtype='int64')})
+    df_site['time_diff'] = pd.to_timedelta(_histogram_median(hist_diff), unit='s')
+    df_site['sample_length'] = _histogram_median(hist_length)
+    df_site['sample_rate'] = _histogram_median(hist_rate)
+    df_site.index.name = 'sensor_name'
+    df_site = df_site.reset_index()
+
+    df_daily = (daily[0] if daily else pd.Series(dtype='int64')).astype('int64')
+    df_daily = df_daily.rename('count').reset_index()
+    df_daily.columns = ['sensor_name', 'date', 'count']
+    df_daily['date'] = pd.to_datetime(df_daily['date']).dt.date
+    return df_site, df_daily
+
+def _sum_counts(counts):
+    """ Sum a list of count series with a common index structure """
+    counts = [c for c in counts if len(c) > 0]
+    if len(counts) == 0:
+        return pd.Series(dtype='int64')
+    return pd.concat(counts).groupby(level=list(range(counts[0].index.nlevels))).sum()
+
+def _interval_counts(site_dates):
+    """ Counts indexed by (site, interval in seconds) from the dates of each site in ns """
+    counts = []
+    for site, dates in site_dates.items():
+        diff = np.diff(np.sort(np.concatenate(dates))) / 1e9
+        values, n = np.unique(diff, return_counts=True)
+        counts.append(pd.Series(n, index=pd.MultiIndex.from_arrays(
+            [np.full(len(values), site, dtype=object), values])))
+    counts = [c for c in counts if len(c) > 0]
+    if len(counts) == 0:
+        return pd.Series(dtype='int64')
+    return pd.concat(counts)
+
+def _histogram_median(hist):
+    """ Median per site from a list with a series of counts indexed by (site, value) """
+    if len(hist) == 0 or len(hist[0]) == 0:
+        return pd.Series(dtype='float64')
+    hist = hist[0].sort_index()
+    site = hist.index.get_level_values(0)
+    value = pd.Series(hist.index.get_level_values(1).astype('float64'), index=hist.index)
+    cumsum = hist.groupby(level=0).cumsum()
+    total = hist.groupby(level=0).transform('sum')
+    # Lower and upper middle values, averaged as in pandas.Series.median
+    lower = value[cumsum >= (total + 1) // 2].groupby(site[cumsum >= (total + 1) // 2]).first()
+    upper = value[cumsum >= total // 2 + 1].groupby(site[cumsum >= total // 2 + 1]).first()
+    return (lower + upper) / 2
+
+def deployment_matrix(data, chunksize=1000000):
+    """ Number of recordings per site and day as a dense matrix, in a single pass
+
+    Dates are parsed once per distinct value and counts are computed with integer codes,
+    so tens of millions of rows are processed in seconds. Dates must be formatted as
+    YYYY-mm-dd HH:MM:SS.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe, path to a csv file, to a metadata store or to an audio
+        directory. Must have the columns sensor_name and date.
+    chunksize : int, optional
+        Number of rows processed at once, by default 1000000
+
+    Returns
+    -------
+    counts : 2d numpy array of ints
+        Number of recordings with sites as rows and days as columns.
+    sites : pandas Index
+        Sites sorted by first recording and name, as in plot_sensor_deployment.
+    days : pandas DatetimeIndex
+        Consecutive days from the first to the last recording.
+    """
+    daily, first = [], []
+    for chunk in iter_metadata(data, chunksize, ['sensor_name', 'date']):
+        # Missing values get the code -1
+        site_codes, sites = pd.factorize(chunk['sensor_name'])
+        date_codes, dates = pd.factorize(chunk['date'])
+        valid = (site_codes >= 0) & (date_codes >= 0)
+        if not valid.any():
+            continue
+        site_codes, date_codes = site_codes[valid], date_codes[valid]
+        sites = sites.astype(str)
+        dates = pd.to_datetime(dates, format='%Y-%m-%d %H:%M:%S')
+        day_codes, days = pd.factorize(dates.normalize())
+        day_codes = day_codes[date_codes]
+
+        counts = np.bincount(site_codes * len(days) + day_codes, minlength=len(sites) * len(days))
+        idx = np.flatnonzero(counts)
+        daily.append(pd.Series(counts[idx], index=pd.MultiIndex.from_arrays(
+            [sites[idx // len(days)], days[idx % len(days)]])))
+        first_date = pd.Series(dates.asi8[date_codes]).groupby(site_codes).min()
+        first.append(pd.Series(first_date.values, index=sites[first_date.index]))
+        # Combine partial results to keep memory bounded
+        daily = [_sum_counts(daily)]
+        first = [pd.concat(first).groupby(level=0).min()]
+
+    if not daily or len(daily[0]) == 0:
+        return np.zeros((0, 0), dtype='int64'), pd.Index([]), pd.DatetimeIndex([])
+    first = pd.Series(pd.to_datetime(first[0].values), index=first[0].index)
+    sites = pd.Index(pd.DataFrame({'first': first, 'site': first.index}).sort_values(
+        ['first', 'site'], kind='stable')['site'], name='sensor_name')
+    days = pd.date_range(daily[0].index.get_level_values(1).min(),
+                         daily[0].index.get_level_values(1).max(), freq='D')
+    counts = np.zeros((len(sites), len(days)), dtype='int64')
+    counts[sites.get_indexer(daily[0].index.get_level_values(0)),
+           days.get_indexer(daily[0].index.get_level_values(1))] = daily[0].values
+    return counts, sites, days
 
-def random_sample_metadata(df, n_samples_per_site=10, hour_sel=None, random_state=None):
-    """ Get a random sample form metadata DataFrame """
-    if hour_sel==None:
+def random_sample_metadata(df, n_samples_per_site=10, hour_sel=None, random_state=None,
+                           strata=('sensor_name',), chunksize=None):
+    """ Get a random sample form metadata DataFrame
+
+    Rows are sampled without replacement within each stratum. Strata with fewer rows
+    than requested are kept entirely. Each row gets a random key and the rows with the
+    smallest keys are kept in each stratum, so the sample can also be drawn from a
+    stream of chunks (reservoir sampling) with the same result as in memory.
+
+    Parameters
+    ----------
+    df : pandas DataFrame or str
+        Metadata dataframe, path to a csv file or to a metadata store.
+    n_samples_per_site : int, optional
+        Number of samples per stratum, by default 10
+    hour_sel : list, optional
+        Hours to sample from, as strings formated as 'HH', by default all hours
+    random_state : int, optional
+        Seed for the random generator, by default None
+    strata : list, optional
+        Columns defining the strata. Besides metadata columns, 'hour' and 'day' can be
+        used, by default ('sensor_name',)
+    chunksize : int, optional
+        If provided, metadata is read in chunks of this size and sampled in streaming
+        mode with bounded memory, by default None
+
+    Returns
+    -------
+    pandas DataFrame
+        Sampled metadata with an additional column hour, sorted by strata and date.
+    """
+    rng = np.random.default_rng(random_state)
+    strata = list(strata)
+    if hour_sel is None:
         hour_sel = [str(i).zfill(2) for i in range(24)]
+    hour_sel = [str(hour).zfill(2) for hour in hour_sel]
+
+    if chunksize is None:
+        chunks = [input_validation(df)]
+    else:
+        chunks = iter_metadata(df, chunksize)
+
+    df_out = None
+    for chunk in chunks:
+        # format data
+        date = pd.to_datetime(chunk['date'])
+        chunk = chunk.assign(hour=date.dt.hour.astype(str).str.zfill(2))
+        if 'day' in strata:
+            chunk['day'] = date.dt.normalize()
+        chunk = chunk.loc[chunk['hour'].isin(hour_sel)]
+        chunk = chunk.assign(_key=rng.random(len(chunk)))
 
-    # format data
-    df.loc[:,'hour'] = df.loc[:,'date'].str[11:13].astype(str)
-    sensor_list = df.sensor_name.unique()
+        # keep the rows with the smallest keys per stratum
+        df_out = chunk if df_out is None else pd.concat([df_out, chunk], ignore_index=True)
+        rank = df_out.groupby(strata)['_key'].rank(method='first')
+        df_out = df_out.loc[rank <= n_samples_per_site]
 
-    # Batch process
-    df_out = pd.DataFrame()
-    for sensor_name in sensor_list:
-        df_sel = df.loc[(df.sensor_name==sensor_name) & (df.hour.isin(hour_sel)),:]
-        df_sel = df_sel.sample(n_samples_per_site, random_state=random_state)
-        df_out = pd.concat([df_out, df_sel])
+    # Metadata without rows gives no chunk in streaming mode
+    if df_out is None:
+        return input_validation(df).iloc[:0].assign(hour=pd.Series(dtype=object))
 
+    df_out = df_out.sort_values(strata + ['date', '_key'], kind='stable')
+    df_out = df_out.drop(columns=['_key'] + (['day'] if 'day' in strata else []))
     df_out.reset_index(drop=True, inplace=True)
 
     return df_out
 
-def metadata_summary(df):
+def metadata_summary(df, chunksize=100000):
     """ Get a summary of a metadata dataframe of the acoustic sampling
 
     Parameters
     ----------
-    df : pandas DataFrame or string with path to a csv file
+    df : pandas DataFrame or string with path to a csv file or metadata store
         The dataframe must have the columns site, date, sample_length.
         Use maad.util.get_audio_metadata to compile the dataframe.
+    chunksize : int, optional
+        Number of rows processed at once, see aggregate_metadata, by default 100000
 
     Returns
     -------
     pandas DataFrame
         A summary of each site
     """
-    # Function argument validation
-    df = input_validation(df)
-        
-    df['date'] = pd.to_datetime(df.date,  format='%Y-%m-%d %H:%M:%S')
-    df.dropna(inplace=True)
-    df_summary = {}
-    for site, df_site in df.groupby('sensor_name'):
-        site_summary = {
-            'date_ini': str(df_site.date.min()),
-            'date_end': str(df_site.date.max()),
-            'n_recordings': len(df_site),
-            'duration': str(df_site.date.max() - df_site.date.min()),
-            'time_diff': df_site['date'].sort_values().diff().median(),
-            'sample_length': round(df_site.length.median(), 1),
-            'sample_rate': int(df_site.sample_rate.median()),
-        }
-        df_summary[site] = site_summary
-    df_summary = pd.DataFrame(df_summary).T
-    return df_summary.reset_index().rename(columns={'index': 'sensor_name'})
+    df_site, _ = aggregate_metadata(df, chunksize)
+    df_summary = pd.DataFrame({
+        'sensor_name': df_site['sensor_name'],
+        'date_ini': df_site['date_ini'].astype(str),
+        'date_end': df_site['date_end'].astype(str),
+        'n_recordings': df_site['n_recordings'],
+        'duration': (df_site['date_end'] - df_site['date_ini']).astype(str),
+        'time_diff': df_site['time_diff'],
+        'sample_length': df_site['sample_length'].round(1),
+        'sample_rate': df_site['sample_rate'].astype(int)})
+    return df_summary
+
+#%%
+# --------------------------
+# Metadata Store Functions
+# --------------------------
+def is_metadata_store(path_store):
+    """ Check if a path is a columnar metadata store built with write_metadata_store """
+    return os.path.isfile(os.path.join(path_store, METADATA_STORE_MANIFEST))
+
+def write_metadata_store(data, path_store, verbose=False):
+    """ Save metadata as a columnar store partitioned by sensor name and month
+
+    Each partition is saved as a numpy .npz file with one typed array per column and
+    rows sorted by date. A manifest with the date range of each partition allows to read
+    only the partitions that match a query, see read_metadata_store.
+
+    Parameters
+    ----------
+    data : pandas DataFrame or string with path to a csv file
+        Metadata with at least the columns sensor_name and date.
+    path_store : str
+        Directory where the store is saved.
+    verbose : bool, optional
+        Print progress messages, by default False
+
+    Returns
+    -------
+    pandas DataFrame
+        Manifest of the store, one row per partition.
+    """
+    df = input_validation(data)
+    df = df.assign(date=pd.to_datetime(df['date']))
+    idx_valid = df['sensor_name'].notna() & df['date'].notna()
+    if verbose and (~idx_valid).sum() > 0:
+        print(f'Removing {(~idx_valid).sum()} rows without sensor name or date')
+    df = df.loc[idx_valid].sort_values(['sensor_name', 'date'], kind='stable')
+    df['sensor_name'] = df['sensor_name'].astype(str)
+    month = df['date'].values.astype('datetime64[M]').astype(str)
+
+    # Remove partitions from a previous version of the store
+    if is_metadata_store(path_store):
+        for fname in read_metadata_manifest(path_store)['path_partition']:
+            fname = os.path.join(path_store, fname)
+            if os.path.isfile(fname):
+                os.remove(fname)
+
+    manifest = []
+    for (sensor_name, month_partition), df_partition in df.groupby(['sensor_name', month]):
+        path_partition = os.path.join(f'sensor_name={sensor_name}', f'{month_partition}.npz')
+        os.makedirs(os.path.join(path_store, f'sensor_name={sensor_name}'), exist_ok=True)
+        columns = {col: _column_to_array(df_partition[col]) for col in df_partition.columns}
+        np.savez(os.path.join(path_store, path_partition), **columns)
+        manifest.append({
+            'sensor_name': sensor_name,
+            'month': month_partition,
+            'date_min': df_partition['date'].min(),
+            'date_max': df_partition['date'].max(),
+            'n_rows': len(df_partition),
+            'path_partition': path_partition})
+        if verbose:
+            print(f'{path_partition}: {len(df_partition)} rows', end='\r')
+
+    manifest = pd.DataFrame(
+        manifest, columns=['sensor_name', 'month', 'date_min', 'date_max', 'n_rows',
+                           'path_partition'])
+    manifest.to_csv(os.path.join(path_store, METADATA_STORE_MANIFEST), index=False)
+    if verbose:
+        print(f'Metadata store saved at {path_store}: {len(manifest)} partitions, '
+              f'{manifest.n_rows.sum()} rows')
+    return manifest
+
+def read_metadata_manifest(path_store):
+    """ Load the manifest of a metadata store """
+    manifest = pd.read_csv(
+        os.path.join(path_store, METADATA_STORE_MANIFEST), dtype={'sensor_name': str},
+        parse_dates=['date_min', 'date_max'])
+    return manifest
+
+def read_metadata_store(path_store, sensor_name=None, date_range=None, columns=None):
+    """ Load metadata from a columnar store reading only the partitions needed
+
+    Parameters
+    ----------
+    path_store : str
+        Directory of the store, built with write_metadata_store.
+    sensor_name : list, optional
+        Sensor names to load, by default all sensors.
+    date_range : list, optional
+        Start and end dates as timestamps or strings. The start date is inclusive and
+        the end date exclusive. By default all dates are loaded.
+    columns : list, optional
+        Columns to load, by default all columns.
+
+    Returns
+    -------
+    pandas DataFrame
+        Metadata with typed columns, date as datetime64.
+    """
+    manifest = read_metadata_manifest(path_store)
+
+    # Select partitions that can hold rows matching the query
+    idx_keep = pd.Series(True, index=manifest.index)
+    if sensor_name is not None:
+        idx_keep &= manifest['sensor_name'].isin([str(name) for name in sensor_name])
+    if date_range is not None:
+        date_range = [pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])]
+        idx_keep &= (manifest['date_max'] >= date_range[0]) & (manifest['date_min'] < date_range[1])
+
+    dfs = [_read_partition(path_store, path_partition, date_range, columns)
+           for path_partition in manifest.loc[idx_keep, 'path_partition']]
+
+    if len(dfs) == 0:
+        cols = columns
+        if cols is None and manifest.shape[0] > 0:
+            with np.load(os.path.join(path_store, manifest['path_partition'].iloc[0])) as partition:
+                cols = partition.files
+        return pd.DataFrame(columns=cols)
+
+    df = pd.concat(dfs, ignore_index=True)
+    return df.astype({col: dtype for col, dtype in METADATA_DTYPES.items() if col in df.columns})
+
+def _read_partition(path_store, path_partition, date_range=None, columns=None):
+    """ Load a partition of a metadata store """
+    with np.load(os.path.join(path_store, path_partition)) as partition:
+        # Rows are sorted by date, slice the date range without loading other columns
+        start, stop = 0, len(partition['date'])
+        if date_range is not None:
+            dates = partition['date']
+            start = np.searchsorted(dates, np.datetime64(date_range[0]), side='left')
+            stop = np.searchsorted(dates, np.datetime64(date_range[1]), side='left')
+        cols = partition.files if columns is None else columns
+        return pd.DataFrame({col: partition[col][start:stop] for col in cols})
+
+def _column_to_array(column):
+    """ Convert a dataframe column to a typed numpy array """
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.values.astype('datetime64[ns]')
+    elif pd.api.types.is_numeric_dtype(column) or pd.api.types.is_bool_dtype(column):
+        if column.isna().any() or pd.api.types.is_extension_array_dtype(column):
+            return column.astype('float64').values
+        return column.values
+    else:
+        return column.astype(str).values.astype(str)
 
 #%%
 # --------------------
 # Time Lapse Functions
 # --------------------
+def read_audio_segment(path_audio, min_t=0, max_t=None, detrend=True):
+    """ Read a time segment of a WAVE file without loading the rest of the file
+
+    Only the frames between min_t and max_t are read from disk. As with maad.sound.load,
+    samples are normalized between -1 and 1 and the left channel is kept.
+
+    Parameters
+    ----------
+    path_audio : str
+        Path to the audio file.
+    min_t : float, optional
+        Start of the segment in seconds, by default 0
+    max_t : float, optional
+        End of the segment in seconds, by default the end of the file
+    detrend : bool, optional
+        Subtract the DC value of the segment, by default True
+
+    Returns
+    -------
+    s : 1d numpy array
+        Audio segment
+    fs : int
+        Sampling frequency
+    """
+    header = read_wav_header(path_audio)
+    if header['error'] is not None:
+        raise ValueError(f"Cannot read {path_audio}: {header['error']}")
+
+    fs = header['sample_rate']
+    channels = header['channels']
+    sampwidth = header['block_align'] // channels
+    start = min(int(round(min_t * fs)), header['samples'])
+    stop = header['samples'] if max_t is None else min(int(round(max_t * fs)), header['samples'])
+    nframes = max(stop - start, 0)
+
+    with stage('read'), open(path_audio, 'rb') as f:
+        f.seek(header['data_offset'] + start * header['block_align'])
+        data = f.read(nframes * header['block_align'])
+    nframes = len(data) // header['block_align']
+    with stage('decode'):
+        data = np.frombuffer(data[:nframes * header['block_align']], dtype=np.uint8)
+        data = data.reshape(nframes, channels, sampwidth)[:, 0, :]
+
+        # Decode samples of the left channel
+        if header['format_tag'] == 3:  # IEEE float
+            s = data.copy().view(f'<f{sampwidth}').ravel().astype(np.float64)
+        elif sampwidth == 1:
+            s = data.ravel() / 2**8
+        elif sampwidth == 3:
+            s = (data[:, 0].astype(np.int32) | (data[:, 1].astype(np.int32) << 8)
+                 | (data[:, 2].astype(np.int8).astype(np.int32) << 16))
+            s = s / 2**23
+        else:
+            s = data.copy().view(f'<i{sampwidth}').ravel() / 2**(8 * sampwidth - 1)
+
+    if detrend and s.size > 0:
+        s = s - np.mean(s)
+    return s, fs
+
 def concat_audio(flist, sample_len=1, verbose=False, display=False):
     """ Concatenates samples using a list of audio files
 
@@ -398,8 +1262,7 @@ def concat_audio(flist, sample_len=1, verbose=False, display=False):
     for idx, fname in enumerate(flist, start=1):
         if verbose:
             print(f'{idx} / {len(flist)} : {os.path.basename(fname)}', end='\r')
-        s, fs = sound.load(fname)
-        s = sound.trim(s, fs, 0, sample_len)
+        s, fs = read_audio_segment(fname, 0, sample_len)
         long_wav.append(s)
 
     long_wav = np.concatenate(long_wav)
@@ -416,35 +1279,128 @@ def concat_audio(flist, sample_len=1, verbose=False, display=False):
 
     return long_wav, fs
 
+def write_timelapse(flist, fname_save, sample_len=1, verbose=False):
+    """ Write a timelapse streaming samples of audio files into a WAVE file
+
+    Each sample is read and written directly, so memory usage does not depend on the
+    number of files. Files with a different sampling rate than the first readable file
+    are resampled, unreadable files are skipped.
+
+    Parameters
+    ----------
+    flist : list or pandas Series
+        List of files to concatenate
+    fname_save : str
+        Path to the output WAVE file, saved as 16 bits mono. If None, samples are read
+        but nothing is written.
+    sample_len : float, optional
+        Length in seconds of each sample, default is 1 second
+    verbose : bool, optional
+        Print progress messages, by default False
+
+    Returns
+    -------
+    int
+        Number of files included in the timelapse
+    """
+    flist = list(flist)
+    writer, fs_out, n_files = None, None, 0
+    try:
+        for idx, fname in enumerate(flist, start=1):
+            if verbose:
+                print(f'{idx} / {len(flist)} : {os.path.basename(fname)}', end='\r')
+            try:
+                s, fs = read_audio_segment(fname, 0, sample_len)
+            except (OSError, ValueError) as e:
+                print(f'Error reading {fname}: {e}')
+                continue
+
+            if fs_out is None:
+                fs_out = fs
+                if fname_save is not None:
+                    writer = wave.open(fname_save, 'wb')
+                    writer.setnchannels(1)
+                    writer.setsampwidth(2)
+                    writer.setframerate(fs_out)
+            elif fs != fs_out:
+                s = sound.resample(s, fs, fs_out, res_type='scipy_poly')
+
+            if writer is not None:
+                s = (np.clip(s, -1, 1) * 32767).astype('<i2')
+                writer.writeframes(s.tobytes())
+            n_files += 1
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_files
+
+def _site_timelapse(site, flist, path_save, sample_len, save_audio, verbose):
+    """ Build the timelapse of a single site, used by audio_timelapse workers """
+    fname_save = os.path.join(path_save, f'{site}_timelapse.wav') if save_audio else None
+    n_files = write_timelapse(flist, fname_save, sample_len, verbose)
+    return site, n_files
+
 def audio_timelapse(
-        data, sample_len, sample_period='30T', date_range=None, path_save=None, save_audio=True, verbose=True)  -> None:
-    """ Build audio timelapse """
+        data, sample_len, sample_period='30T', date_range=None, path_save=None, save_audio=True,
+        verbose=True, n_jobs=1)  -> None:
+    """ Build audio timelapse
+
+    Parameters
+    ----------
+    data : pandas DataFrame or str
+        Metadata dataframe or path to metadata.
+    sample_len : float
+        Length in seconds of each sample.
+    sample_period : str, optional
+        Period between consecutive samples, by default '30T'
+    date_range : list
+        Start and end dates formated as 'YYYY-MM-DD', the end date is exclusive.
+    path_save : str, optional
+        Directory to save timelapses, by default None
+    save_audio : bool, optional
+        Save the timelapse as a WAVE file per site, by default True
+    verbose : bool, optional
+        Print progress messages, by default True
+    n_jobs : int, optional
+        Number of sites processed in parallel, -1 uses all processors, by default 1
+    """
     
     # Function argument validation
     df = input_validation(data)
     date_range = [date_validation(date_range[0]), date_validation(date_range[1])]
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
 
     # select files to create timelapse
     df.date = pd.to_datetime(df.date)
     idx_dates = df.date.between(date_range[0], date_range[1], inclusive='left')
-    df_timelapse = df.loc[idx_dates,:]
+    df_timelapse = df.loc[idx_dates,:].copy()
     df_timelapse['day'] = df_timelapse.date.dt.date
     df_timelapse.set_index('date', inplace=True)
     ngroups = df_timelapse.groupby(['sensor_name', 'day']).ngroups
 
+    # select one file per sample period and site
+    site_flist = dict()
+    for site, df_site in df_timelapse.groupby('sensor_name'):
+        df_site = df_site.sort_index().resample(sample_period).first()
+        df_site = df_site.dropna(subset=['path_audio'])
+        site_flist[site] = df_site['path_audio'].to_list()
+
     # create time lapse
     print(f'Processing {ngroups} groups:')
-    for site, df_site in df_timelapse.groupby('sensor_name'):
-        print(site)
-        df_site.sort_values('date', inplace=True)
-        df_site = df_site.resample(sample_period).first()
-        df_site.dropna(inplace=True)
-        long_wav, fs = concat_audio(df_site['path_audio'],
-                                    sample_len=sample_len, 
-                                    verbose=verbose)
-        if save_audio:
-            sound.write(os.path.join(path_save, f'{site}_timelapse.wav'), fs, long_wav, bit_depth=16)
-        print('\n')
+    if n_jobs == 1:
+        for site, flist in site_flist.items():
+            print(site)
+            _site_timelapse(site, flist, path_save, sample_len, save_audio, verbose)
+            print('\n')
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [
+                executor.submit(_site_timelapse, site, flist, path_save, sample_len, save_audio, False)
+                for site, flist in site_flist.items()]
+            for future in concurrent.futures.as_completed(futures):
+                site, n_files = future.result()
+                print(f'{site} Done! {n_files} samples')
         
 #%%
 def plot_spectrogram(fname, nperseg=1024, noverlap=0.5, db_range=80, width=10, height=4):
@@ -455,19 +1411,234 @@ def plot_spectrogram(fname, nperseg=1024, noverlap=0.5, db_range=80, width=10, h
 
 #%%
 def select_metadata(input_path, sensor_name=None, date_range=None):
+    """ Select metadata rows by sensor name and date range
+
+    When input_path is a metadata store, filters are applied while reading so that only
+    the matching partitions are loaded.
+
+    Parameters
+    ----------
+    input_path : pandas DataFrame or str
+        Metadata dataframe, path to a csv file, to a metadata store or to an audio directory.
+    sensor_name : list, optional
+        Sensor names to keep, by default None
+    date_range : list, optional
+        Start and end dates formated as 'YYYY-MM-DD', the end date is exclusive, by default None
+
+    Returns
+    -------
+    pandas DataFrame
+        Selected metadata
+    """
+    if date_range is not None:
+        date_range = [date_validation(date_range[0]), date_validation(date_range[1])]
+
+    if isinstance(input_path, str) and os.path.isdir(input_path) and is_metadata_store(input_path):
+        return read_metadata_store(input_path, sensor_name, date_range)
+
     df = input_validation(input_path)
     
     if sensor_name is None and date_range is None:
         return df    
     
     else: 
+        idx_keep = pd.Series(True, index=df.index)
         if sensor_name is not None:
             idx_keep = df.sensor_name.isin(sensor_name)
         
         if date_range is not None:
-            date_range = [date_validation(date_range[0]), date_validation(date_range[1])]
             df.date = pd.to_datetime(df.date)
             idx_dates = df.date.between(date_range[0], date_range[1], inclusive='left')
             idx_keep = (idx_keep & idx_dates)
         
         return df.loc[idx_keep,:]
+
+#%%
+# -------------------------
+# Parallel processing
+# -------------------------
+def bounded_map(func, tasks, n_jobs=1, max_in_flight=None):
+    """ Apply func to tuples of arguments with a pool of processes
+
+    At most max_in_flight tasks are pending at any time, by default twice the number of
+    processes, and a new task is submitted each time one finishes.
+
+    Yields
+    ------
+    tuple
+        Position of the task and result, in order of completion.
+    """
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    tasks = enumerate(tasks)
+
+    if n_jobs == 1:
+        for position, task in tasks:
+            yield position, func(*task)
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * n_jobs
+
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs)
+    try:
+        pending = dict()
+        for position, task in itertools.islice(tasks, max_in_flight):
+            pending[executor.submit(func, *task)] = position
+
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+                for position, task in itertools.islice(tasks, 1):
+                    pending[executor.submit(func, *task)] = position
+        # Workers are joined, so that their memory is reported in the resources of children
+        executor.shutdown(wait=True)
+    finally:
+        # Do not wait for pending files if the run is interrupted
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def bounded_map_groups(func, groups, n_jobs=1, max_in_flight=None):
+    """ Apply func to the tasks of several groups, such as sites, as a single queue of a
+    pool of processes
+
+    Tasks are submitted group after group to one pool, so workers move on to the next
+    group while the last tasks of a group complete, instead of starting a pool per group.
+
+    Parameters
+    ----------
+    func : function
+        Function applied to each task.
+    groups : iterable
+        Tuples (key, tasks), with tasks a list of tuples of arguments of func.
+    n_jobs : int, optional
+        Number of processes, -1 uses all processors, by default 1
+    max_in_flight : int, optional
+        Maximum number of pending tasks, by default twice the number of processes.
+
+    Yields
+    ------
+    tuple
+        Key of the group, position of the task in the group, result, and True for the
+        last task of the group to complete. Groups without tasks are yielded first, with
+        position and result None.
+    """
+    groups = [(key, tasks) for key, tasks in groups]
+    for key, tasks in groups:
+        if len(tasks) == 0:
+            yield key, None, None, True
+
+    owners = [(group, position) for group, (_, tasks) in enumerate(groups)
+              for position in range(len(tasks))]
+    remaining = [len(tasks) for _, tasks in groups]
+    flat_tasks = (task for _, tasks in groups for task in tasks)
+    for flat_position, result in bounded_map(func, flat_tasks, n_jobs, max_in_flight):
+        group, position = owners[flat_position]
+        remaining[group] -= 1
+        yield groups[group][0], position, result, remaining[group] == 0
+
+#%%
+# -------------------------
+# Sharding for multi-node runs
+# -------------------------
+def parse_shard(shard):
+    """ Parse a shard given as 'i/N', with i from 1 to N
+
+    Returns
+    -------
+    tuple of int
+        Shard number and number of shards.
+    """
+    try:
+        i, n_shards = [int(x) for x in str(shard).split('/')]
+    except ValueError:
+        raise ValueError(f"Shard must be formated as 'i/N', got {shard}")
+    if not 1 <= i <= n_shards:
+        raise ValueError(f'Shard number must be between 1 and {n_shards}, got {i}')
+    return i, n_shards
+
+def shard_of(keys, n_shards):
+    """ Shard of each key, from 1 to n_shards
+
+    Shards are assigned by a hash of the key, so they do not depend on the order of the
+    metadata, the machine or the Python process.
+    """
+    return np.array([
+        int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'big')
+        % n_shards + 1 for key in keys], dtype=int)
+
+def select_shard(df, shard, by='path_audio'):
+    """ Select the metadata rows of a shard
+
+    Parameters
+    ----------
+    df : pandas DataFrame
+        Metadata dataframe.
+    shard : str or tuple
+        Shard formated as 'i/N' or as a tuple (i, N).
+    by : str, optional
+        Column used to assign rows to shards. Use 'sensor_name' to keep all files of a
+        site in the same shard. By default 'path_audio'
+
+    Returns
+    -------
+    pandas DataFrame
+        Rows of the shard, in the order of df.
+    """
+    i, n_shards = parse_shard(shard) if isinstance(shard, str) else shard
+    return df.loc[shard_of(df[by], n_shards) == i]
+
+def shard_fname(fname, shard):
+    """ Name of the output of a shard, as results.shard-1-of-4.csv for results.csv """
+    i, n_shards = parse_shard(shard) if isinstance(shard, str) else shard
+    root, ext = os.path.splitext(fname)
+    return f'{root}.shard-{i}-of-{n_shards}{ext}'
+
+def read_shards(fname, n_shards, **kwargs):
+    """ Read the csv outputs of all shards of a run
+
+    Parameters
+    ----------
+    fname : str
+        Output path of the single node run, shard outputs are named with shard_fname.
+    n_shards : int
+        Number of shards of the run.
+    **kwargs
+        Arguments passed to pandas.read_csv.
+
+    Returns
+    -------
+    list of pandas DataFrame
+        Outputs of shards with results, shards without files are skipped.
+    """
+    flist = [shard_fname(fname, (i, n_shards)) for i in range(1, n_shards + 1)]
+    missing = [f for f in flist if not os.path.isfile(f)]
+    if missing:
+        raise FileNotFoundError(f'Missing outputs of {len(missing)} shards: {missing}')
+    dfs = []
+    for f in flist:
+        try:
+            dfs.append(pd.read_csv(f, **kwargs))
+        except pd.errors.EmptyDataError:  # shard without files
+            continue
+    return dfs
+
+def check_site_outputs(df, path_output, suffix):
+    """ Check that all sites in the metadata have an output file in path_output
+
+    Used to merge runs grouped by site, where each site is processed by a single shard
+    and shards write the same files as a single node run.
+
+    Returns
+    -------
+    list
+        Sites without output file.
+    """
+    missing = [site for site in df.sensor_name.unique()
+               if not os.path.exists(os.path.join(path_output, f'{site}{suffix}'))]
+    if missing:
+        print(f'Missing outputs for {len(missing)} sites: {missing}')
+    else:
+        print(f'All {df.sensor_name.nunique()} sites have outputs at {path_output}')
+    return missing
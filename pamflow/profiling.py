@@ -0,0 +1,180 @@
+""" Opt-in profiling of processing stages
+
+Profiling is enabled by setting the environment variable PAMFLOW_PROFILE to a directory.
+The variable is inherited by worker processes, and each process appends to its own
+files in that directory the wall and CPU times of each stage per audio file, the
+duration of the audio and the peak memory of the process. Stages run on several files
+at once, such as indices computed on stacks of spectrograms, are split equally between
+the files. When profiling is disabled stages have no cost beyond a dictionary lookup.
+
+    with profile_files(path_audio):
+        with stage('decode'):
+            ...
+
+"""
+import os
+import sys
+import csv
+import json
+import time
+from contextlib import contextmanager
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PROFILE_ENV = 'PAMFLOW_PROFILE'
+_state = {'files': None, 'stages': [], 'audio': dict()}
+
+#%%
+def enabled():
+    """ True if profiling is enabled in this process """
+    return os.environ.get(PROFILE_ENV) is not None
+
+@contextmanager
+def profile_files(files):
+    """ Attribute the stages run within the context to one or several files """
+    if not enabled():
+        yield
+        return
+    previous = _state['files']
+    _state['files'] = [files] if isinstance(files, str) else list(files)
+    try:
+        yield
+    finally:
+        files = _state['files']
+        _state['files'] = previous
+        if previous is None:
+            _flush(files)
+
+@contextmanager
+def stage(name):
+    """ Record wall and CPU time of a processing stage """
+    if not enabled() or _state['files'] is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        files = _state['files']
+        for file in files:
+            _state['stages'].append((file, name, wall / len(files), cpu / len(files)))
+
+def add_audio(seconds):
+    """ Record the duration of audio processed for the current file """
+    if not enabled() or _state['files'] is None:
+        return
+    for file in _state['files']:
+        _state['audio'][file] = _state['audio'].get(file, 0) + seconds / len(_state['files'])
+
+def peak_rss(children=False):
+    """ Peak resident memory of the process in MB, None if not available
+
+    If children, the peak of the largest terminated child process is returned instead.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    maxrss = resource.getrusage(who).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+def _flush(files):
+    """ Append records of this process to the profile directory """
+    path_profile = os.environ[PROFILE_ENV]
+    os.makedirs(path_profile, exist_ok=True)
+    pid = os.getpid()
+    rss = peak_rss()
+
+    _append_csv(os.path.join(path_profile, f'stages_{pid}.csv'),
+                ['path_audio', 'stage', 'wall', 'cpu'], _state['stages'])
+    _append_csv(os.path.join(path_profile, f'files_{pid}.csv'),
+                ['path_audio', 'audio_seconds', 'pid', 'peak_rss_mb'],
+                [(file, _state['audio'].pop(file, 0), pid, rss) for file in files])
+    _state['stages'] = []
+
+def _append_csv(fname, header, rows):
+    new = not os.path.isfile(fname)
+    with open(fname, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+#%%
+def profile_summary(path_profile, elapsed, path_save=None):
+    """ Aggregate profiling records of a run
+
+    Parameters
+    ----------
+    path_profile : str
+        Directory with the records written by the processes of the run.
+    elapsed : float
+        Wall time of the run in seconds.
+    path_save : str, optional
+        Directory to save the summary as profile.json and per file stage times as
+        profile_files.csv, by default the summary is not saved.
+
+    Returns
+    -------
+    df_stages : pandas DataFrame
+        Total and per file wall and CPU times per stage.
+    summary : dict
+        Throughput of the run.
+    """
+    stages = _read_csvs(path_profile, 'stages_', ['path_audio', 'stage', 'wall', 'cpu'])
+    files = _read_csvs(path_profile, 'files_', ['path_audio', 'audio_seconds', 'pid', 'peak_rss_mb'])
+    files = files.groupby('path_audio').agg(
+        audio_seconds=('audio_seconds', 'sum'), peak_rss_mb=('peak_rss_mb', 'max'))
+    n_files = len(files)
+
+    df_stages = stages.groupby('stage', sort=False)[['wall', 'cpu']].sum()
+    df_stages['wall_per_file'] = df_stages['wall'] / max(n_files, 1)
+    df_stages['share'] = df_stages['wall'] / df_stages['wall'].sum()
+    df_stages = df_stages.sort_values('wall', ascending=False)
+
+    audio_hours = files['audio_seconds'].sum() / 3600
+    summary = {
+        'files': n_files,
+        'elapsed_seconds': elapsed,
+        'files_per_second': n_files / elapsed if elapsed > 0 else None,
+        'audio_hours': audio_hours,
+        'audio_hours_per_second': audio_hours / elapsed if elapsed > 0 else None,
+        'peak_rss_mb': None if files['peak_rss_mb'].isna().all() else files['peak_rss_mb'].max(),
+        'stages': df_stages.reset_index().to_dict(orient='records')}
+
+    if path_save is not None:
+        os.makedirs(path_save, exist_ok=True)
+        with open(os.path.join(path_save, 'profile.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        df_files = stages.pivot_table(
+            index='path_audio', columns='stage', values='wall', aggfunc='sum')
+        df_files = files.join(df_files)
+        df_files.to_csv(os.path.join(path_save, 'profile_files.csv'))
+    return df_stages, summary
+
+def print_profile(df_stages, summary):
+    """ Print the summary of a profiled run """
+    print(f"\nProfile of {summary['files']} files in {summary['elapsed_seconds']:.1f} s")
+    print(df_stages.to_string(float_format=lambda x: f'{x:.3f}'))
+    if summary['files_per_second'] is not None:
+        print(f"Throughput: {summary['files_per_second']:.2f} files/s, "
+              f"{summary['audio_hours_per_second']:.3f} audio hours/s")
+    if summary['peak_rss_mb'] is not None:
+        print(f"Peak memory of a process: {summary['peak_rss_mb']:.0f} MB")
+
+def _read_csvs(path_profile, prefix, columns):
+    """ Concatenate the records of all processes, the directory is missing if no file was processed """
+    flist = []
+    if os.path.isdir(path_profile):
+        flist = [os.path.join(path_profile, fname) for fname in os.listdir(path_profile)
+                 if fname.startswith(prefix) and fname.endswith('.csv')]
+    if not flist:
+        return pd.DataFrame({col: pd.Series(dtype='object' if col in ('path_audio', 'stage') else 'f8')
+                             for col in columns})
+    return pd.concat([pd.read_csv(fname) for fname in flist], ignore_index=True)
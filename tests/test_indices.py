@@ -0,0 +1,42 @@
+""" The stacked engine of acoustic indices matches compute_acoustic_indices """
+import numpy as np
+import pytest
+from maad import sound
+from pamflow.acoustic_indices.indices import INDICES, RTOL
+from pamflow.acoustic_indices.utils import compute_acoustic_indices, compute_acoustic_indices_batch
+from pamflow.benchmark.utils import synthetic_signal
+
+FS = 48000
+
+def _spectra(seed, n_files=4, length=5):
+    """ Spectrograms and envelopes of seeded synthetic soundscapes along the day """
+    rng = np.random.default_rng(seed)
+    signals = [synthetic_signal(length, FS, hour, rng) for hour in np.linspace(0, 23, n_files)]
+    spectra = [sound.spectrogram(s, FS, nperseg=1024, noverlap=0, mode='amplitude')
+               for s in signals]
+    envs = [sound.envelope(s, mode='fast', Nt=512) for s in signals]
+    return signals, spectra, envs
+
+@pytest.mark.parametrize('seed', range(3))
+def test_batch_matches_per_file(seed):
+    signals, spectra, envs = _spectra(seed)
+    fn = spectra[0][2]
+    Sxx = np.stack([Sxx for Sxx, _, _, _ in spectra])
+    records = compute_acoustic_indices_batch(Sxx, fn, np.stack(envs))
+    assert set(records.dtype.names) == set(INDICES)
+    for idx, (s, (Sxx, tn, fn, _), env) in enumerate(zip(signals, spectra, envs)):
+        expected = compute_acoustic_indices(s, Sxx, tn, fn, env)
+        for name in INDICES:
+            np.testing.assert_allclose(records[name][idx], expected[name], rtol=RTOL,
+                                       err_msg=name)
+
+@pytest.mark.parametrize('name', list(INDICES))
+def test_single_index(name):
+    signals, spectra, envs = _spectra(0, n_files=2)
+    fn = spectra[0][2]
+    Sxx = np.stack([Sxx for Sxx, _, _, _ in spectra])
+    records = compute_acoustic_indices_batch(Sxx, fn, np.stack(envs), indices=[name])
+    assert records.dtype.names == (name,)
+    for idx, (s, (Sxx, tn, fn, _), env) in enumerate(zip(signals, spectra, envs)):
+        expected = compute_acoustic_indices(s, Sxx, tn, fn, env)[name]
+        np.testing.assert_allclose(records[name][idx], expected, rtol=RTOL)
@@ -0,0 +1,57 @@
+""" local_max finds the same peaks as skimage.feature.peak_local_max """
+import numpy as np
+import pytest
+from skimage.feature import peak_local_max
+from pamflow.graphical_soundscape.peaks import local_max
+
+MIN_DISTANCES = range(0, 7)
+# skimage warns that min_distance 0 only applies the threshold
+pytestmark = pytest.mark.filterwarnings('ignore:When min_distance < 1')
+
+def _images(seed):
+    """ Spectrogram-like images with plateaus, peaks on borders and flat regions """
+    rng = np.random.default_rng(seed)
+    noise = rng.normal(size=(40, 60))
+    # Few levels give ties and plateaus of neighboring pixels
+    plateaus = rng.integers(0, 4, size=(40, 60)).astype(float)
+    blocks = np.kron(rng.integers(0, 3, size=(8, 12)), np.ones((5, 5)))
+    border = rng.normal(size=(30, 30)) - 10
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = 5
+    border[0, 0] = border[15, -1] = border[-1, 7] = 9
+    flat = np.zeros((20, 25))
+    partly_flat = np.zeros((20, 25))
+    partly_flat[5:9, 10:14] = 1
+    return {'noise': noise, 'plateaus': plateaus, 'blocks': blocks, 'border': border,
+            'flat': flat, 'partly_flat': partly_flat}
+
+def _expected(image, min_distance, threshold_abs):
+    return peak_local_max(image, min_distance=min_distance, threshold_abs=threshold_abs)
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('min_distance', MIN_DISTANCES)
+@pytest.mark.parametrize('threshold_abs', [None, 0.5])
+def test_local_max(seed, min_distance, threshold_abs):
+    for name, image in _images(seed).items():
+        result = local_max(image, min_distance, threshold_abs)
+        expected = _expected(image, min_distance, threshold_abs)
+        np.testing.assert_array_equal(result, expected, err_msg=name)
+
+@pytest.mark.parametrize('min_distance', MIN_DISTANCES)
+@pytest.mark.parametrize('threshold_abs', [None, 0.5])
+def test_local_max_stack(min_distance, threshold_abs):
+    rng = np.random.default_rng(0)
+    stack = np.stack([
+        rng.normal(size=(40, 60)),
+        rng.integers(0, 4, size=(40, 60)).astype(float),
+        np.zeros((40, 60)),
+        rng.integers(0, 2, size=(40, 60)) - 5.])
+    result = local_max(stack, min_distance, threshold_abs)
+    for file, image in enumerate(stack):
+        expected = _expected(image, min_distance, threshold_abs)
+        np.testing.assert_array_equal(result[result[:, 0] == file, 1:], expected)
+    # Files are returned in order
+    assert np.all(np.diff(result[:, 0]) >= 0)
+
+def test_local_max_invalid_shape():
+    with pytest.raises(ValueError):
+        local_max(np.zeros(10))